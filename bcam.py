@@ -1,16 +1,86 @@
 #!/usr/bin/env python
 
+import os
 import re
+import time
+import threading
+import Queue
+from collections import OrderedDict
 from astropy.io import fits as pyfits
 import numpy as np
 
+import bcam_fits
+import bcam_stats
+import bcam_metrics
+from bcam_metrics import timer
+
 import logging
 
-from pylibapogee import pylibapogee as apg
 from ctypes import *
 
-# TODO: sort out this absolute path in a sane way
-libfli = CDLL("/home/tim/BCAM/libfli-1.104/libfli.so")
+# where the BCAM checkout lives: libfli, the log file and the server's data go under here
+BCAM_HOME = os.environ.get("BCAM_HOME", "/home/tim/BCAM")
+
+# BCAM_BACKEND=sim swaps libapogee and libfli for the simulated hardware in bcam_sim
+BACKEND = os.environ.get("BCAM_BACKEND", "hardware")
+if BACKEND == "sim":
+    import bcam_sim as apg
+else:
+    from pylibapogee import pylibapogee as apg
+
+# libfli is only loaded when the focuser is first opened
+libfli = None
+
+def loadLibfli():
+    global libfli
+    if libfli is None:
+        if BACKEND == "sim":
+            libfli = apg.FLI
+        else:
+            libfli = CDLL(os.path.join(BCAM_HOME, "libfli-1.104", "libfli.so"))
+    return libfli
+
+# libfli domain for USB focusers
+FLI_FOCUSER_USB = 0x02 | 0x300
+
+# paths of the FLI focusers on the host, from FLIList
+def findFocusers():
+    try:
+        loadLibfli()
+    except OSError as e:
+        b_log.warn("Can't load libfli: %s" % e)
+        return []
+    names = POINTER(c_char_p)()
+    err = libfli.FLIList(FLI_FOCUSER_USB, byref(names))
+    if err != 0:
+        bcam_metrics.ERRORS.inc(source="libfli", code=err)
+        b_log.warn("Can't list FLI focusers.")
+        return []
+    paths = []
+    i = 0
+    while names and names[i] is not None:
+        # each entry is "path;model"
+        paths.append(names[i].split(";")[0])
+        i += 1
+    libfli.FLIFreeList(names)
+    return paths
+
+# named acquisition geometries.  each has a binning and optionally a window, given either as
+# startx/starty/endx/endy or as a width and height centred on the chip, in unbinned pixels; without
+# one it's the full chip.
+PROFILES = OrderedDict([
+    ("full", {"xbin": 1, "ybin": 1}),
+    ("binned2", {"xbin": 2, "ybin": 2}),
+    ("binned4", {"xbin": 4, "ybin": 4}),
+    ("finder", {"xbin": 8, "ybin": 8}),
+    ("window", {"xbin": 1, "ybin": 1, "width": 1024, "height": 1024}),
+    ("star", {"xbin": 1, "ybin": 1, "width": 128, "height": 128}),
+])
+
+# connection states of the camera
+INITIALIZING = "initializing"
+READY = "ready"
+DISCONNECTED = "disconnected"
 
 def add_coloring_to_emit_ansi(fn):
     def new(*args):
@@ -34,7 +104,7 @@ def add_coloring_to_emit_ansi(fn):
 # Initialize logger
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 b_log = logging.getLogger()
-fh = logging.FileHandler("/home/tim/BCAM/bcam.log")
+fh = logging.FileHandler(os.environ.get("BCAM_LOG", os.path.join(BCAM_HOME, "bcam.log")))
 fh.setLevel(logging.DEBUG)
 fh.setFormatter(logging.Formatter("%(asctime)s: %(levelname)s - %(message)s"))
 b_log.addHandler(fh)
@@ -43,58 +113,380 @@ f = logging.Formatter("%(levelname)s: %(message)s")
 ch.setFormatter(f)
 logging.StreamHandler.emit = add_coloring_to_emit_ansi(logging.StreamHandler.emit)
 
+class ExposureError(Exception):
+    """
+    raised when an exposure ends in one of the camera's error states or doesn't finish in time.
+    'code' is the camera status, "timeout" or "aborted".
+    """
+    def __init__(self, msg, code=None):
+        Exception.__init__(self, msg)
+        self.code = code
+
+# FITS date string (UTC, to the millisecond) for unix time t
+def fitsDate(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + ".%03d" % int(1000*(t % 1.0))
+
+# pixels copied per slice when a camera can only hand back a sequence
+READ_CHUNK = 65536
+
+# read the frame waiting in the camera into out, a flat contiguous uint16 array of rows*cols
+# pixels.  backends that provide GetImageInto(address, npixels) write straight into out; otherwise
+# the result of GetImage is copied in slices so no second full-size array is ever built.
+def readImage(cam, out):
+    n = out.size
+    if hasattr(cam, "GetImageInto"):
+        with timer("transfer"):
+            cam.GetImageInto(out.ctypes.data, n)
+        return out
+
+    with timer("transfer"):
+        data = cam.GetImage()
+    with timer("convert"):
+        try:
+            src = np.frombuffer(data, dtype=np.uint16, count=n)
+        except Exception:
+            src = None
+        if src is not None:
+            out[:] = src
+        else:
+            for i in xrange(0, n, READ_CHUNK):
+                out[i:i+READ_CHUNK] = data[i:i+READ_CHUNK]
+    return out
+
+class ImageBuffer:
+    """
+    reusable uint16 frame buffer.  readouts are written into it in place and returned as views, so
+    an image is only valid until the next read into the same buffer.
+    """
+    def __init__(self, npix=4096*4096):
+        self.data = np.empty(npix, dtype=np.uint16)
+
+    # read the current frame from cam and return a rows x cols view onto the buffer
+    def read(self, cam, rows, cols):
+        n = rows*cols
+        if n > self.data.size:
+            self.data = np.empty(n, dtype=np.uint16)
+        return readImage(cam, self.data[:n]).reshape(rows, cols)
+
+class DeviceLock:
+    """
+    serializes access to one piece of hardware.  urgent work such as an image readout goes ahead
+    of anything queued and marks the device busy; while it's busy, status reads are answered from
+    the last value read instead of waiting behind it.  counts calls, waits and cached answers.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.cond = threading.Condition()
+        self.held = False
+        self.busy = False
+        self.queued = 0
+        self.urgent_queued = 0
+        self.last = {}
+        self.calls = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.cached = 0
+
+    def acquire(self, urgent=False):
+        t0 = time.time()
+        self.cond.acquire()
+        try:
+            self.queued += 1
+            if urgent:
+                self.urgent_queued += 1
+            while self.held or (not urgent and self.urgent_queued > 0):
+                self.cond.wait()
+            self.queued -= 1
+            if urgent:
+                self.urgent_queued -= 1
+            self.held = True
+
+            wait = time.time() - t0
+            self.calls += 1
+            if wait > 0.001:
+                self.waits += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.held = False
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def timed(self, func, args):
+        t0 = time.time()
+        try:
+            return func(*args)
+        finally:
+            bcam_metrics.countCall(self.name, time.time() - t0)
+
+    # run func(*args) with the device to ourselves
+    def call(self, func, *args):
+        self.acquire()
+        try:
+            return self.timed(func, args)
+        finally:
+            self.release()
+
+    # run func(*args) ahead of everything queued, with the device marked busy
+    def urgent(self, func, *args):
+        self.acquire(urgent=True)
+        self.busy = True
+        try:
+            return self.timed(func, args)
+        finally:
+            self.busy = False
+            self.release()
+
+    # status read remembered under key.  while the device is busy the last value is returned
+    # without touching the hardware.
+    def read(self, key, func, *args):
+        if self.busy and key in self.last:
+            self.cached += 1
+            return self.last[key]
+        value = self.call(func, *args)
+        self.last[key] = value
+        return value
+
+    def stats(self):
+        return {
+            "device": self.name,
+            "busy": self.busy,
+            "queue_depth": self.queued,
+            "calls": self.calls,
+            "waits": self.waits,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "cached_reads": self.cached,
+        }
+
+class GuardedCamera:
+    """
+    wraps a libapogee camera so that every call goes through its DeviceLock.  readouts are urgent
+    and Get* status calls are reads, so they're answered from last-known values during a readout.
+    """
+    READOUT = ("GetImage", "GetImageInto")
+
+    def __init__(self, cam, device):
+        self.cam = cam
+        self.device = device
+
+    def __getattr__(self, name):
+        attr = getattr(self.cam, name)
+        if not callable(attr):
+            return attr
+        device = self.device
+
+        # count libapogee exceptions by type before passing them on
+        def checked(*args):
+            try:
+                return attr(*args)
+            except Exception as e:
+                bcam_metrics.ERRORS.inc(source="libapogee", code=type(e).__name__)
+                raise
+
+        if name in GuardedCamera.READOUT:
+            def readout(*args):
+                return device.urgent(checked, *args)
+            return readout
+        elif name.startswith("Get"):
+            def status(*args):
+                return device.read((name,) + args, checked, *args)
+            return status
+        else:
+            def command(*args):
+                return device.call(checked, *args)
+            return command
+
+class FrameWriter:
+    """
+    pool of threads writing finished frames to FITS files.  frames are read into a ring of 'nslots'
+    reusable ImageBuffers; a slot is only handed out again once its frame is on disk, so when the
+    writers fall behind, acquisition blocks waiting for a free slot.
+    """
+    def __init__(self, nslots=4, nwriters=2, npix=4096*4096):
+        self.free = Queue.Queue()
+        for i in range(nslots):
+            self.free.put(ImageBuffer(npix))
+        self.pending = Queue.Queue()
+        self.errors = []
+        self.threads = []
+        for i in range(nwriters):
+            t = threading.Thread(target=self.run, name="writer-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    # wait for a free buffer.  returns it and how long the wait took.
+    def slot(self):
+        t0 = time.time()
+        buf = self.free.get()
+        return buf, time.time() - t0
+
+    # queue image (a view onto buf) for writing to path.  the write time goes into record.
+    def write(self, path, image, header, buf, record):
+        self.pending.put((path, image, header, buf, record))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            path, image, header, buf, record = item
+            t0 = time.time()
+            try:
+                f = open(path, "wb")
+                try:
+                    for chunk in bcam_fits.stream(image, header):
+                        f.write(chunk)
+                finally:
+                    f.close()
+            except Exception as e:
+                b_log.error("Can't write %s: %s" % (path, e))
+                self.errors.append("%s: %s" % (path, e))
+            record["write"] = time.time() - t0
+            self.free.put(buf)
+
+    # wait for everything queued to be written and stop the writers
+    def close(self):
+        for t in self.threads:
+            self.pending.put(None)
+        for t in self.threads:
+            t.join()
+
+class Move:
+    """
+    a focuser move, to be waited on like a future.  once done, 'position' is where the focuser
+    stopped and 'error' says why it didn't get there, if it didn't.  a move that was still waiting
+    when a later one replaced it is marked 'superseded' and is done when that one is.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.position = None
+        self.error = None
+        self.superseded = False
+        self.replaces = []
+        self.done = threading.Event()
+
+    def finish(self, position, error=None):
+        for move in self.replaces:
+            move.finish(position, error)
+        self.position = position
+        self.error = error
+        self.done.set()
+
+    # wait up to timeout s for the move to end.  returns whether the focuser reached the target.
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.isSet() and self.error is None and self.position == self.target
+
 class Focuser:
     """
     class for talking to an FLI precision focuser.  requires FLI's fliusb-1.3 and libfli-1.104.
+    'id' names it in logs, metrics and headers.
+
+    moves are started asynchronously and followed by a poller thread reading
+    FLIGetStepsRemaining, so nothing holds the device while the focuser travels.  a goto issued
+    while the focuser is moving waits for that move to finish, and replaces any goto already
+    waiting.  with 'backlash' set, targets below the current position are approached from that
+    many steps further down, so every move ends travelling upward.
     """
-    attached = False
+    # seconds between FLIGetStepsRemaining polls while moving, and the longest a blocking goto
+    # waits for the focuser to get there
+    MOTION_POLL = 0.05
+    MOVE_TIMEOUT = 120.0
+
+    # default to the first FLI device.  nothing is opened until open(), and a focuser with no
+    # device path never opens, for a camera that has none.
+    def __init__(self, device="/dev/fliusb0", id="foc0", backlash=0):
+        self.path = device
+        self.id = id
+        self.backlash = backlash
+        self.attached = False
+        self.handle = None
+        self.device = DeviceLock(id)
+        self.extent = None
+
+        # the move under way with the positions left to visit for it, the move waiting for it
+        # to finish, and the time and position at which the last move ended
+        self.motion = threading.Condition()
+        self.move = None
+        self.legs = []
+        self.pending = None
+        self.final = None
+        self.idle = threading.Event()
+        self.idle.set()
+        self.poller = None
 
-    # default to the first FLI device (always true for BCAM)
-    def __init__(self, device="/dev/fliusb0"):
-        if not Focuser.attached:
-            Focuser.handle = c_long()
-            err = libfli.FLIOpen(byref(Focuser.handle), device, 0x02 | 0x300)
+    # load libfli and open the focuser.  returns whether it's attached.
+    def open(self):
+        if not self.attached and self.path is not None:
+            try:
+                loadLibfli()
+            except OSError as e:
+                b_log.warn("Can't load libfli: %s" % e)
+                return False
+            self.handle = c_long()
+            err = libfli.FLIOpen(byref(self.handle), self.path, FLI_FOCUSER_USB)
             if err != 0:
+                bcam_metrics.ERRORS.inc(source="libfli", code=err)
                 b_log.warn("Can't open FLI device!")
-                Focuser.handle = None
-                Focuser.attached = False
+                self.handle = None
+                self.attached = False
             else:
-                b_log.info("Opened FLI focuser at %s with handle %d." % 
-                           (device, Focuser.handle.value))
-                Focuser.attached = True
+                b_log.info("Opened FLI focuser %s at %s with handle %d." %
+                           (self.id, self.path, self.handle.value))
+                self.attached = True
+                self.extent = None
+        return self.attached
 
     # get current focus position
     def position(self):
-        if Focuser.attached:
-            position = c_long()
-            err = libfli.FLIGetStepperPosition(Focuser.handle, byref(position))
-            if err != 0:
-                b_log.warn("Can't query stepper position: error in read.")
-                return None
-            else:
-                b_log.info("FLI Focuser position: %d", position.value)
-                return position.value
+        if self.attached:
+            return self.device.read("position", self.readPosition)
         else:
             b_log.warn("Can't query stepper position: no device attached.")
 
-    # get upper limits (should be 7000)
+    def readPosition(self):
+        position = c_long()
+        err = libfli.FLIGetStepperPosition(self.handle, byref(position))
+        if err != 0:
+            bcam_metrics.ERRORS.inc(source="libfli", code=err)
+            b_log.warn("Can't query stepper position: error in read.")
+            return None
+        else:
+            b_log.debug("FLI Focuser position: %d", position.value)
+            return position.value
+
+    # get upper limits (should be 7000).  it's read from the focuser once and remembered.
     def upper_limit(self):
-        if Focuser.attached:
-            limit = c_long()
-            err = libfli.FLIGetFocuserExtent(Focuser.handle, byref(limit))
-            if err != 0:
-                b_log.warn("Can't query stepper limit: error in read.")
-                return None
-            else:
-                b_log.info("FLI Focuser maximum position: %d", limit.value)
-                return limit.value
+        if self.attached:
+            if self.extent is None:
+                self.extent = self.device.call(self.readExtent)
+            return self.extent
         else:
             b_log.warn("Can't query stepper limit: no device attached.")
 
+    def readExtent(self):
+        limit = c_long()
+        err = libfli.FLIGetFocuserExtent(self.handle, byref(limit))
+        if err != 0:
+            bcam_metrics.ERRORS.inc(source="libfli", code=err)
+            b_log.warn("Can't query stepper limit: error in read.")
+            return None
+        else:
+            b_log.info("FLI Focuser maximum position: %d", limit.value)
+            return limit.value
+
     # no way to query it, but empirically it's 0
     def lower_limit(self):
-        if Focuser.attached:
-            b_log.info("FLI Focuser minimum position: %d", 0)
+        if self.attached:
             return 0
         else:
             b_log.warn("Can't query stepper limit: no device attached.")
@@ -102,25 +494,30 @@ class Focuser:
 
     # get the internal temperature of the focuser
     def temperature(self):
-        if Focuser.attached:
-            t = c_double()
-            err = libfli.FLIReadTemperature(Focuser.handle, 0, byref(t))
-            if err != 0:
-                b_log.warn("Can't query focuser temperature: error in read.")
-                return None
-            else:
-                b_log.info("FLI Focuser internal temperature (C): %.2f" % t.value)
-                return t.value
+        if self.attached:
+            return self.device.read("temperature", self.readTemperature)
         else:
             b_log.warn("Can't query focuser temperature: no device attached.")
             return None
+
+    def readTemperature(self):
+        t = c_double()
+        err = libfli.FLIReadTemperature(self.handle, 0, byref(t))
+        if err != 0:
+            bcam_metrics.ERRORS.inc(source="libfli", code=err)
+            b_log.warn("Can't query focuser temperature: error in read.")
+            return None
+        else:
+            b_log.debug("FLI Focuser internal temperature (C): %.2f" % t.value)
+            return t.value
         
     # home the focuser
     def home(self):
-        if Focuser.attached:
+        if self.attached:
             b_log.info("Homing FLI Focuser....")
-            err = libfli.FLIHomeFocuser(Focuser.handle)
+            err = self.device.urgent(libfli.FLIHomeFocuser, self.handle)
             if err != 0:
+                bcam_metrics.ERRORS.inc(source="libfli", code=err)
                 b_log.warn("Can't home focuser: error in command.")
                 return False
             else:
@@ -130,75 +527,512 @@ class Focuser:
             b_log.warn("Can't home focuser: no device attached.")
             return False
 
-    # to a movement where 'steps' is relative to the current position.  async determines which command is used
-    # to determine whether to command motion and return right away or to wait until motion is complete. 
+    # a movement where 'steps' is relative to the current position, or to where the last goto
+    # is taking the focuser.  async determines whether to return as soon as the move is
+    # started or to wait until it's complete.
     def step(self, steps, async=False):
-        if Focuser.attached:
-            now = self.position()
-            new = now + steps
-            if new > self.upper_limit() or new < self.lower_limit():
-                b_log.warn("Attempted motion to position %d is out of range (%d,%d)." 
-                           % (new,self.upper_limit(),self.lower_limit()))
-                return False
+        if not self.attached:
+            b_log.warn("Can't step focuser: no device attached.")
+            return False
+        base = self.target()
+        if base is None:
+            base = self.position()
+        if base is None:
+            return False
+        return self.goto(base + steps, async=async)
+
+    # perform movement to an absolute position.  returns whether the move was started (async) or
+    # whether the focuser got there.
+    def goto(self, position, async=False):
+        move = self.moveTo(position)
+        if move is None:
+            return False
+        if async:
+            return True
+        return move.wait(Focuser.MOVE_TIMEOUT)
+
+    # start moving to an absolute position, or queue the move if the focuser is already moving.
+    # returns the Move, or None if it's out of range or the focuser isn't attached.
+    def moveTo(self, position):
+        if not self.attached:
+            b_log.warn("Can't move focuser: no device attached.")
+            return None
+        lo, hi = self.lower_limit(), self.upper_limit()
+        if hi is None or position < lo or position > hi:
+            b_log.warn("Attempted motion to position %d is out of range (%d,%s)." %
+                       (position, lo, hi))
+            return None
 
-            if not async:
-                b_log.info("Stepping FLI Focuser %d steps from %d...." % 
-                           (steps, now))
-                err = libfli.FLIStepMotor(Focuser.handle, c_long(steps))
+        self.motion.acquire()
+        try:
+            if self.move is None:
+                move = Move(position)
+                self.begin(move)
+            elif self.pending is None and self.move.target == position:
+                # already on its way there
+                move = self.move
+            elif self.pending is not None and self.pending.target == position:
+                move = self.pending
             else:
-                b_log.info("Stepping FLI Focuser asynchronously %d steps from %d...." % 
-                           (steps, self.position()))
-                err = libfli.FLIStepMotorAsync(Focuser.handle, c_long(steps))
+                move = Move(position)
+                if self.pending is not None:
+                    self.pending.superseded = True
+                    move.replaces.append(self.pending)
+                self.pending = move
+            return move
+        finally:
+            self.motion.release()
+
+    # target of the move under way or waiting, if any
+    def target(self):
+        self.motion.acquire()
+        try:
+            if self.pending is not None:
+                return self.pending.target
+            if self.move is not None:
+                return self.move.target
+            return None
+        finally:
+            self.motion.release()
+
+    # plan move and start its first leg.  called with the motion lock held.
+    def begin(self, move):
+        now = self.device.call(self.readPosition)
+        if now is None:
+            self.idle.set()
+            move.finish(None, "can't read position")
+            return
+        self.legs = [move.target]
+        if self.backlash and move.target < now:
+            self.legs.insert(0, max(move.target - self.backlash, self.lower_limit()))
+        self.move = move
+        self.idle.clear()
+        b_log.info("Moving FLI focuser %s from %d to %d." % (self.id, now, move.target))
+        self.startLeg(self.legs[0] - now)
+        if self.poller is None or not self.poller.isAlive():
+            self.poller = threading.Thread(target=self.follow, name="%s-motion" % self.id)
+            self.poller.daemon = True
+            self.poller.start()
+        self.motion.notifyAll()
+
+    # step toward the next position on the plan.  called with the motion lock held.
+    def startLeg(self, steps):
+        err = 0
+        if steps != 0:
+            err = self.device.call(libfli.FLIStepMotorAsync, self.handle, c_long(steps))
+        if err != 0:
+            bcam_metrics.ERRORS.inc(source="libfli", code=err)
+            b_log.warn("Can't step focuser: error in command.")
+            self.end(None, "step command failed (%d)" % err)
+
+    # finish the move under way and start the one waiting, if any.  called with the motion lock
+    # held.
+    def end(self, position, error=None):
+        move = self.move
+        self.move = None
+        self.legs = []
+        self.final = (time.time(), position)
+        move.finish(position, error)
+        if self.pending is not None:
+            move, self.pending = self.pending, None
+            self.begin(move)
+        if self.move is None:
+            self.idle.set()
+
+    # the poller: follow each move through its legs until the focuser stops
+    def follow(self):
+        while True:
+            self.motion.acquire()
+            try:
+                while self.move is None:
+                    self.motion.wait()
+            finally:
+                self.motion.release()
 
+            time.sleep(Focuser.MOTION_POLL)
+            steps = self.stepsRemaining()
+            if steps != 0:
+                if steps is None:
+                    self.motion.acquire()
+                    try:
+                        if self.move is not None:
+                            self.end(None, "can't read steps remaining")
+                    finally:
+                        self.motion.release()
+                continue
+
+            self.motion.acquire()
+            try:
+                if self.move is None:
+                    continue
+                done = self.legs.pop(0)
+                if self.legs:
+                    self.startLeg(self.legs[0] - done)
+                else:
+                    position = self.device.call(self.readPosition)
+                    if position == self.move.target:
+                        self.end(position)
+                    else:
+                        self.end(position, "stopped at %s" % position)
+            finally:
+                self.motion.release()
+
+    # whether the focuser is at rest with no move under way or waiting
+    def settled(self):
+        return self.idle.isSet()
+
+    # number of steps left in the current move
+    def stepsRemaining(self):
+        if self.attached:
+            steps = c_long()
+            err = self.device.call(libfli.FLIGetStepsRemaining, self.handle, byref(steps))
             if err != 0:
-                b_log.warn("Can't step focuser: error in command.")
-                return False
+                bcam_metrics.ERRORS.inc(source="libfli", code=err)
+                b_log.warn("Can't query steps remaining: error in read.")
+                return None
             else:
-                b_log.info("FLI Focuser successfully commanded to step to position %d." % 
-                           new)
-                return True
+                return steps.value
         else:
-            b_log.warn("Can't step focuser: no device attached.")
+            b_log.warn("Can't query steps remaining: no device attached.")
+            return None
+
+    # wait for every move under way or waiting to finish.  returns False on a timeout.
+    def waitForMotion(self, timeout=60.0):
+        if not self.idle.wait(timeout):
+            b_log.warn("FLI Focuser still moving to %s after %.1f s." % (self.target(), timeout))
             return False
+        return True
 
-    # perform movement to an absolute position.
-    def goto(self, position, async=False):
-        now = self.position()
-        delta = position - now
-        self.step(delta, async=async)
+class Snapshot:
+    """
+    immutable, timestamped set of telemetry values, indexed like a dict.  a snapshot older than its
+    ttl (in seconds) is stale.
+    """
+    def __init__(self, values, ttl, t=None):
+        self._values = dict(values)
+        self.ttl = ttl
+        if t is None:
+            t = time.time()
+        self.time = t
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def keys(self):
+        return self._values.keys()
+
+    def age(self):
+        return time.time() - self.time
+
+    def stale(self):
+        return self.age() > self.ttl
+
+class Telemetry:
+    """
+    polls camera and focuser state on a background thread every 'interval' seconds and publishes
+    the result as a Snapshot.  readers only ever see a complete snapshot and never touch the
+    hardware.  snapshots are stale after 'ttl' seconds, three polling intervals by default.
+    polling waits until the camera is connected, and 'lost_after' polls failing in a row mark it
+    disconnected.  each snapshot is also added to 'history' (a bcam_history.History) if given, and
+    every poll, connected or not, publishes the camera state and latest values to 'feed' (a
+    bcam_live.StatusFeed).
+    """
+    def __init__(self, bcam, interval=2.0, ttl=None, lost_after=3, history=None, feed=None):
+        self.bcam = bcam
+        self.interval = interval
+        self.history = history
+        self.feed = feed
+        if ttl is None:
+            ttl = 3.0*interval
+        self.ttl = ttl
+        self.lost_after = lost_after
+        self.failures = 0
+        self.snapshot = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.thread is None or not self.thread.isAlive():
+            self._stop.clear()
+            self.thread = threading.Thread(target=self.run, name="telemetry")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # take one snapshot from the hardware and publish it
+    def poll(self):
+        self.snapshot = Snapshot(self.bcam.readTelemetry(), self.ttl)
+        if self.history is not None:
+            self.history.add(self.snapshot)
+        return self.snapshot
+
+    def run(self):
+        while not self._stop.isSet():
+            if self.bcam.state == READY:
+                try:
+                    self.poll()
+                    self.failures = 0
+                except Exception as e:
+                    b_log.warn("Telemetry poll failed: %s" % e)
+                    self.failures += 1
+                    if self.failures >= self.lost_after:
+                        self.failures = 0
+                        self.bcam.lost("telemetry failed %d times: %s" % (self.lost_after, e))
+            if self.feed is not None:
+                self.publish()
+            self._stop.wait(self.interval)
+
+    # send the camera state and, while it's connected, the last snapshot to the feed
+    def publish(self):
+        values = {"state": self.bcam.state, "error": self.bcam.error, "now": time.time()}
+        snap = self.snapshot
+        if snap is not None and self.bcam.state == READY:
+            for key in snap.keys():
+                values[key] = snap[key]
+            values["time"] = snap.time
+        self.feed.publish(values)
+
+class Connector:
+    """
+    finds and connects the camera and focuser on a background thread, so that nothing waits on USB
+    discovery or cam.Init().  when the camera is lost it reconnects, waiting 'backoff' seconds
+    after the first failed attempt and doubling the wait up to 'max_backoff'.
+    """
+    def __init__(self, bcam, backoff=1.0, max_backoff=60.0):
+        self.bcam = bcam
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempts = 0
+        self.thread = None
+        self.wake = threading.Event()
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.thread is None or not self.thread.isAlive():
+            self._stop.clear()
+            self.thread = threading.Thread(target=self.run, name="connector")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wake.set()
+
+    def run(self):
+        delay = self.backoff
+        while not self._stop.isSet():
+            if self.bcam.state != READY:
+                self.attempts += 1
+                if self.bcam.connect():
+                    delay = self.backoff
+                else:
+                    b_log.info("Retrying camera connection in %.0f s." % delay)
+                    # woken early if the camera turns up somewhere new
+                    self.wake.wait(delay)
+                    self.wake.clear()
+                    delay = min(2.0*delay, self.max_backoff)
+                    continue
+            # sleep until lost() says the camera has gone
+            self.wake.wait(self.max_backoff)
+            self.wake.clear()
+
+class StartBarrier:
+    """
+    lines up exposures on several cameras so they start together.  each camera's acquireImage
+    waits here once its ROI is programmed and they're all released when the last one arrives.  if
+    that takes more than 'timeout' seconds, or one of them gives up through abort(), every waiting
+    exposure fails with ExposureError.
+    """
+    def __init__(self, parties, timeout=30.0):
+        self.parties = parties
+        self.timeout = timeout
+        self.arrived = 0
+        self.broken = False
+        self.released = None
+        self.cond = threading.Condition()
+
+    # wait for the rest of the group.  returns the time they were released.
+    def wait(self):
+        self.cond.acquire()
+        try:
+            self.arrived += 1
+            if self.arrived == self.parties:
+                self.released = time.time()
+                self.cond.notifyAll()
+            deadline = time.time() + self.timeout
+            while self.released is None and not self.broken:
+                left = deadline - time.time()
+                if left <= 0:
+                    self.broken = True
+                    self.cond.notifyAll()
+                    break
+                self.cond.wait(left)
+            if self.released is None:
+                raise ExposureError("Only %d of %d cameras were ready to start together." %
+                                    (self.arrived, self.parties), "sync")
+            return self.released
+        finally:
+            self.cond.release()
+
+    # release everyone still waiting with an error, e.g. because one camera failed before it
+    # got here
+    def abort(self):
+        self.cond.acquire()
+        try:
+            if self.released is None:
+                self.broken = True
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
 class BCAM:
     """
     class for talking to BCAM which consists of an Apogee Alta U16M CCD and an FLI precision
     focuser.  requires libapogee to be installed and uses the SWIG python bindings to that from 
     http://sourceforge.net/projects/apogee-driver/
+
+    each instance drives one camera, and its focuser if it has one.  the calibration store, archive
+    and the flags below are shared by all cameras unless set on an instance.
     """
-    camera = None
-    foc = Focuser()
+    calib = None
+    archive = None
+
+    # compute bcam_stats statistics for every frame unless acquireImage is told otherwise
+    frame_stats = False
+
+    # add a card with the last frame's stage timing to headers
+    timing_card = False
+
+    # have headers wait, up to SETTLE_TIMEOUT s, for a focuser move to finish so that they record
+    # where it stopped rather than somewhere along the way
+    settle_focus = False
+    SETTLE_TIMEOUT = 60.0
+
+    # readout model for the Alta U16M used to pace status polling.  digitization is the nominal
+    # 1 MHz mode and the row shift time is per unbinned row.
+    PIXEL_RATE = 1.0e6
+    ROW_SHIFT = 2.0e-5
+    READ_OVERHEAD = 0.05
+
+    # limits on the status polling interval and the slack added to the expected exposure +
+    # readout time before an exposure is declared lost.
+    MIN_POLL = 0.005
+    MAX_POLL = 0.25
+    TIMEOUT_PAD = 10.0
+
+    # patterns for the fields of a FindDeviceUsb listing
+    DEVICE_RE = re.compile("<d>(.*?<)/d>")
+    FIELD_RE = dict([(name, re.compile("%s=(.*?)[,|<]" % name))
+                     for name in ("interface", "address", "port", "id", "firmwareRev", "model",
+                                  "interfaceStatus")])
+
+    # 'id' names the camera in logs, metrics, headers and server routes.  'address' picks the
+    # camera from the FindDeviceUsb listing; without one the first camera listed is used.  the
+    # focuser defaults to the first FLI device.  with connect=False the camera is left for a
+    # Connector to find in the background.
+    def __init__(self, connect=True, id="cam0", address=None, focuser=None):
+        self.id = id
+        self.address = address
+        if focuser is None:
+            focuser = Focuser()
+        self.foc = focuser
+        self.camera = None
+        self.device = DeviceLock(id)
+        self.state = INITIALIZING
+        self.error = None
+        self.devices = None
+        self.connected_at = None
+        self.connector = None
+        self.registers = None
+        self.telemetry = None
+        self.sensor = None
+        self.profiles = {}
+        self.roi = None
+        self.calibration = None
+        self.timing = None
+        self.started = None
+        self.stats = None
+        self.synced = None
+
+        # set to interrupt an exposure in progress
+        self.aborting = threading.Event()
+
+        # the cancel Event of the job driving the camera, if any.  unlike aborting it's never
+        # cleared here, so a cancelled job can't go on to start another exposure.
+        self.cancelled = None
 
-    def __init__(self):
         # find and initialize camera
-        if not BCAM.camera:
+        if connect:
+            self.connect()
+
+    # open the focuser if it isn't already, and find, connect and initialize this camera.
+    # returns whether the camera is ready.
+    def connect(self):
+        self.foc.open()
+        try:
             cameras = self.getUsbApogees()
-            if cameras[0]:
-                try:
-                    BCAM.camera = self.createAndConnectCam(cameras[0])
-                except:
-                    BCAM.camera = None
-            else:
-                BCAM.camera = None
+            if self.address is not None:
+                cameras = [c for c in cameras if c["address"] == self.address]
+            if not cameras:
+                if self.address is not None:
+                    raise IOError("no Apogee camera at address %s" % self.address)
+                raise IOError("no Apogee cameras found")
+            cam = self.createAndConnectCam(cameras[0])
+            self.connected_at = cameras[0]["address"]
+        except Exception as e:
+            # look again next time, in case the camera came back somewhere else
+            self.devices = None
+            self.state = DISCONNECTED
+            self.error = str(e)
+            b_log.warn("Can't connect camera %s: %s" % (self.id, e))
+            return False
+        self.camera = GuardedCamera(cam, self.device)
+        self.sensor = None
+        self.profiles = {}
+        self.registers = None
+        self.error = None
+        self.state = READY
+        return True
+
+    # mark the camera disconnected and wake the Connector, if there is one, to reconnect
+    def lost(self, reason):
+        if self.state != READY:
+            return
+        b_log.error("Camera %s lost: %s" % (self.id, reason))
+        self.state = DISCONNECTED
+        self.error = reason
+        cam = self.camera
+        self.camera = None
+        self.devices = None
+        try:
+            cam.CloseConnection()
+        except Exception:
+            pass
+        if self.connector is not None:
+            self.connector.wake.set()
 
-    # get listing of attached apogee devices
+    # get listing of attached apogee devices.  the listing is kept until a connection fails.
     def getUsbApogees(self):
-        msg = apg.FindDeviceUsb().Find()
-        return self.parseDeviceStr(msg)
+        if self.devices is None:
+            msg = apg.FindDeviceUsb().Find()
+            self.devices = self.parseDeviceStr(msg)
+        return self.devices
 
     def parseDeviceStr(self, deviceStr):
         #MUST include the < in the grouping, so the regex
         #search functions below will find the last item in the
         #string
-        deviceStrList = re.findall("<d>(.*?<)/d>", deviceStr)
+        deviceStrList = BCAM.DEVICE_RE.findall(deviceStr)
         deviceDictList = []
+        fields = BCAM.FIELD_RE
         
         for device in deviceStrList:
             # 1 here, because the match above will
@@ -210,27 +1044,27 @@ class BCAM:
                 continue
         
             devDict = {}
-            mm = re.search("interface=(.*?)[,|<]", device)
+            mm = fields["interface"].search(device)
             devDict["interface"] = mm.group(1)
             
-            mmA = re.search("address=(.*?)[,|<]", device)
+            mmA = fields["address"].search(device)
         
             if "ethernet" == devDict["interface"]:
-                mmP = re.search("port=(.*?)[,|<]", device)
+                mmP = fields["port"].search(device)
                 devDict["address"] = mmA.group(1) + ":" + mmP.group(1)
             else:
                 devDict["address"] = mmA.group(1)
                 
-            mm = re.search("id=(.*?)[,|<]", device)
+            mm = fields["id"].search(device)
             devDict["id"] = mm.group(1)  
             
-            mm = re.search("firmwareRev=(.*?)[,|<]", device)
+            mm = fields["firmwareRev"].search(device)
             devDict["firmwareRev"] = mm.group(1)
             
-            mm = re.search("model=(.*?)[,|<]", device)
+            mm = fields["model"].search(device)
             devDict["model"] = mm.group(1) 
             
-            mm = re.search("interfaceStatus=(.*?)[,|<]", device)
+            mm = fields["interfaceStatus"].search(device)
             status = mm.group(1).replace("\"","")
             devDict["interfaceStatus"] = status  
             
@@ -265,45 +1099,264 @@ class BCAM:
                        ( cam.GetModel(), devDict["interface"] ) )
         return cam
 
-    # acquire image from camera
-    def acquireImage(self, exp, shutter, xbin=1, ybin=1, startx=0, starty=0, endx=4096, endy=4096):
-        cam = BCAM.camera
+    # static sensor properties.  these never change for a connected camera so they're read once.
+    def sensorInfo(self):
+        if self.sensor is None:
+            cam = self.camera
+            self.sensor = {
+                "pixel_height": cam.GetPixelHeight(),
+                "pixel_width": cam.GetPixelWidth(),
+                "max_img_cols": cam.GetMaxImgCols(),
+                "max_img_rows": cam.GetMaxImgRows(),
+                "max_bin_cols": cam.GetMaxBinCols(),
+                "max_bin_rows": cam.GetMaxBinRows(),
+                "model": cam.GetModel(),
+                "sensor": cam.GetSensor(),
+            }
+        return self.sensor
 
-# TODO: set up working check here to see if an exposure is on-going.  i think Flushing is the right
-# one to check for by default.
-#
-#        status = None
-#        while status != apg.Status_Idle:
-#            status = cam.GetImagingStatus()
+    # query the camera and focuser for everything shown on the status page or written to headers
+    def readTelemetry(self):
+        cam = self.camera
+        values = dict(self.sensorInfo())
+        values.update({
+            "imaging_status": cam.GetImagingStatus(),
+            "fan_mode": cam.GetFanMode(),
+            "cooler_status": cam.GetCoolerStatus(),
+            "cooler_drive": cam.GetCoolerDrive(),
+            "setpoint": cam.GetCoolerSetPoint(),
+            "backoff": cam.GetCoolerBackoffPoint(),
+            "t_ccd": cam.GetTempCcd(),
+            "t_heatsink": cam.GetTempHeatsink(),
+            "shutter_state": cam.GetShutterState(),
+            "focus": None,
+            "focus_temp": None,
+        })
+        if self.foc.attached:
+            values["focus"] = self.foc.position()
+            values["focus_temp"] = self.foc.temperature()
+        return values
+
+    # latest telemetry snapshot.  without a Telemetry poller, or if its snapshot is missing or
+    # stale, the hardware is queried directly.
+    def status(self):
+        t = self.telemetry
+        if t is None:
+            return Snapshot(self.readTelemetry(), 0.0)
+        snap = t.snapshot
+        if snap is None or snap.stale():
+            snap = t.poll()
+        return snap
+
+    # ROI as programmed on the camera
+    def readRoi(self):
+        cam = self.camera
+        return {
+            "xbin": cam.GetRoiBinCol(),
+            "ybin": cam.GetRoiBinRow(),
+            "startx": cam.GetRoiStartCol(),
+            "starty": cam.GetRoiStartRow(),
+            "nx": cam.GetRoiNumCols(),
+            "ny": cam.GetRoiNumRows(),
+        }
+
+    # program the camera's ROI registers, skipping any that already hold the wanted value so that
+    # repeated frames with the same geometry cost no register writes.  if a write fails nothing is
+    # assumed about the registers and they're all written next time.
+    def programRoi(self, xbin, ybin, startx, starty, nx, ny):
+        cam = self.camera
+        if self.registers is None:
+            self.registers = {}
+        wanted = (("StartRow", starty), ("NumRows", ny), ("BinRow", ybin),
+                  ("StartCol", startx), ("NumCols", nx), ("BinCol", xbin))
+        try:
+            for name, value in wanted:
+                if self.registers.get(name) != value:
+                    getattr(cam, "SetRoi" + name)(value)
+                    self.registers[name] = value
+        except Exception:
+            self.registers = None
+            raise
 
+    # ROI for the given binning and corners (unbinned pixels), clamped to the sensor
+    def geometry(self, xbin=1, ybin=1, startx=0, starty=0, endx=4096, endy=4096):
         if startx > endx:
             startx, endx = endx, startx
         if starty > endy:
             starty, endy = endy, starty
 
-        if ybin > cam.GetMaxBinRows():
-            ybin = cam.GetMaxBinRows()
-        if endy > cam.GetMaxImgRows():
-            endy = cam.GetMaxImgRows()
-        if xbin > cam.GetMaxBinCols():
-            xbin = cam.GetMaxBinCols()
-        if endx > cam.GetMaxImgCols():
-            endx = cam.GetMaxImgCols()
+        sensor = self.sensorInfo()
+        if ybin > sensor["max_bin_rows"]:
+            ybin = sensor["max_bin_rows"]
+        if endy > sensor["max_img_rows"]:
+            endy = sensor["max_img_rows"]
+        if xbin > sensor["max_bin_cols"]:
+            xbin = sensor["max_bin_cols"]
+        if endx > sensor["max_img_cols"]:
+            endx = sensor["max_img_cols"]
 
-        cam.SetRoiStartRow(starty)
         rows = int( (endy-starty)/ybin )
-        cam.SetRoiNumRows(rows)
-        cam.SetRoiBinRow(ybin)
-						
-        cam.SetRoiStartCol(startx)
         cols = int( (endx-startx)/xbin )
-        cam.SetRoiNumCols(cols)
-        cam.SetRoiBinCol(xbin)
-	
-        status = None
-        cam.StartExposure(exp, shutter)
-        while status != apg.Status_ImageReady:
+        return {"xbin": xbin, "ybin": ybin, "startx": startx, "starty": starty,
+                "nx": cols, "ny": rows}
+
+    # ROI of the named profile from PROFILES.  it's checked against the sensor's limits the first
+    # time it's asked for and remembered until the camera reconnects.  raises ValueError for an
+    # unknown profile or one this sensor can't do.
+    def profile(self, name):
+        roi = self.profiles.get(name)
+        if roi is not None:
+            return roi
+        if name not in PROFILES:
+            raise ValueError("Unknown profile '%s'." % name)
+        p = PROFILES[name]
+        sensor = self.sensorInfo()
+        cols, rows = sensor["max_img_cols"], sensor["max_img_rows"]
+        xbin, ybin = p["xbin"], p["ybin"]
+        if "width" in p:
+            startx = (cols - p["width"])//2
+            starty = (rows - p["height"])//2
+            endx, endy = startx + p["width"], starty + p["height"]
+        else:
+            startx, starty = p.get("startx", 0), p.get("starty", 0)
+            endx, endy = p.get("endx", cols), p.get("endy", rows)
+        if xbin > sensor["max_bin_cols"] or ybin > sensor["max_bin_rows"]:
+            raise ValueError("Profile '%s' bins %dx%d but the sensor allows at most %dx%d." %
+                             (name, xbin, ybin, sensor["max_bin_cols"], sensor["max_bin_rows"]))
+        if startx < 0 or starty < 0 or endx > cols or endy > rows or \
+           endx - startx < xbin or endy - starty < ybin:
+            raise ValueError("Profile '%s' doesn't fit on the %dx%d sensor." % (name, cols, rows))
+        roi = self.geometry(xbin, ybin, startx, starty, endx, endy)
+        self.profiles[name] = roi
+        return roi
+
+    # work out the ROI for a profile, or for the given geometry, and program it on the camera.
+    # only registers that differ from the last frame's are written, so a run of frames with the
+    # same profile costs no camera I/O here after the first.
+    def prepare(self, xbin=1, ybin=1, startx=0, starty=0, endx=4096, endy=4096, profile=None):
+        if profile is not None:
+            roi = dict(self.profile(profile))
+        else:
+            roi = self.geometry(xbin, ybin, startx, starty, endx, endy)
+        roi["profile"] = profile
+        self.programRoi(roi["xbin"], roi["ybin"], roi["startx"], roi["starty"], roi["nx"],
+                        roi["ny"])
+        return roi
+
+    # estimate how long the camera takes to digitize and transfer a frame of rows x cols binned pixels
+    def readoutTime(self, rows, cols, ybin=1):
+        return BCAM.READ_OVERHEAD + rows*cols/BCAM.PIXEL_RATE + rows*ybin*BCAM.ROW_SHIFT
+
+    # wait for an exposure started at time t0 to finish.  sleeps through the known exposure time,
+    # then polls at an interval scaled to the expected readout time.  the camera's error states and
+    # running past the timeout raise ExposureError.  returns the wall time spent waiting on the
+    # exposure and on the readout.
+    def waitForImage(self, exp, rows, cols, ybin=1, t0=None, timeout=None):
+        cam = self.camera
+        if t0 is None:
+            t0 = time.time()
+
+        readout = self.readoutTime(rows, cols, ybin)
+        poll = min(max(readout/20.0, BCAM.MIN_POLL), BCAM.MAX_POLL)
+        if timeout is None:
+            timeout = exp + 3.0*readout + BCAM.TIMEOUT_PAD
+        deadline = t0 + timeout
+        errors = (apg.Status_ConnectionError, apg.Status_DataError, apg.Status_PatternError)
+        reading = (apg.Status_ImagingActive, apg.Status_ImageReady)
+
+        # nothing to ask the camera until the shutter is about to close
+        remaining = t0 + exp - poll - time.time()
+        if remaining > 0:
+            self.aborting.wait(remaining)
+
+        t_read = None
+        while True:
+            if self.aborting.isSet():
+                cam.StopExposure(False)
+                raise ExposureError("Exposure aborted.", "aborted")
             status = cam.GetImagingStatus()
+            now = time.time()
+            if status in errors:
+                raise ExposureError("Exposure failed with camera status %d." % status, status)
+            if t_read is None and status in reading:
+                t_read = now
+            if status == apg.Status_ImageReady:
+                break
+            if now > deadline:
+                try:
+                    cam.StopExposure(False)
+                except:
+                    pass
+                raise ExposureError("Timed out after %.1f s waiting for image (status %d)." %
+                                    (timeout, status), "timeout")
+            self.aborting.wait(poll)
+
+        return t_read - t0, now - t_read
+
+    # interrupt the exposure in progress, if any.  acquireImage raises ExposureError.
+    def abortExposure(self):
+        self.aborting.set()
+
+    # follow the cancel Event of the job now running on the camera, or None between jobs
+    def watchJob(self, cancelled):
+        self.cancelled = cancelled
+
+    # raise ExposureError if the running job has been cancelled.  acquireImage checks before every
+    # exposure; loops over many frames call it between them too.
+    def checkCancelled(self):
+        cancelled = self.cancelled
+        if cancelled is not None and cancelled.isSet():
+            raise ExposureError("Job cancelled.", "cancelled")
+
+    # acquire image from camera.  if buf is an ImageBuffer the frame is read into it and a view is
+    # returned; otherwise a new array is allocated for it.  with calibrate set, the matching master
+    # from self.calib is subtracted in place.  with stats set (self.frame_stats by default), the
+    # statistics of the frame as returned, calibrated or not, are kept in self.stats and go into its
+    # header.  with a StartBarrier the exposure waits, ROI programmed, until every camera sharing
+    # the barrier is ready and they all start together.  a profile named from PROFILES replaces the
+    # binning and ROI arguments.
+    def acquireImage(self, exp, shutter, xbin=1, ybin=1, startx=0, starty=0, endx=4096, endy=4096,
+                     timeout=None, buf=None, calibrate=False, stats=None, barrier=None,
+                     profile=None):
+        cam = self.camera
+        if stats is None:
+            stats = self.frame_stats
+
+# TODO: set up working check here to see if an exposure is on-going.  i think Flushing is the right
+# one to check for by default.
+#
+#        status = None
+#        while status != apg.Status_Idle:
+#            status = cam.GetImagingStatus()
+
+        with timer("roi_setup") as roi_timer:
+            self.roi = self.prepare(xbin, ybin, startx, starty, endx, endy, profile)
+        xbin, ybin = self.roi["xbin"], self.roi["ybin"]
+        rows, cols = self.roi["ny"], self.roi["nx"]
+
+        # aborting is cleared before the cancel check, so a cancel that comes in between is still
+        # seen by waitForImage
+        self.aborting.clear()
+        self.checkCancelled()
+        self.calibration = None
+        self.stats = None
+        self.synced = None
+        if barrier is not None:
+            barrier.wait()
+            self.synced = barrier.parties
+        t0 = time.time()
+        self.started = t0
+        cam.StartExposure(exp, shutter)
+        try:
+            t_exp, t_read = self.waitForImage(exp, rows, cols, ybin=ybin, t0=t0, timeout=timeout)
+        except ExposureError as e:
+            b_log.error(str(e))
+            bcam_metrics.ERRORS.inc(source="exposure", code=e.code)
+            if e.code == apg.Status_ConnectionError:
+                self.lost(str(e))
+            raise
+        bcam_metrics.STAGE_SECONDS.observe(t_exp, stage="exposure")
+        bcam_metrics.STAGE_SECONDS.observe(t_read, stage="readout_wait")
 
         if shutter:
             imtype = "Light"
@@ -313,30 +1366,114 @@ class BCAM:
             (imtype, exp, xbin, ybin, rows, cols)
         b_log.info(msg)
 
-        data = cam.GetImage()
-
         # default to unsigned 16-bit ints and reshape appropriately
-        return np.array(data, dtype=np.uint16).reshape(rows,cols)
+        with timer("readout") as t:
+            if buf is not None:
+                image = buf.read(cam, rows, cols)
+            else:
+                image = readImage(cam, np.empty(rows*cols, dtype=np.uint16)).reshape(rows, cols)
+        bcam_metrics.FRAMES.inc()
+        bcam_metrics.BYTES_READ.inc(image.nbytes)
+        self.timing = {"roi": roi_timer.elapsed, "exposure": t_exp, "wait": t_read,
+                       "transfer": t.elapsed, "readout": t_read + t.elapsed}
+        t_read += t.elapsed
+        b_log.info("Waited %.3f s for exposure and %.3f s for readout." % (t_exp, t_read))
+
+        if calibrate:
+            if self.calib is not None:
+                with timer("calibrate"):
+                    self.calibration = self.calib.correct(image, exp, self.roi,
+                                                          self.status()["t_ccd"])
+            else:
+                b_log.warn("Calibration requested but no calibration store is set up.")
+
+        if stats:
+            with timer("stats"):
+                self.stats = bcam_stats.frameStats(image)
 
-    # set up FITS header information 
+        return image
+
+    # take n frames with the same exposure and geometry, writing them to prefix-0000.fits,
+    # prefix-0001.fits, ... through a FrameWriter while the next frames are exposed and read out.
+    # the files are added to self.archive's index, if there is one, once they're all written.  a
+    # cancelled job stops before its next frame.  returns per-frame timing (time blocked waiting
+    # for a slot, exposure, readout, write) along with the elapsed time and duty cycle of the
+    # whole sequence.
+    def sequence(self, n, exp, shutter, prefix, ccdtype, xbin=1, ybin=1, startx=0, starty=0,
+                 endx=4096, endy=4096, calibrate=False, nslots=4, nwriters=2, profile=None):
+        if profile is not None:
+            roi = self.profile(profile)
+            npix = roi["nx"]*roi["ny"]
+        else:
+            npix = (abs(endx - startx)//xbin)*(abs(endy - starty)//ybin)
+        writer = FrameWriter(nslots, nwriters, npix)
+        frames = []
+        written = []
+        t0 = time.time()
+        try:
+            for i in range(n):
+                self.checkCancelled()
+                buf, blocked = writer.slot()
+                start = time.time() - t0
+                image = self.acquireImage(exp, shutter, xbin=xbin, ybin=ybin, startx=startx,
+                                          starty=starty, endx=endx, endy=endy, buf=buf,
+                                          calibrate=calibrate, profile=profile)
+                header = self.makeHeader(ccdtype, exp)
+                header.append(pyfits.createCard("SEQNUM", i, "Frame number in sequence"))
+                record = {"frame": i, "start": start, "blocked": blocked,
+                          "exposure": self.timing["exposure"], "readout": self.timing["readout"]}
+                frames.append(record)
+                path = "%s-%04d.fits" % (prefix, i)
+                writer.write(path, image, header, buf, record)
+                written.append((path, header, t0 + start))
+        finally:
+            # let the frames already taken finish writing, and index them even if the sequence
+            # was cancelled or failed part way
+            writer.close()
+            if self.archive is not None:
+                for path, header, t in written:
+                    if os.path.exists(path):
+                        self.archive.register(path, header, t)
+
+        elapsed = time.time() - t0
+        duty = 0.0
+        if elapsed > 0.0:
+            duty = sum([f["exposure"] for f in frames])/elapsed
+        b_log.info("Sequence of %d frames took %.2f s (duty cycle %.1f%%)." %
+                   (len(frames), elapsed, 100.0*duty))
+        return {"prefix": prefix, "frames": frames, "elapsed": elapsed, "duty_cycle": duty,
+                "errors": writer.errors}
+
+    # set up FITS header information.  hardware state comes from the telemetry snapshot and the ROI
+    # from the last acquireImage call, so this needs no camera I/O while the poller is running.
     def makeHeader(self, ccdtype, exptime):
-        cam = BCAM.camera
+        with timer("header"):
+            return self.buildHeader(ccdtype, exptime)
+
+    def buildHeader(self, ccdtype, exptime):
+        t = self.status()
+        roi = self.roi
+        if roi is None:
+            roi = self.readRoi()
 
         cards = []
         cards.append(pyfits.createCard("CCDTYPE", ccdtype, "CCD type"))
         cards.append(pyfits.createCard("EXPTIME", exptime, "Exposure time (s)"))
-        cards.append(pyfits.createCard("PXHEIGHT", cam.GetPixelHeight(), "Pixel height in um"))
-        cards.append(pyfits.createCard("PXWIDTH", cam.GetPixelWidth(), "Pixel width in um"))
-        cards.append(pyfits.createCard("CCDMAX_X", cam.GetMaxImgCols(), "CCD width in pixels"))
-        cards.append(pyfits.createCard("CCDMAX_Y", cam.GetMaxImgRows(), "CCD height in pixels"))
-        binx = cam.GetRoiBinCol()
-        biny = cam.GetRoiBinRow()
+        if self.started is not None:
+            cards.append(pyfits.createCard("DATE-OBS", fitsDate(self.started),
+                                           "Exposure start (UTC)"))
+        cards.append(pyfits.createCard("PXHEIGHT", t["pixel_height"], "Pixel height in um"))
+        cards.append(pyfits.createCard("PXWIDTH", t["pixel_width"], "Pixel width in um"))
+        cards.append(pyfits.createCard("CCDMAX_X", t["max_img_cols"], "CCD width in pixels"))
+        cards.append(pyfits.createCard("CCDMAX_Y", t["max_img_rows"], "CCD height in pixels"))
+        binx = roi["xbin"]
+        biny = roi["ybin"]
         cards.append(pyfits.createCard("ROIBIN_X", binx, "X binning"))
         cards.append(pyfits.createCard("ROIBIN_Y", biny, "Y binning"))
-        startx = cam.GetRoiStartCol()
-        starty = cam.GetRoiStartRow()
-        nx = cam.GetRoiNumCols()
-        ny = cam.GetRoiNumRows()
+        startx = roi["startx"]
+        starty = roi["starty"]
+        nx = roi["nx"]
+        ny = roi["ny"]
         endx = startx + binx*nx
         endy = starty + biny*ny
         cards.append(pyfits.createCard("ROIMIN_X", startx, "ROI start X"))
@@ -345,34 +1482,184 @@ class BCAM:
         cards.append(pyfits.createCard("ROIMAX_Y", endy, "ROI end Y"))
         cards.append(pyfits.createCard("ROI_NX", nx, "ROI width"))
         cards.append(pyfits.createCard("ROI_NY", ny, "ROI height"))
+        if roi.get("profile"):
+            cards.append(pyfits.createCard("PROFILE", roi["profile"], "Acquisition profile"))
         cards.append(pyfits.createCard("SETPOINT", 
-                                       float("%.2f" % cam.GetCoolerSetPoint()), 
+                                       float("%.2f" % t["setpoint"]), 
                                        "Cooler setpoint in C"))
-        cards.append(pyfits.createCard("COOLING", cam.GetCoolerStatus(), "Cooler status"))
+        cards.append(pyfits.createCard("COOLING", t["cooler_status"], "Cooler status"))
         cards.append(pyfits.createCard("COOLDRIV", 
-                                       float("%.2f" % cam.GetCoolerDrive()), 
+                                       float("%.2f" % t["cooler_drive"]), 
                                        "Cooler drive (%)"))
-        cards.append(pyfits.createCard("FANMODE", cam.GetFanMode(), "Cooler fan mode"))
+        cards.append(pyfits.createCard("FANMODE", t["fan_mode"], "Cooler fan mode"))
         cards.append(pyfits.createCard("BACKOFF", 
-                                       float("%.2f" % cam.GetCoolerBackoffPoint()), 
+                                       float("%.2f" % t["backoff"]), 
                                        "Cooler backoff point"))
         cards.append(pyfits.createCard("T_CCD", 
-                                       float("%.2f" % cam.GetTempCcd()), 
+                                       float("%.2f" % t["t_ccd"]), 
                                        "CCD temperature in C"))
         cards.append(pyfits.createCard("T_HSINK", 
-                                       float("%.2f" % cam.GetTempHeatsink()), 
+                                       float("%.2f" % t["t_heatsink"]), 
                                        "Camera heatsink temperature in C"))
-        cards.append(pyfits.createCard("MODEL", cam.GetModel(), "Camera model"))
-        cards.append(pyfits.createCard("SENSOR", cam.GetSensor(), "Camera sensor"))
-        if BCAM.foc.attached:
+        cards.append(pyfits.createCard("MODEL", t["model"], "Camera model"))
+        cards.append(pyfits.createCard("SENSOR", t["sensor"], "Camera sensor"))
+        cards.append(pyfits.createCard("CAMERA", self.id, "BCAM camera id"))
+        if self.synced:
+            cards.append(pyfits.createCard("NSYNC", self.synced, "Cameras started together"))
+        if self.foc.attached:
+            cards.append(pyfits.createCard("FOCUSER", self.foc.id, "BCAM focuser id"))
+            focus = t["focus"]
+            settled = self.foc.settled()
+            if not settled and self.settle_focus:
+                settled = self.foc.waitForMotion(BCAM.SETTLE_TIMEOUT)
+            # the snapshot may be from before the last move ended
+            final = self.foc.final
+            if settled and final is not None and final[0] > t.time and final[1] is not None:
+                focus = final[1]
             cards.append(pyfits.createCard("BCAMFOC", 
-                                           BCAM.foc.position(), 
+                                           focus, 
                                            "BCAM focus position"))
+            cards.append(pyfits.createCard("FOCSETL", settled, "Focuser at rest when recorded"))
             cards.append(pyfits.createCard("FLITEMP", 
-                                           BCAM.foc.temperature(), 
+                                           t["focus_temp"], 
                                            "BCAM focuser temperature (C)"))
+        if self.calibration:
+            cards.append(pyfits.createCard("DARKCOR", self.calibration["master"],
+                                           "Master subtracted"))
+            cards.append(pyfits.createCard("DARKFILE", self.calibration["file"], "Master file"))
+            cards.append(pyfits.createCard("PEDESTAL", self.calibration["pedestal"],
+                                           "Level kept after subtraction (ADU)"))
+            cards.append(pyfits.createCard("DARKCLIP", self.calibration["clipped"],
+                                           "Pixels clipped at PEDESTAL, not restorable"))
+        if self.stats:
+            for name, keyword, comment in bcam_stats.CARDS:
+                value = self.stats[name]
+                if isinstance(value, float):
+                    value = float("%.2f" % value)
+                cards.append(pyfits.createCard(keyword, value, comment))
+        if self.timing_card and self.timing:
+            timing = "roi=%(roi).3f exp=%(exposure).3f wait=%(wait).3f xfer=%(transfer).3f" % \
+                self.timing
+            cards.append(pyfits.createCard("TIMING", timing, "Stage times (s)"))
+        cards.append(pyfits.createCard("TLM_AGE", float("%.2f" % t.age()),
+                                       "Age of telemetry snapshot (s)"))
         return pyfits.Header(cards=cards)
 
+class Registry:
+    """
+    every camera and focuser on the host, by id.  it starts out with just cam0 paired with foc0 on
+    the first FLI device, so there is something to report on before anything has been enumerated.
+    discover() lists the Apogee cameras FindDeviceUsb finds and the FLI focusers FLIList finds and
+    takes in any it hasn't seen: a device at a new address or path goes to the first camera or
+    focuser that isn't connected and whose own address or path is no longer listed (so one that
+    was unplugged and comes back elsewhere keeps its id), and otherwise is added as cam1, cam2, ...
+    or foc1, foc2, ...; camera n is paired with focuser n.  start() runs discover() every
+    'interval' s on a background thread, so USB enumeration never holds up the caller.  nothing
+    is connected here, so each camera can be brought up by its own Connector.
+    """
+    def __init__(self):
+        foc = Focuser("/dev/fliusb0", "foc0")
+        cam = BCAM(connect=False, id="cam0", focuser=foc)
+        self.cameras = OrderedDict([(cam.id, cam)])
+        self.focusers = OrderedDict([(foc.id, foc)])
+        self.lock = threading.Lock()
+        self.added = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    # discover() now and then every 'interval' s.  added(camera) is called, on the discovery
+    # thread, for each camera added after the first.
+    def start(self, interval=30.0, added=None):
+        self.added = added
+        if self.thread is None or not self.thread.isAlive():
+            self._stop.clear()
+            self.thread = threading.Thread(target=self.run, args=(interval,), name="discovery")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, interval):
+        while not self._stop.isSet():
+            try:
+                self.discover()
+            except Exception as e:
+                b_log.warn("Device discovery failed: %s" % e)
+            self._stop.wait(interval)
+
+    # enumerate the cameras and focusers and take in new ones.  the dicts are replaced rather than
+    # changed, so other threads can go through them without locking.  returns self.
+    def discover(self):
+        paths = findFocusers()
+        found = self.cameras["cam0"].parseDeviceStr(apg.FindDeviceUsb().Find())
+        present = set([dev["address"] for dev in found])
+        new = []
+        self.lock.acquire()
+        try:
+            focusers = OrderedDict(self.focusers)
+            for path in paths:
+                if path in [foc.path for foc in focusers.values()]:
+                    continue
+                foc = self.vacant(focusers.values(), lambda f: f.attached or f.path in paths)
+                if foc is not None:
+                    b_log.info("Focuser %s is now at %s." % (foc.id, path))
+                else:
+                    id = "foc%d" % len(focusers)
+                    cam = self.cameras.get("cam%d" % len(focusers))
+                    if cam is not None and cam.foc.path is None:
+                        foc = cam.foc
+                    else:
+                        foc = Focuser(None, id)
+                    b_log.info("Found focuser %s at %s." % (id, path))
+                foc.path = path
+                focusers[foc.id] = foc
+            self.focusers = focusers
+
+            cameras = OrderedDict(self.cameras)
+            for dev in found:
+                address = dev["address"]
+                claimed = [c.address for c in cameras.values()] + \
+                    [c.connected_at for c in cameras.values() if c.state == READY]
+                if address in claimed:
+                    continue
+                cam = self.vacant(cameras.values(),
+                                  lambda c: c.state == READY or c.address in present)
+                if cam is not None:
+                    if cam.address is not None:
+                        b_log.info("Camera %s is now at address %s." % (cam.id, address))
+                    cam.address = address
+                    if cam.connector is not None:
+                        cam.connector.wake.set()
+                else:
+                    i = len(cameras)
+                    foc = focusers.get("foc%d" % i) or Focuser(None, "foc%d" % i)
+                    cam = BCAM(connect=False, id="cam%d" % i, address=address, focuser=foc)
+                    cameras[cam.id] = cam
+                    new.append(cam)
+                    b_log.info("Found camera %s at address %s." % (cam.id, address))
+            self.cameras = cameras
+        finally:
+            self.lock.release()
+
+        if self.added is not None:
+            for cam in new:
+                self.added(cam)
+        return self
+
+    # the first of devices that isn't taken, as 'taken' decides
+    def vacant(self, devices, taken):
+        for dev in devices:
+            if not taken(dev):
+                return dev
+        return None
+
+    def camera(self, id):
+        return self.cameras.get(id)
+
+    def focuser(self, id):
+        return self.focusers.get(id)
+
 #############
 if __name__ == "__main__":
     bcam = BCAM()
@@ -385,11 +1672,13 @@ if __name__ == "__main__":
     exptime = 0.05
 
     blah = bcam.acquireImage(0.0, False, xbin=8, ybin=8)
-    dark = bcam.acquireImage(exptime, False, xbin=8, ybin=8).astype(np.int32)
-    light = bcam.acquireImage(exptime, False, xbin=8, ybin=8).astype(np.int32)
-
-    print dark.mean()
-    print light.mean()
+    dark = bcam.acquireImage(exptime, False, xbin=8, ybin=8, stats=True)
+    print bcam.stats["mean"]
+    light = bcam.acquireImage(exptime, False, xbin=8, ybin=8, stats=True)
+    print bcam.stats["mean"]
 
+    # the file holds light - dark, which the raw frame's statistics don't describe
+    bcam.stats = None
     header = bcam.makeHeader("OBJECT", exptime)
-    pyfits.writeto("test.fits", light-dark, header=header, clobber=True)
+    light = light.astype(np.int32) - dark
+    pyfits.writeto("test.fits", light, header=header, clobber=True)
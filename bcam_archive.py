@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+on-disk archive of BCAM frames.  every frame is written as an uncompressed FITS file under a
+YYYY/MM/DD tree and its key header cards go into a SQLite index, so frames can be found by type,
+exposure, binning, ROI, temperature, focus and time without opening any files.  pixels are read
+back through a memory map, so a cutout or a range of rows only touches the part of the file it
+needs.
+"""
+
+import os
+import time
+import Queue
+import sqlite3
+import threading
+
+from astropy.io import fits as pyfits
+import numpy as np
+
+import bcam_fits
+import bcam_metrics
+from bcam import b_log
+
+SCHEMA = """
+create table if not exists frames (
+    id integer primary key,
+    path text not null unique,
+    time real not null,
+    date_obs text,
+    ccdtype text,
+    exptime real,
+    xbin integer,
+    ybin integer,
+    startx integer,
+    starty integer,
+    nx integer,
+    ny integer,
+    t_ccd real,
+    focus integer,
+    data_offset integer not null
+);
+create index if not exists frames_match on frames (ccdtype, xbin, ybin, t_ccd);
+create index if not exists frames_exptime on frames (exptime);
+create index if not exists frames_time on frames (time);
+"""
+
+# index columns filled from header cards
+CARDS = (
+    ("date_obs", "DATE-OBS"),
+    ("ccdtype", "CCDTYPE"),
+    ("exptime", "EXPTIME"),
+    ("xbin", "ROIBIN_X"),
+    ("ybin", "ROIBIN_Y"),
+    ("startx", "ROIMIN_X"),
+    ("starty", "ROIMIN_Y"),
+    ("nx", "ROI_NX"),
+    ("ny", "ROI_NY"),
+    ("t_ccd", "T_CCD"),
+    ("focus", "BCAMFOC"),
+)
+
+COLUMNS = ("id", "path", "time") + tuple([c for c, k in CARDS])
+
+# the most rows a query returns
+MAX_ROWS = 10000
+
+# frames waiting to be written, each with its pixels, before new ones are dropped
+MAX_PENDING = 4
+
+class Archive:
+    """
+    frames filed under 'directory' with an index in directory/index.sqlite.  add() hands frames to
+    a writer thread so the caller never waits on the disk, dropping them if 'maxpending' are
+    already waiting; register() indexes a file that's already been written elsewhere.  only uint16
+    frames are archived.
+    """
+    def __init__(self, directory, maxpending=MAX_PENDING):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"),
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue(maxpending)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.isAlive():
+            self.thread = threading.Thread(target=self.run, name="archive")
+            self.thread.daemon = True
+            self.thread.start()
+
+    # queue a frame for writing.  image must not be modified afterwards.  returns False, with a
+    # warning, if the frame is dropped because it isn't uint16 or the writer is too far behind.
+    def add(self, image, header, t=None):
+        if t is None:
+            t = time.time()
+        if image.dtype != np.uint16:
+            b_log.warn("Not archiving %s frame; only uint16 frames are archived." % image.dtype)
+            bcam_metrics.ARCHIVE_DROPPED.inc(reason="dtype")
+            return False
+        try:
+            self.pending.put_nowait((image, header, t))
+        except Queue.Full:
+            b_log.warn("Archive is %d frames behind; dropping frame." % self.pending.maxsize)
+            bcam_metrics.ARCHIVE_DROPPED.inc(reason="backlog")
+            return False
+        return True
+
+    def run(self):
+        while True:
+            image, header, t = self.pending.get()
+            try:
+                self.write(image, header, t)
+            except Exception as e:
+                b_log.error("Can't archive frame: %s" % e)
+
+    # dated path for a frame taken at time t, by the given camera if there's more than one
+    def path(self, t, camera=None):
+        day = time.strftime("%Y/%m/%d", time.gmtime(t))
+        name = "bcam-%s-%03d.fits" % (time.strftime("%Y%m%d-%H%M%S", time.gmtime(t)),
+                                      int(1000*(t % 1.0)))
+        if camera:
+            name = name.replace("bcam-", "bcam-%s-" % camera, 1)
+        return os.path.join(self.directory, day, name)
+
+    # write image to the archive now and index it.  returns the frame id.
+    def write(self, image, header, t):
+        path = self.path(t, header.get("CAMERA"))
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + ".part"
+        f = open(tmp, "wb")
+        try:
+            for chunk in bcam_fits.stream(image, header):
+                f.write(chunk)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        return self.register(path, header, t)
+
+    # index a FITS file written by bcam_fits.stream().  pixels() and cutout() read the data as
+    # stored for a uint16 frame, so anything else is refused with ValueError.
+    def register(self, path, header, t=None):
+        if t is None:
+            t = os.path.getmtime(path)
+        stored = pyfits.getheader(path)
+        if stored.get("NAXIS") != 2 or stored.get("BITPIX") != 16 or \
+                stored.get("BZERO") != 32768 or stored.get("BSCALE", 1) != 1:
+            raise ValueError("%s isn't a 2-D uint16 frame (BITPIX %s, BZERO %s)." %
+                             (path, stored.get("BITPIX"), stored.get("BZERO")))
+        offset = len(stored.tostring())
+        values = [path, t] + [header.get(k) for c, k in CARDS] + [offset]
+        sql = "insert or replace into frames (path, time, %s, data_offset) values (%s)" % \
+            (", ".join([c for c, k in CARDS]), ", ".join(["?"]*len(values)))
+        self.lock.acquire()
+        try:
+            cur = self.db.execute(sql, values)
+            self.db.commit()
+            return cur.lastrowid
+        finally:
+            self.lock.release()
+
+    # frames matching all the given criteria, newest first.  t_ccd matches within t_tol degrees,
+    # exptime to the ms, and since/until bound the time taken (unix seconds).
+    def query(self, ccdtype=None, exptime=None, xbin=None, ybin=None, t_ccd=None, t_tol=1.0,
+              focus=None, since=None, until=None, limit=100):
+        where = []
+        args = []
+        for column, value in (("ccdtype", ccdtype), ("xbin", xbin), ("ybin", ybin),
+                              ("focus", focus)):
+            if value is not None:
+                where.append("%s = ?" % column)
+                args.append(value)
+        if exptime is not None:
+            where.append("exptime between ? and ?")
+            args.extend([exptime - 0.0005, exptime + 0.0005])
+        if t_ccd is not None:
+            where.append("t_ccd between ? and ?")
+            args.extend([t_ccd - t_tol, t_ccd + t_tol])
+        if since is not None:
+            where.append("time >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("time < ?")
+            args.append(until)
+        sql = "select %s from frames" % ", ".join(COLUMNS)
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by time desc limit ?"
+        args.append(min(limit, MAX_ROWS))
+        self.lock.acquire()
+        try:
+            return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql, args)]
+        finally:
+            self.lock.release()
+
+    # index row for frame id, or None
+    def get(self, id):
+        self.lock.acquire()
+        try:
+            row = self.db.execute("select * from frames where id = ?", (id,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    # read-only memory map of a frame's pixels as stored: big-endian int16 offset by 32768
+    def pixels(self, frame):
+        return np.memmap(frame["path"], dtype=">i2", mode="r", offset=frame["data_offset"],
+                         shape=(frame["ny"], frame["nx"]))
+
+    # rows y0:y1 and columns x0:x1 of a frame as uint16.  only that part of the file is read.
+    def cutout(self, frame, x0=0, y0=0, x1=None, y1=None):
+        data = self.pixels(frame)
+        try:
+            block = np.array(data[y0:y1, x0:x1], dtype=np.int16)
+        finally:
+            del data
+        return block.view(np.uint16) ^ np.uint16(0x8000)
+
+    # the frame's stored header, with the cutout's offset recorded as IRAF-style LTV cards
+    def header(self, frame, x0=0, y0=0):
+        header = pyfits.getheader(frame["path"])
+        if x0 or y0:
+            header.append(pyfits.createCard("LTV1", -x0, "Cutout offset in X"))
+            header.append(pyfits.createCard("LTV2", -y0, "Cutout offset in Y"))
+        return header
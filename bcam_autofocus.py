@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+autofocus for BCAM.  steps the FLI focuser through a range of positions, measures the half-flux
+diameter of a star in a small window at each one and fits for the best focus.  the move to the next
+position is started as soon as a frame is read out, so the focuser travels while that frame is
+being measured.
+"""
+
+import time
+import numpy as np
+
+import bcam_star
+from bcam import b_log, ExposureError
+
+class AutoFocusError(Exception):
+    """
+    raised when an autofocus run can't find or fit a best focus.
+    """
+    pass
+
+# fit HFD(x) = a*sqrt(1 + ((x - c)/b)**2), the shape of a defocused star.  HFD**2 is then a
+# parabola in x, so a linear least-squares fit does it.  returns (best position, HFD there) or
+# None if the points don't bracket a minimum.
+def fitFocus(positions, hfds):
+    x = np.asarray(positions, dtype=np.float64)
+    y = np.asarray(hfds, dtype=np.float64)**2
+    if len(x) < 3:
+        return None
+    a, b, c = np.polyfit(x, y, 2)
+    if a <= 0.0:
+        return None
+    best = -b/(2.0*a)
+    if best < x.min() or best > x.max():
+        return None
+    return best, np.sqrt(max(c - b*b/(4.0*a), 0.0))
+
+# focuser positions a sweep from start to stop in steps of 'step' visits.  raises AutoFocusError
+# unless they run upward through at least the three points a fit needs.
+def sweepPositions(start, stop, step):
+    if step <= 0:
+        raise AutoFocusError("Autofocus step must be > 0, not %d." % step)
+    if start >= stop:
+        raise AutoFocusError("Autofocus start (%d) must be below stop (%d)." % (start, stop))
+    positions = range(start, stop + 1, step)
+    if len(positions) < 3:
+        raise AutoFocusError("Autofocus sweep %d-%d in steps of %d has fewer than 3 points." %
+                             (start, stop, step))
+    return positions
+
+class AutoFocus:
+    """
+    one autofocus run.  'progress' is updated as the run goes and is safe to read from other
+    threads.
+    """
+    def __init__(self, bcam, focuser):
+        self.bcam = bcam
+        self.focuser = focuser
+        self.progress = {"state": "idle", "points": []}
+
+    def update(self, **kw):
+        p = dict(self.progress)
+        p.update(kw)
+        self.progress = p
+
+    # exposure on a box x box window (unbinned pixels) centred on (x, y)
+    def window(self, exptime, x, y, box):
+        sensor = self.bcam.sensorInfo()
+        startx = int(min(max(x - box//2, 0), sensor["max_img_cols"] - box))
+        starty = int(min(max(y - box//2, 0), sensor["max_img_rows"] - box))
+        return self.bcam.acquireImage(exptime, True, startx=startx, starty=starty,
+                                      endx=startx+box, endy=starty+box)
+
+    # locate the brightest star on an 8x8 binned full frame and return its unbinned position
+    def locate(self, exptime):
+        image = self.bcam.acquireImage(exptime, True, xbin=8, ybin=8)
+        x, y = bcam_star.findStar(image)
+        return 8*x + 4, 8*y + 4
+
+    def aborted(self):
+        return self.bcam.aborting.isSet()
+
+    # sweep the focuser from start to stop in steps of 'step', exposing 'exptime' s on a window of
+    # 'box' pixels around (x, y), or around the brightest star if no position is given.  moves to
+    # the fitted best focus and returns the run's summary.
+    def run(self, start, stop, step, exptime, box=128, x=None, y=None):
+        try:
+            return self.sweep(start, stop, step, exptime, box, x, y)
+        except Exception as e:
+            self.update(state="failed", error=str(e))
+            raise
+
+    def sweep(self, start, stop, step, exptime, box, x, y):
+        if not self.focuser.attached:
+            raise AutoFocusError("Can't autofocus: no focuser attached.")
+        positions = sweepPositions(start, stop, step)
+        t0 = time.time()
+        self.update(state="locating", points=[], total=len(positions), best=None, error=None)
+        if x is None or y is None:
+            x, y = self.locate(exptime)
+        self.update(state="sweeping", x=x, y=y)
+        if not self.focuser.goto(positions[0]):
+            raise AutoFocusError("Focuser didn't reach %d." % positions[0])
+
+        points = []
+        for i, pos in enumerate(positions):
+            image = self.window(exptime, x, y, box)
+
+            # start the next move right away and measure while the focuser travels
+            last = i + 1 == len(positions)
+            if not last:
+                move = self.focuser.moveTo(positions[i+1])
+            m = bcam_star.measure(image)
+            if m is not None:
+                m["position"] = pos
+                points.append(m)
+                b_log.info("Autofocus %d/%d: focus=%d HFD=%.2f FWHM=%.2f" %
+                           (i + 1, len(positions), pos, m["hfd"], m["fwhm"]))
+            else:
+                b_log.warn("Autofocus %d/%d: no star found at focus=%d." %
+                           (i + 1, len(positions), pos))
+            self.update(points=list(points), done=i + 1)
+
+            if not last:
+                if move is None or not move.wait(self.focuser.MOVE_TIMEOUT):
+                    raise AutoFocusError("Focuser didn't reach %d." % positions[i+1])
+            if self.aborted():
+                raise ExposureError("Autofocus aborted.")
+
+        fit = fitFocus([p["position"] for p in points], [p["hfd"] for p in points])
+        if fit is None:
+            raise AutoFocusError("Autofocus sweep %d-%d didn't bracket best focus." % (start, stop))
+        best, hfd = int(round(fit[0])), fit[1]
+        if not self.focuser.goto(best):
+            raise AutoFocusError("Focuser didn't reach best focus %d." % best)
+        result = {"best": best, "hfd": hfd, "points": points, "elapsed": time.time() - t0}
+        self.update(state="done", best=best, hfd=hfd, elapsed=result["elapsed"])
+        b_log.info("Autofocus: best focus %d with HFD %.2f in %.1f s." %
+                   (best, hfd, result["elapsed"]))
+        return result
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""
+benchmarks for the BCAM acquisition and delivery paths, run against the simulated hardware in
+bcam_sim.  each case runs in its own process and reports throughput, latency percentiles and how far
+the peak resident memory rose above where it stood after setup, so the temporaries a step frees
+again are counted but what the setup built is not.  bench-baseline.json is a full run at the
+default scale, kept with the code to compare changes against.
+
+    python bcam_bench.py                                # every suite
+    python bcam_bench.py acquire header                 # selected suites
+    python bcam_bench.py --save report.json             # keep the results as a baseline
+    python bcam_bench.py --compare bench-baseline.json  # show the change against a baseline
+    python bcam_bench.py --scale 0.1                    # run the simulated hardware 10x faster
+
+suites: readout, fits, acquire, header, expose, track, sync, setup
+"""
+
+import os
+import sys
+import json
+import time
+import ctypes
+import tempfile
+import threading
+import resource
+import platform
+import cStringIO
+import multiprocessing
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+BINNINGS = (1, 2, 4, 8)
+
+# window sizes (unbinned pixels, centred on the chip) used for ROI cases
+WINDOWS = (1024, 128)
+
+# resident set size of this process in MB, now and at its peak, from /proc/self/status.  elsewhere
+# both are the lifetime peak, which is all getrusage gives.
+def rss():
+    sizes = {}
+    try:
+        f = open("/proc/self/status")
+        try:
+            for line in f:
+                if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+                    sizes[line[:5]] = int(line.split()[1])/1024.0
+        finally:
+            f.close()
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    return sizes.get("VmRSS", peak), sizes.get("VmHWM", peak)
+
+# start the peak over from the current size (Linux 4.0 and later)
+def reset_peak_rss():
+    try:
+        f = open("/proc/self/clear_refs", "w")
+        try:
+            f.write("5")
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+# give memory freed during setup back to the OS (glibc only), so that a step reusing it still
+# shows up as growth
+def release_free():
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def summarize(times, drss, extra=None):
+    times = np.asarray(times)
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    r = {"n": len(times), "fps": len(times)/times.sum(), "p50": p50, "p90": p90, "p99": p99,
+         "drss_mb": drss}
+    if extra:
+        r.update(extra)
+    return r
+
+# run one case in a child process.  setup(**kw) is called there and returns (step, extra): step()
+# is timed 'repeat' times and may return a dict of values to report, which replaces 'extra'.
+# memory held by the setup is part of the baseline, so only what the steps add is reported.
+def _child(setup, kw, repeat, results):
+    try:
+        step, extra = setup(**kw)
+        release_free()
+        reset_peak_rss()
+        base = rss()[0]
+        times = []
+        for i in range(repeat):
+            t0 = time.time()
+            out = step()
+            times.append(time.time() - t0)
+            if out:
+                extra = out
+        results.put(summarize(times, rss()[1] - base, extra))
+    except Exception as e:
+        results.put({"error": "%s: %s" % (type(e).__name__, e)})
+
+def run(setup, repeat, **kw):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_child, args=(setup, kw, repeat, results))
+    p.start()
+    r = results.get()
+    p.join()
+    return r
+
+def simBcam(telemetry=False):
+    import bcam
+    b = bcam.BCAM()
+    if telemetry:
+        b.telemetry = bcam.Telemetry(b, interval=1.0)
+        b.telemetry.start()
+        b.telemetry.poll()
+    return b
+
+def window(size):
+    lo = (4096 - size)//2
+    return {"startx": lo, "starty": lo, "endx": lo + size, "endy": lo + size}
+
+# readout: the old np.array(GetImage()) conversion against ImageBuffer, for a camera that only
+# hands back a tuple (as the SWIG binding does) and for one with a bulk path.  the tuple is built
+# up front so only the conversion is measured.
+class TupleCamera:
+    def __init__(self, rows, cols):
+        frame = np.random.randint(0, 65536, rows*cols).astype(np.uint16)
+        self.data = tuple(frame.tolist())
+
+    def GetImage(self):
+        return self.data
+
+class BulkCamera:
+    def __init__(self, rows, cols):
+        self.frame = np.random.randint(0, 65536, rows*cols).astype(np.uint16)
+
+    def GetImageInto(self, address, npix):
+        ctypes.memmove(address, self.frame.ctypes.data, 2*npix)
+
+def setup_readout(path, rows, cols):
+    import bcam
+    if path == "bulk":
+        cam = BulkCamera(rows, cols)
+    else:
+        cam = TupleCamera(rows, cols)
+    # a server's buffer is long-lived, so it's read into once here to have it resident before the
+    # steps are measured
+    buf = bcam.ImageBuffer(rows*cols)
+    buf.data.fill(0)
+
+    def step():
+        if path == "legacy":
+            np.array(cam.GetImage(), dtype=np.uint16).reshape(rows, cols)
+        else:
+            buf.read(cam, rows, cols)
+    return step, None
+
+def bench_readout(repeat):
+    for b in BINNINGS:
+        n = 4096//b
+        for path in ("legacy", "chunked", "bulk"):
+            yield "readout/%s/bin%d" % (path, b), run(setup_readout, repeat, path=path, rows=n,
+                                                       cols=n)
+
+# fits: bytes on the wire and encode time for each way of delivering a frame.  the frame is a
+# flat sky with read noise, which is what tile compression sees in practice.
+def setup_fits(path, rows, cols):
+    import bcam_fits
+    frame = np.clip(np.random.normal(1000.0, 10.0, (rows, cols)), 0, 65535).astype(np.uint16)
+    header = pyfits.Header([pyfits.createCard("EXPTIME", 1.0, "Exposure time (s)")])
+
+    def step():
+        if path == "legacy":
+            fitsData = cStringIO.StringIO()
+            pyfits.writeto(fitsData, frame, header=header, clobber=True)
+            fitsData.seek(0)
+            nbytes = len(fitsData.read())
+        elif path == "stream":
+            nbytes = sum([len(c) for c in bcam_fits.stream(frame, header)])
+        else:
+            nbytes = len(bcam_fits.compressed(frame, header, path))
+        return {"bytes": nbytes, "ratio": 2.0*frame.size/nbytes}
+    return step, None
+
+def bench_fits(repeat):
+    import bcam_fits
+    for b in BINNINGS:
+        n = 4096//b
+        for path in ["legacy", "stream"] + sorted(bcam_fits.COMPRESSION.keys()):
+            yield "fits/%s/bin%d" % (path, b), run(setup_fits, repeat, path=path, rows=n, cols=n)
+
+# acquire: bias frames through BCAM.acquireImage on the simulated Alta
+def setup_acquire(xbin, roi):
+    b = simBcam()
+
+    def step():
+        b.acquireImage(0.0, False, xbin=xbin, ybin=xbin, **roi)
+        return b.timing
+    return step, None
+
+def bench_acquire(repeat):
+    for xbin in BINNINGS:
+        yield "acquire/full/bin%d" % xbin, run(setup_acquire, repeat, xbin=xbin, roi={})
+    for size in WINDOWS:
+        yield "acquire/win%d/bin1" % size, run(setup_acquire, repeat, xbin=1, roi=window(size))
+
+# header: makeHeader from the telemetry snapshot and straight from the hardware
+def setup_header(telemetry):
+    b = simBcam(telemetry)
+    b.acquireImage(0.0, False, xbin=8, ybin=8)
+
+    def step():
+        b.makeHeader("BIAS", 0.0)
+    return step, None
+
+def bench_header(repeat):
+    yield "header/snapshot", run(setup_header, 50*repeat, telemetry=True)
+    yield "header/live", run(setup_header, 50*repeat, telemetry=False)
+
+# expose: the full HTTP path, POST /expose through web.py's test client
+def setup_expose(xbin, compress):
+    import web
+    import bcam_srv
+    app = web.application(bcam_srv.urls, vars(bcam_srv))
+    app.add_processor(bcam_srv.metricsProcessor)
+    app.add_processor(bcam_srv.cameraProcessor)
+    while bcam_srv.units[bcam_srv.DEFAULT_CAMERA].b.state != bcam_srv.bcam.READY:
+        time.sleep(0.05)
+    data = {"exptime": "0", "xbin": str(xbin), "ybin": str(xbin), "compress": compress}
+
+    def step():
+        r = app.request("/expose", method="POST", data=data)
+        if not r.status.startswith("200"):
+            raise RuntimeError("POST /expose returned %s" % r.status)
+        return {"bytes": len(r.data)}
+    return step, None
+
+def bench_expose(repeat):
+    for xbin in BINNINGS:
+        yield "expose/none/bin%d" % xbin, run(setup_expose, repeat, xbin=xbin, compress="none")
+    yield "expose/rice/bin1", run(setup_expose, repeat, xbin=1, compress="rice")
+
+# track: sustained tracking rate on small windows, 20 frames per step
+def setup_track(box, exptime):
+    import bcam_track
+    b = simBcam()
+    tracker = bcam_track.Tracker(b)
+
+    def step():
+        r = tracker.run(exptime, box=box, x=2048, y=2048, frames=20)
+        return {"rate_hz": r["rate"], "lost": r["lost"]}
+    return step, None
+
+def bench_track(repeat):
+    for box in (32, 64, 128):
+        yield "track/box%d" % box, run(setup_track, repeat, box=box, exptime=0.01)
+
+# sync: bias frames started together on 1, 2 and 4 simulated cameras, each read out on its own
+# thread as the server's per-camera workers do.  a step takes as long as one camera's frame if the
+# readouts really overlap.  the tuple a SWIG GetImage hands back is built holding the GIL, so those
+# readouts take turns; the 'bulk' cases read through GetImageInto, which doesn't hold it.
+def setup_sync(ncams, xbin, bulk=False):
+    os.environ["BCAM_SIM_CAMERAS"] = str(ncams)
+    os.environ["BCAM_SIM_BULK"] = str(int(bulk))
+    import bcam
+    cams = bcam.Registry().discover().cameras.values()
+    for b in cams:
+        b.connect()
+
+    def step():
+        barrier = bcam.StartBarrier(len(cams))
+        threads = [threading.Thread(target=b.acquireImage, args=(0.0, False),
+                                    kwargs={"xbin": xbin, "ybin": xbin, "barrier": barrier})
+                   for b in cams]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        started = [b.started for b in cams]
+        return {"skew_ms": 1000.0*(max(started) - min(started))}
+    return step, None
+
+def bench_sync(repeat):
+    for bulk in (False, True):
+        for ncams in (1, 2, 4):
+            name = "sync/cams%d/bin2" % ncams + "/bulk"*bulk
+            yield name, run(setup_sync, repeat, ncams=ncams, xbin=2, bulk=bulk)
+
+# setup: per-frame geometry setup (BCAM.prepare, what acquireImage times as roi_setup) on its own.
+# 'legacy' is the original acquireImage setup, which asked the camera for its sensor limits and
+# wrote every ROI register on every frame; 'args' repeats the same explicit geometry, which is
+# clamped against the cached limits but writes nothing; 'profile' repeats a named profile, resolved
+# once; 'switch' alternates between two profiles, so every frame pays for the registers that
+# differ.
+def legacySetup(cam, xbin, ybin, startx, starty, endx, endy):
+    if startx > endx:
+        startx, endx = endx, startx
+    if starty > endy:
+        starty, endy = endy, starty
+
+    if ybin > cam.GetMaxBinRows():
+        ybin = cam.GetMaxBinRows()
+    if endy > cam.GetMaxImgRows():
+        endy = cam.GetMaxImgRows()
+    if xbin > cam.GetMaxBinCols():
+        xbin = cam.GetMaxBinCols()
+    if endx > cam.GetMaxImgCols():
+        endx = cam.GetMaxImgCols()
+
+    cam.SetRoiStartRow(starty)
+    cam.SetRoiNumRows(int( (endy-starty)/ybin ))
+    cam.SetRoiBinRow(ybin)
+    cam.SetRoiStartCol(startx)
+    cam.SetRoiNumCols(int( (endx-startx)/xbin ))
+    cam.SetRoiBinCol(xbin)
+
+def setup_setup(path, profile):
+    import bcam
+    b = simBcam()
+    other = [p for p in bcam.PROFILES if p != profile][0]
+    roi = b.profile(profile)
+    args = {"xbin": roi["xbin"], "ybin": roi["ybin"], "startx": roi["startx"],
+            "starty": roi["starty"], "endx": roi["startx"] + roi["xbin"]*roi["nx"],
+            "endy": roi["starty"] + roi["ybin"]*roi["ny"]}
+    frames = [0]
+
+    def step():
+        frames[0] += 1
+        if path == "legacy":
+            legacySetup(b.camera, **args)
+        elif path == "args":
+            b.prepare(**args)
+        elif path == "profile":
+            b.prepare(profile=profile)
+        else:
+            b.prepare(profile=(profile, other)[frames[0] % 2])
+    return step, None
+
+def bench_setup(repeat):
+    for profile in ("full", "star"):
+        for path in ("legacy", "args", "profile", "switch"):
+            yield "setup/%s/%s" % (path, profile), run(setup_setup, 20*repeat, path=path,
+                                                        profile=profile)
+
+BENCHMARKS = {
+    "readout": bench_readout,
+    "fits": bench_fits,
+    "acquire": bench_acquire,
+    "header": bench_header,
+    "expose": bench_expose,
+    "track": bench_track,
+    "sync": bench_sync,
+    "setup": bench_setup,
+}
+ORDER = ("readout", "fits", "acquire", "header", "expose", "track", "sync", "setup")
+
+def show(name, r, base=None):
+    if "error" in r:
+        print "%-28s ERROR %s" % (name, r["error"])
+        return
+    line = "%-28s %9.2f %10.4f %10.4f %10.4f %9.1f" % (name, r["fps"], r["p50"], r["p90"],
+                                                       r["p99"], r["drss_mb"])
+    if "bytes" in r:
+        line += " %11d" % r["bytes"]
+    if "rate_hz" in r:
+        line += " %8.1f Hz" % r["rate_hz"]
+    if "skew_ms" in r:
+        line += " skew %.2f ms" % r["skew_ms"]
+    if base is not None and "p50" in base and base["p50"] > 0:
+        line += "   p50 %+6.1f%%" % (100.0*(r["p50"]/base["p50"] - 1.0))
+    print line
+
+def main(argv):
+    save = compare = None
+    scale = None
+    repeat = 5
+    names = []
+    args = list(argv)
+    while args:
+        a = args.pop(0)
+        if a == "--save":
+            save = args.pop(0)
+        elif a == "--compare":
+            compare = args.pop(0)
+        elif a == "--scale":
+            scale = args.pop(0)
+        elif a == "--repeat":
+            repeat = int(args.pop(0))
+        elif a in BENCHMARKS:
+            names.append(a)
+        else:
+            print __doc__
+            return 1
+    names = names or list(ORDER)
+
+    # everything runs against the simulator, with its logs and data kept out of the way
+    os.environ["BCAM_BACKEND"] = "sim"
+    if scale is not None:
+        os.environ["BCAM_SIM_SCALE"] = scale
+    if "BCAM_HOME" not in os.environ:
+        os.environ["BCAM_HOME"] = tempfile.mkdtemp(prefix="bcam-bench-")
+
+    baseline = {}
+    if compare:
+        saved = json.load(open(compare))
+        baseline = saved["results"]
+        sim_scale = float(os.environ.get("BCAM_SIM_SCALE", "1.0"))
+        if saved["meta"]["sim_scale"] != sim_scale:
+            print "Warning: %s was run at --scale %g, not %g." % (compare,
+                                                                  saved["meta"]["sim_scale"],
+                                                                  sim_scale)
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "host": platform.node(),
+                 "python": platform.python_version(), "numpy": np.__version__,
+                 "sim_scale": float(os.environ.get("BCAM_SIM_SCALE", "1.0")), "repeat": repeat},
+        "results": {},
+    }
+    print "%-28s %9s %10s %10s %10s %9s %11s" % ("case", "fps", "p50 (s)", "p90 (s)", "p99 (s)",
+                                                 "dRSS (MB)", "bytes")
+    for name in names:
+        for case, r in BENCHMARKS[name](repeat):
+            report["results"][case] = r
+            show(case, r, baseline.get(case))
+
+    if save:
+        json.dump(report, open(save, "w"), indent=1, sort_keys=True)
+        print "Saved %s." % save
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+master bias and dark frames for BCAM.  masters are combined from a series of closed-shutter
+exposures, keyed by exposure time, binning, ROI and CCD temperature band, kept in a small in-memory
+LRU and saved as FITS files so they survive restarts.  a bias is just a dark with zero exposure.
+"""
+
+import os
+import glob
+import tempfile
+import threading
+from collections import OrderedDict
+
+from astropy.io import fits as pyfits
+import numpy as np
+
+from bcam import b_log
+
+# width of the CCD temperature bands masters are filed under (C)
+TEMP_BAND = 2.0
+
+# working memory allowed per block of rows while combining a stack
+CHUNK_BYTES = 64*1024*1024
+
+METHODS = ("median", "sigclip")
+
+# calibration key: exposure time to the ms, binning, ROI and temperature band
+def calibKey(exptime, roi, t_ccd):
+    return (round(exptime, 3), roi["xbin"], roi["ybin"], roi["startx"], roi["starty"],
+            roi["nx"], roi["ny"], int(round(t_ccd/TEMP_BAND)))
+
+def keyName(key):
+    exptime, xbin, ybin, startx, starty, nx, ny, band = key
+    if exptime > 0.0:
+        kind = "dark"
+    else:
+        kind = "bias"
+    return "%s-%.3fs-%dx%d-%d_%d_%dx%d-T%+d" % (kind, exptime, xbin, ybin, startx, starty,
+                                                nx, ny, band*TEMP_BAND)
+
+# mean of each pixel's stack after rejecting values more than nsigma robust sigmas (from the MAD)
+# from the running centre, which starts at the median
+def clippedMean(block, nsigma=3.0, iters=2):
+    centre = np.median(block, axis=0)
+    for i in range(iters):
+        dev = np.abs(block - centre)
+        sigma = np.maximum(1.4826*np.median(dev, axis=0), 1.0)
+        keep = dev <= nsigma*sigma
+        n = keep.sum(axis=0)
+        total = np.where(keep, block, 0.0).sum(axis=0)
+        centre = np.where(n > 0, total/np.maximum(n, 1), centre)
+    return centre
+
+# combine an (n, rows, cols) stack into one uint16 frame, a block of rows at a time so working
+# memory stays under 'chunk' bytes however large the stack is
+def combine(stack, method="median", nsigma=3.0, chunk=CHUNK_BYTES):
+    n, rows, cols = stack.shape
+    out = np.empty((rows, cols), dtype=np.uint16)
+    # float32 block plus about three block-sized temporaries in clippedMean
+    step = max(1, chunk // (4*n*cols*4))
+    for r in xrange(0, rows, step):
+        block = np.asarray(stack[:, r:r+step], dtype=np.float32)
+        if method == "median":
+            m = np.median(block, axis=0)
+        else:
+            m = clippedMean(block, nsigma=nsigma)
+        out[r:r+step] = np.clip(np.round(m), 0, 65535)
+    return out
+
+class FrameStack:
+    """
+    n frames of the same shape spooled to a memory-mapped temporary file, so building a master from
+    many full frames doesn't need them all in memory.
+    """
+    def __init__(self, n, rows, cols, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.data = np.memmap(self.file, dtype=np.uint16, mode="w+", shape=(n, rows, cols))
+
+    def close(self):
+        del self.data
+        self.file.close()
+
+class CalibStore:
+    """
+    master calibration frames saved under 'directory', with the 'capacity' most recently used held
+    in memory.  frames are corrected by clipped subtraction of (master - pedestal), so pixels below
+    the master keep some of their noise instead of all landing on zero.
+    """
+    def __init__(self, directory, capacity=4, pedestal=100):
+        self.directory = directory
+        self.capacity = capacity
+        self.pedestal = pedestal
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, "master-%s.fits" % keyName(key))
+
+    # master for key with the pedestal taken off, from memory or disk.  None if there isn't one.
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.cache:
+                offset = self.cache.pop(key)
+                self.cache[key] = offset
+                return offset
+        finally:
+            self.lock.release()
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        master = pyfits.getdata(path, uint=True)
+        return self.remember(key, master)
+
+    def remember(self, key, master):
+        offset = master - np.minimum(master, np.uint16(self.pedestal))
+        self.lock.acquire()
+        try:
+            self.cache.pop(key, None)
+            self.cache[key] = offset
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+        return offset
+
+    def put(self, key, master, header):
+        pyfits.writeto(self.path(key), master, header=header, clobber=True)
+        self.remember(key, master)
+        b_log.info("Saved master %s." % keyName(key))
+
+    # subtract the matching dark from image in place, falling back to the bias for the same
+    # geometry and temperature.  returns the name and file of the master used, the pedestal left
+    # in and how many pixels were clipped, or None if there was no master.  adding back the
+    # master less the pedestal restores every pixel but the clipped ones, which were below it and
+    # can't be recovered.
+    def correct(self, image, exptime, roi, t_ccd):
+        key = calibKey(exptime, roi, t_ccd)
+        offset = self.get(key)
+        if offset is None and key[0] > 0.0:
+            key = (0.0,) + key[1:]
+            offset = self.get(key)
+        if offset is None:
+            b_log.warn("No master dark or bias for exp=%.3f, T(CCD)=%.1f." % (exptime, t_ccd))
+            return None
+        clipped = np.count_nonzero(image < offset)
+        np.maximum(image, offset, out=image)
+        image -= offset
+        return {"master": keyName(key), "file": os.path.basename(self.path(key)),
+                "pedestal": self.pedestal, "clipped": clipped}
+
+    # take n closed-shutter exposures with the given geometry and combine them into a master,
+    # which is saved and returned along with its header
+    def build(self, bcam, exptime, n, xbin=1, ybin=1, startx=0, starty=0, endx=4096, endy=4096,
+              method="median"):
+        stack = None
+        temps = []
+        try:
+            for i in range(n):
+                bcam.checkCancelled()
+                image = bcam.acquireImage(exptime, False, xbin=xbin, ybin=ybin, startx=startx,
+                                          starty=starty, endx=endx, endy=endy)
+                if stack is None:
+                    stack = FrameStack(n, image.shape[0], image.shape[1], self.directory)
+                stack.data[i] = image
+                temps.append(bcam.status()["t_ccd"])
+            b_log.info("Combining %d frames (%s)...." % (n, method))
+            master = combine(stack.data, method=method)
+        finally:
+            if stack is not None:
+                stack.close()
+
+        t_ccd = float(np.mean(temps))
+        key = calibKey(exptime, bcam.roi, t_ccd)
+        if exptime > 0.0:
+            ccdtype = "DARK"
+        else:
+            ccdtype = "BIAS"
+        header = bcam.makeHeader("MASTER " + ccdtype, exptime)
+        header.append(pyfits.createCard("NCOMBINE", n, "Number of frames combined"))
+        header.append(pyfits.createCard("COMBINE", method, "Combine method"))
+        header.append(pyfits.createCard("T_BAND", key[-1]*TEMP_BAND, "CCD temperature band (C)"))
+        self.put(key, master, header)
+        return master, header
+
+    # names of the masters saved on disk
+    def list(self):
+        names = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "master-*.fits"))):
+            names.append(os.path.basename(path)[len("master-"):-len(".fits")])
+        return names
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+FITS encoding for delivering BCAM frames.  uncompressed frames are streamed block by block straight
+from the image array; tile-compressed frames are encoded into a single compressed buffer.  frames
+are uint16, except for stacks, which are float32.
+"""
+
+import cStringIO
+from astropy.io import fits as pyfits
+import numpy as np
+
+BLOCK = 2880
+
+# bytes of data handed to the client per chunk when streaming
+CHUNK_BYTES = 1024*1024
+
+# tile compression schemes accepted from clients and their FITS names
+COMPRESSION = {
+    "rice": "RICE_1",
+    "gzip": "GZIP_1",
+    "hcompress": "HCOMPRESS_1",
+}
+
+# keywords primaryHeader() writes itself
+STRUCTURAL = ("SIMPLE", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "EXTEND", "BZERO", "BSCALE")
+
+def padding(nbytes):
+    return (BLOCK - nbytes % BLOCK) % BLOCK
+
+# primary header for a 2-D uint16 image, stored as BITPIX=16 with BZERO=32768 as FITS requires,
+# or for a float32 one as BITPIX=-32
+def primaryHeader(image, header):
+    rows, cols = image.shape
+    floating = image.dtype == np.float32
+    h = pyfits.Header()
+    h.append(pyfits.createCard("SIMPLE", True, "conforms to FITS standard"))
+    if floating:
+        h.append(pyfits.createCard("BITPIX", -32, "array data type"))
+    else:
+        h.append(pyfits.createCard("BITPIX", 16, "array data type"))
+    h.append(pyfits.createCard("NAXIS", 2, "number of array dimensions"))
+    h.append(pyfits.createCard("NAXIS1", cols))
+    h.append(pyfits.createCard("NAXIS2", rows))
+    for card in header.cards:
+        if card.keyword not in STRUCTURAL:
+            h.append(card)
+    if not floating:
+        h.append(pyfits.createCard("BZERO", 32768))
+        h.append(pyfits.createCard("BSCALE", 1))
+    return h
+
+# total size of the uncompressed FITS file stream() produces
+def streamLength(image, header):
+    head = len(primaryHeader(image, header).tostring())
+    data = image.dtype.itemsize*image.size
+    return head + data + padding(data)
+
+# generate an uncompressed FITS file in chunks.  rows are offset to signed 16-bit (uint16 images)
+# and byte-swapped a slice at a time, so nothing close to a full copy of the image is ever held.
+def stream(image, header, chunk=CHUNK_BYTES):
+    yield primaryHeader(image, header).tostring()
+
+    rows, cols = image.shape
+    size = image.dtype.itemsize
+    step = max(1, chunk // (size*cols))
+    for r in xrange(0, rows, step):
+        if image.dtype == np.float32:
+            yield image[r:r+step].astype(">f4").tostring()
+        else:
+            block = image[r:r+step] ^ np.uint16(0x8000)
+            yield block.view(np.int16).astype(">i2").tostring()
+
+    pad = padding(size*image.size)
+    if pad:
+        yield "\0"*pad
+
+# encode the image as a tile-compressed image extension using one of COMPRESSION's schemes and
+# return the whole file.  the HDU writes its own structural keywords from the data and the frame's
+# cards go in after them.
+def compressed(image, header, method):
+    hdu = pyfits.CompImageHDU(data=image, compression_type=COMPRESSION[method])
+    hdu.header.extend([card for card in header.cards if card.keyword not in STRUCTURAL])
+    out = cStringIO.StringIO()
+    pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(out)
+    return out.getvalue()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+telemetry history for BCAM: temperatures, cooler drive and status, and focus, kept in fixed-size
+numpy rings.  every sample is folded into each of several tiers of time bins (1 s, 1 min, 15 min by
+default), each bin holding the min, sum, max and count of every field, so the finest tier covers
+the last few days and the coarser ones months to years, all in memory fixed at startup.  queries
+pick the finest tier that covers the requested window and can merge its bins into wider steps.
+"""
+
+import math
+import threading
+
+import numpy as np
+
+# snapshot keys recorded
+FIELDS = ("t_ccd", "t_heatsink", "cooler_drive", "cooler_status", "setpoint", "focus",
+          "focus_temp")
+
+# (bin width in s, number of bins) for each tier: 3 days at 1 s, 60 days at 1 min and two years
+# at 15 min
+TIERS = ((1, 3*86400), (60, 60*1440), (900, 730*96))
+
+# most bins a query returns before it moves to a coarser tier
+MAX_POINTS = 5000
+
+class Tier:
+    """
+    ring of 'nbins' time bins 'width' seconds wide.  bin b covers [b*width, (b+1)*width) and lives
+    in slot b % nbins; a slot whose recorded bin number doesn't match is empty or out of date.
+    """
+    def __init__(self, width, nbins, nfields):
+        self.width = width
+        self.nbins = nbins
+        self.bins = np.full(nbins, -1, dtype=np.int64)
+        self.min = np.zeros((nbins, nfields), dtype=np.float32)
+        self.max = np.zeros((nbins, nfields), dtype=np.float32)
+        self.sum = np.zeros((nbins, nfields), dtype=np.float32)
+        self.count = np.zeros((nbins, nfields), dtype=np.uint16)
+
+    # earliest time still held
+    def oldest(self, now):
+        return (math.floor(now/self.width) - self.nbins + 1)*self.width
+
+    def add(self, t, values, valid):
+        b = int(t//self.width)
+        slot = b % self.nbins
+        if self.bins[slot] != b:
+            self.bins[slot] = b
+            self.min[slot] = np.inf
+            self.max[slot] = -np.inf
+            self.sum[slot] = 0.0
+            self.count[slot] = 0
+        self.min[slot] = np.where(valid, np.minimum(self.min[slot], values), self.min[slot])
+        self.max[slot] = np.where(valid, np.maximum(self.max[slot], values), self.max[slot])
+        self.sum[slot] += np.where(valid, values, 0.0)
+        self.count[slot] += valid
+
+    # bins between t0 and t1 that hold data: start times, min, sum, max and count.  no more than
+    # the ring's nbins are looked at, counting back from t1.
+    def select(self, t0, t1):
+        b1 = int(t1//self.width)
+        b0 = max(int(t0//self.width), b1 - self.nbins + 1)
+        b = np.arange(b0, b1 + 1, dtype=np.int64)
+        slots = b % self.nbins
+        keep = self.bins[slots] == b
+        b, slots = b[keep], slots[keep]
+        return (b*self.width).astype(np.float64), self.min[slots], self.sum[slots], \
+            self.max[slots], self.count[slots]
+
+class History:
+    """
+    the telemetry history.  add() takes a bcam.Snapshot; query() returns min/mean/max series.
+    """
+    def __init__(self, fields=FIELDS, tiers=TIERS):
+        self.fields = tuple(fields)
+        self.tiers = [Tier(width, nbins, len(self.fields)) for width, nbins in tiers]
+        self.latest = None
+        self.lock = threading.Lock()
+
+    def add(self, snapshot):
+        values = np.zeros(len(self.fields), dtype=np.float32)
+        valid = np.zeros(len(self.fields), dtype=bool)
+        for i, name in enumerate(self.fields):
+            v = snapshot.get(name)
+            if v is not None:
+                values[i] = v
+                valid[i] = True
+        self.lock.acquire()
+        try:
+            for tier in self.tiers:
+                tier.add(snapshot.time, values, valid)
+            self.latest = snapshot.time
+        finally:
+            self.lock.release()
+
+    # the finest tier that still holds t0 without returning more than maxpoints bins of at least
+    # 'step' seconds, or the coarsest one
+    def tier(self, t0, t1, step, maxpoints):
+        now = self.latest or t1
+        for tier in self.tiers:
+            if tier.oldest(now) <= t0 and (t1 - t0)/max(tier.width, step) <= maxpoints:
+                return tier
+        return self.tiers[-1]
+
+    # min/mean/max of each field over [t0, t1] in steps of 'step' seconds (the tier's own bins if
+    # not given).  returns (step, times, {field: (min, mean, max)}) with NaN where a field has no
+    # data in a step.  windows are cut short at the latest sample and at the start of the coarsest
+    # tier, and the step is widened to keep them to maxpoints steps.
+    def query(self, t0, t1, step=None, fields=None, maxpoints=MAX_POINTS):
+        fields = fields or self.fields
+        idx = [self.fields.index(f) for f in fields]
+        self.lock.acquire()
+        try:
+            if self.latest is not None:
+                t1 = min(t1, self.latest)
+            tier = self.tier(t0, t1, step or 0, maxpoints)
+            t0 = max(t0, tier.oldest(self.latest or t1))
+            times, mins, sums, maxs, counts = tier.select(t0, t1)
+        finally:
+            self.lock.release()
+        mins, sums, maxs, counts = mins[:, idx], sums[:, idx], maxs[:, idx], counts[:, idx]
+
+        widest = math.ceil((t1 - t0)/float(maxpoints)/tier.width)*tier.width
+        if widest > max(step or 0, tier.width):
+            step = widest
+
+        if step is None or step <= tier.width:
+            step = tier.width
+        elif len(times):
+            # merge consecutive bins into steps
+            group = ((times - t0)//step).astype(np.int64)
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(group)) + 1))
+            times = t0 + group[starts]*float(step)
+            counts = np.add.reduceat(counts.astype(np.int64), starts)
+            sums = np.add.reduceat(sums.astype(np.float64), starts)
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+
+        empty = counts == 0
+        mean = np.where(empty, np.nan, sums/np.maximum(counts, 1))
+        mins = np.where(empty, np.nan, mins)
+        maxs = np.where(empty, np.nan, maxs)
+        series = {}
+        for i, name in enumerate(fields):
+            series[name] = (mins[:, i], mean[:, i], maxs[:, i])
+        return step, times, series
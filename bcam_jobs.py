@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+job queue for BCAM hardware work.  jobs are run one at a time, in the order they were submitted,
+by a single worker thread so that only one of them ever drives the camera.  finished results are
+kept until they get too old or the store grows past its size limit.
+"""
+
+import time
+import itertools
+import threading
+from collections import deque
+
+import bcam_metrics
+from bcam import b_log
+
+QUEUED = "queued"
+RUNNING = "running"
+CANCELLING = "cancelling"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+
+class QueueFull(Exception):
+    """
+    raised when a job is submitted while the queue is already at its limit.
+    """
+    pass
+
+# size in bytes of a job result; numpy arrays, alone or in a tuple/list, count toward it
+def result_size(result):
+    if isinstance(result, (tuple, list)):
+        return sum([result_size(r) for r in result])
+    return getattr(result, "nbytes", 0)
+
+class Job:
+    """
+    one unit of hardware work.  func(*args, **kwargs) is called on the worker thread and its return
+    value becomes the result.  'calls' counts the hardware calls it made.
+    """
+    def __init__(self, id, kind, func, args, kwargs, params):
+        self.id = id
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.params = params
+        self.state = QUEUED
+        self.error = None
+        self.result = None
+        self.nbytes = 0
+        self.calls = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+
+    # JSON-friendly summary of the job
+    def info(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "params": self.params,
+            "error": self.error,
+            "nbytes": self.nbytes,
+            "hardware_calls": self.calls,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+class JobQueue:
+    """
+    bounded FIFO of Jobs drained by one worker thread.  'maxqueue' limits how many jobs may wait at
+    once.  finished jobs are forgotten after 'max_age' seconds, and the oldest results are dropped
+    whenever the stored results add up to more than 'max_bytes'.  'abort' is called to interrupt a
+    running job when it's cancelled, and 'watch' is called with each job's cancel Event as it starts
+    and with None once it's finished, so the work can stop itself between steps.  queues given the
+    same 'ids' iterator number their jobs from it, so job ids stay unique across them.
+    """
+    def __init__(self, maxqueue=16, max_age=3600.0, max_bytes=512*1024*1024, abort=None,
+                 watch=None, ids=None, name="jobs"):
+        self.maxqueue = maxqueue
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.abort = abort
+        self.watch = watch
+        self.jobs = {}
+        self.queue = deque()
+        self.current = None
+        if ids is None:
+            ids = itertools.count(1)
+        self.ids = ids
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    # queue func(*args, **kwargs) and return the new Job.  'params' is only recorded for reporting.
+    def submit(self, kind, func, args=(), kwargs=None, params=None):
+        self.lock.acquire()
+        try:
+            if len(self.queue) >= self.maxqueue:
+                raise QueueFull("Job queue is full (%d waiting)." % len(self.queue))
+            job = Job(self.ids.next(), kind, func, args, kwargs or {}, params or {})
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.lock.notify()
+        finally:
+            self.lock.release()
+        b_log.info("Queued %s job %d." % (kind, job.id))
+        return job
+
+    def get(self, id):
+        self.lock.acquire()
+        try:
+            self.prune()
+            return self.jobs.get(id)
+        finally:
+            self.lock.release()
+
+    def list(self):
+        self.lock.acquire()
+        try:
+            self.prune()
+            return sorted(self.jobs.values(), key=lambda j: j.id)
+        finally:
+            self.lock.release()
+
+    # most recent finished job of the given kind that still has its result
+    def latest(self, kind):
+        self.lock.acquire()
+        try:
+            done = [j for j in self.jobs.values() if j.kind == kind and j.result is not None]
+        finally:
+            self.lock.release()
+        if not done:
+            return None
+        return max(done, key=lambda j: j.id)
+
+    def depth(self):
+        return len(self.queue)
+
+    # cancel a job.  a queued job is simply dropped.  a running one has its cancel Event set and is
+    # interrupted through the abort hook; it's 'cancelling' until the work has actually stopped and
+    # 'cancelled' after.  returns False if the job is unknown, already finished or being cancelled.
+    def cancel(self, id):
+        self.lock.acquire()
+        try:
+            job = self.jobs.get(id)
+            if job is None:
+                return False
+            if job.state == QUEUED:
+                self.queue.remove(job)
+                job.cancelled.set()
+                job.state = CANCELLED
+                job.finished = time.time()
+                job.done.set()
+                running = False
+            elif job.state == RUNNING:
+                job.cancelled.set()
+                job.state = CANCELLING
+                running = True
+            else:
+                return False
+        finally:
+            self.lock.release()
+
+        if running and self.abort is not None:
+            self.abort()
+        b_log.info("Cancelled job %d." % id)
+        return True
+
+    # forget old jobs and drop the oldest results until the store fits in max_bytes.  called with
+    # the lock held.
+    def prune(self):
+        now = time.time()
+        for job in self.jobs.values():
+            if job.finished is not None and now - job.finished > self.max_age:
+                del self.jobs[job.id]
+
+        stored = [j for j in self.jobs.values() if j.result is not None]
+        stored.sort(key=lambda j: j.finished)
+        total = sum([j.nbytes for j in stored])
+        while stored and total > self.max_bytes:
+            job = stored.pop(0)
+            total -= job.nbytes
+            job.result = None
+            job.state = EXPIRED
+            b_log.info("Dropped result of job %d to stay under %d bytes." % (job.id, self.max_bytes))
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.queue:
+                    self.lock.wait()
+                job = self.queue.popleft()
+                job.state = RUNNING
+                job.started = time.time()
+                self.current = job
+            finally:
+                self.lock.release()
+
+            if self.watch is not None:
+                self.watch(job.cancelled)
+            bcam_metrics.resetCalls()
+            try:
+                result = job.func(*job.args, **job.kwargs)
+                error = None
+            except Exception as e:
+                result = None
+                error = str(e)
+            if self.watch is not None:
+                self.watch(None)
+            job.calls = bcam_metrics.threadCalls()
+            bcam_metrics.JOB_HW_CALLS.observe(job.calls, kind=job.kind)
+
+            self.lock.acquire()
+            try:
+                self.current = None
+                job.finished = time.time()
+                if job.cancelled.isSet():
+                    job.state = CANCELLED
+                    b_log.info("Job %d stopped after being cancelled." % job.id)
+                elif error is not None:
+                    job.state = FAILED
+                    job.error = error
+                    b_log.error("Job %d failed: %s" % (job.id, error))
+                else:
+                    job.state = DONE
+                    job.result = result
+                    job.nbytes = result_size(result)
+                job.done.set()
+                self.prune()
+            finally:
+                self.lock.release()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+live status for BCAM.  the telemetry poller publishes each sample to a StatusFeed, which keeps the
+latest value of every field and, under a sequence number, the fields that changed.  any number of
+subscribers wait on the feed and are sent only what changed since the last number they saw, so
+watchers never cause hardware reads of their own.
+"""
+
+import threading
+from collections import deque
+
+class StatusFeed:
+    """
+    latest status values and the last 'keep' sets of changes to them.  publish() takes a dict of
+    values; since() and wait() are for subscribers on other threads.
+    """
+    def __init__(self, keep=64):
+        self.values = {}
+        self.changes = deque(maxlen=keep)
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    # record values, keeping only those that differ from the last ones published.  returns the
+    # changed fields.
+    def publish(self, values):
+        self.cond.acquire()
+        try:
+            changed = dict([(k, v) for k, v in values.items()
+                            if k not in self.values or self.values[k] != v])
+            if changed:
+                self.values.update(changed)
+                self.seq += 1
+                self.changes.append((self.seq, changed))
+                self.cond.notifyAll()
+            return changed
+        finally:
+            self.cond.release()
+
+    # fields changed after number 'seq', and the latest number.  with no number, or one too old
+    # to still have its changes, every field is returned.
+    def since(self, seq=None):
+        self.cond.acquire()
+        try:
+            if seq is None or not self.changes or seq < self.changes[0][0] - 1 or seq > self.seq:
+                return dict(self.values), self.seq
+            changed = {}
+            for n, c in self.changes:
+                if n > seq:
+                    changed.update(c)
+            return changed, self.seq
+        finally:
+            self.cond.release()
+
+    # wait up to timeout s for a change after number 'seq'
+    def wait(self, seq, timeout):
+        self.cond.acquire()
+        try:
+            if self.seq <= seq:
+                self.cond.wait(timeout)
+            return self.seq > seq
+        finally:
+            self.cond.release()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+lightweight counters, gauges and histograms for BCAM, rendered in the Prometheus text format.
+metrics are plain module-level objects so that bcam.py and bcam_srv.py can update them without
+passing anything around.
+"""
+
+import time
+import bisect
+import threading
+
+# seconds; covers everything from a single SWIG call to a long exposure
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+REGISTRY = []
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def labelString(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (k, escape(v)) for k, v in pairs]) + "}"
+
+class Metric:
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def lines(self):
+        out = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        self.lock.acquire()
+        try:
+            items = sorted(self.values.items())
+        finally:
+            self.lock.release()
+        for key, value in items:
+            out.extend(self.sample(key, value))
+        return out
+
+    def sample(self, key, value):
+        return ["%s%s %s" % (self.name, labelString(key), repr(float(value)))]
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help, "counter")
+
+    def inc(self, amount=1, **labels):
+        k = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[k] = self.values.get(k, 0) + amount
+        finally:
+            self.lock.release()
+
+class Gauge(Metric):
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help, "gauge")
+
+    def set(self, value, **labels):
+        k = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[k] = value
+        finally:
+            self.lock.release()
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, "histogram")
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        self.lock.acquire()
+        try:
+            h = self.values.get(k)
+            if h is None:
+                h = self.values[k] = [[0]*len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+        finally:
+            self.lock.release()
+
+    def sample(self, key, value):
+        counts, total, n = value
+        out = []
+        cumulative = 0
+        for le, c in zip(self.buckets, counts):
+            cumulative += c
+            out.append("%s_bucket%s %d" % (self.name, labelString(key, [("le", repr(le))]),
+                                            cumulative))
+        out.append("%s_bucket%s %d" % (self.name, labelString(key, [("le", "+Inf")]), n))
+        out.append("%s_sum%s %s" % (self.name, labelString(key), repr(total)))
+        out.append("%s_count%s %d" % (self.name, labelString(key), n))
+        return out
+
+STAGE_SECONDS = Histogram("bcam_stage_seconds", "Time spent in each stage of acquiring and "
+                          "delivering a frame.")
+FRAMES = Counter("bcam_frames_total", "Frames read out of the camera.")
+BYTES_READ = Counter("bcam_bytes_read_total", "Image bytes read out of the camera.")
+ERRORS = Counter("bcam_errors_total", "Errors reported by libfli and libapogee.")
+ARCHIVE_DROPPED = Counter("bcam_archive_dropped_total", "Frames not archived, by reason.")
+HW_CALLS = Counter("bcam_hardware_calls_total", "Calls made to each device.")
+HW_SECONDS = Histogram("bcam_hardware_call_seconds", "Duration of calls to each device.")
+REQUEST_SECONDS = Histogram("bcam_request_seconds", "Time to handle each HTTP request.")
+REQUEST_HW_CALLS = Histogram("bcam_request_hardware_calls", "Hardware calls made while handling "
+                             "each HTTP request, including those of the jobs it waited for.",
+                             buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+JOB_HW_CALLS = Histogram("bcam_job_hardware_calls", "Hardware calls made by each job.",
+                         buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500, 1000))
+
+class timer(object):
+    """
+    times a block and records it as a stage in STAGE_SECONDS.  the duration is kept in 'elapsed'.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.t0
+        STAGE_SECONDS.observe(self.elapsed, stage=self.stage)
+        return False
+
+# hardware calls made by the current thread, so a request handler or job can report its own
+_local = threading.local()
+
+def countCall(device, seconds):
+    HW_CALLS.inc(device=device)
+    HW_SECONDS.observe(seconds, device=device)
+    _local.calls = getattr(_local, "calls", 0) + 1
+
+def resetCalls():
+    _local.calls = 0
+
+# count n calls made elsewhere, by a job the current thread waited for, as its own
+def addCalls(n):
+    _local.calls = getattr(_local, "calls", 0) + n
+
+def threadCalls():
+    return getattr(_local, "calls", 0)
+
+def render():
+    lines = []
+    for m in REGISTRY:
+        lines.extend(m.lines())
+    return "\n".join(lines) + "\n"
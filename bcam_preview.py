@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+quick-look previews of BCAM frames.  a frame is block-averaged down to a bounded size, stretched
+with limits estimated from a random subsample of its pixels and encoded as an 8-bit PNG or JPEG.
+PNGs are written with zlib alone; JPEG needs PIL.
+"""
+
+import zlib
+import struct
+import threading
+import cStringIO
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# pixels sampled when estimating the stretch
+NSAMPLE = 20000
+
+STRETCHES = ("zscale", "percentile")
+
+def formats():
+    if Image is not None:
+        return ("png", "jpeg")
+    return ("png",)
+
+# average factor x factor blocks of the image, dropping any partial blocks at the edges
+def blockMean(image, factor):
+    if factor <= 1:
+        return image.astype(np.float32)
+    rows, cols = image.shape
+    ny, nx = rows//factor, cols//factor
+    blocks = image[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=3, dtype=np.float32).mean(axis=1)
+
+# random subsample of the image's pixels
+def sample(image, n=NSAMPLE):
+    flat = image.ravel()
+    if flat.size <= n:
+        return flat.astype(np.float32)
+    return flat[np.random.randint(0, flat.size, n)].astype(np.float32)
+
+# IRAF-style zscale limits: fit a line to the sorted sample with iterative rejection and scale its
+# slope by the contrast around the median
+def zscale(values, contrast=0.25, nsigma=2.5, iters=5):
+    s = np.sort(values)
+    n = s.size
+    mid = n//2
+    x = np.arange(n, dtype=np.float32)
+    good = np.ones(n, dtype=bool)
+    slope = 0.0
+    for i in range(iters):
+        slope, intercept = np.polyfit(x[good], s[good], 1)
+        resid = s - (slope*x + intercept)
+        keep = np.abs(resid) < nsigma*resid[good].std()
+        if keep.sum() < n//2 or (keep == good).all():
+            break
+        good = keep
+    slope /= contrast
+    z1 = max(s[0], s[mid] - mid*slope)
+    z2 = min(s[-1], s[mid] + (n - 1 - mid)*slope)
+    return z1, z2
+
+def percentile(values, lo=0.5, hi=99.5):
+    return np.percentile(values, lo), np.percentile(values, hi)
+
+# scale the image to 0-255 between limits z1 and z2
+def stretch(image, z1, z2):
+    scale = 255.0/max(z2 - z1, 1e-6)
+    return np.clip((image - z1)*scale, 0, 255).astype(np.uint8)
+
+# minimal 8-bit greyscale PNG
+def png(pixels):
+    rows, cols = pixels.shape
+    raw = np.zeros((rows, cols + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+    return "\x89PNG\r\n\x1a\n" + \
+        chunk("IHDR", struct.pack(">IIBBBBB", cols, rows, 8, 0, 0, 0, 0)) + \
+        chunk("IDAT", zlib.compress(raw.tostring(), 6)) + \
+        chunk("IEND", "")
+
+def jpeg(pixels, quality=85):
+    out = cStringIO.StringIO()
+    Image.fromarray(pixels).save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+# preview of image no larger than size x size, in the given format and stretch
+def render(image, size=512, method="zscale", fmt="png"):
+    rows, cols = image.shape
+    factor = max(1, -(-max(rows, cols)//size))
+    small = blockMean(image, factor)
+    values = sample(image)
+    if method == "zscale":
+        z1, z2 = zscale(values)
+    else:
+        z1, z2 = percentile(values)
+    pixels = stretch(small, z1, z2)
+    if fmt == "jpeg":
+        return jpeg(pixels)
+    return png(pixels)
+
+class PreviewCache:
+    """
+    rendered previews keyed by frame id and render options, keeping the 'capacity' most recent.
+    """
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    # preview of frame 'id', rendered only the first time it's asked for with these options
+    def get(self, id, image, size=512, method="zscale", fmt="png"):
+        key = (id, size, method, fmt)
+        self.lock.acquire()
+        try:
+            if key in self.cache:
+                data = self.cache.pop(key)
+                self.cache[key] = data
+                return data
+        finally:
+            self.lock.release()
+
+        data = render(image, size, method, fmt)
+        self.lock.acquire()
+        try:
+            self.cache[key] = data
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+        return data
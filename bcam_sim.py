@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+simulated hardware for running BCAM away from the telescope.  this module stands in for
+pylibapogee (the Alta camera, FindDeviceUsb and the Status_* constants) and for libfli (a focuser
+with stepping latency).  select it by setting BCAM_BACKEND=sim before importing bcam.
+
+exposure and readout take real time, following the Alta U16M's readout model.  BCAM_SIM_SCALE
+scales all simulated delays, e.g. 0.1 to run ten times faster.  frames are a flat sky with read
+noise and one star whose width follows the simulated focuser, so autofocus and tracking can be
+exercised as well.
+"""
+
+import os
+import time
+import ctypes
+import threading
+
+import numpy as np
+
+SCALE = float(os.environ.get("BCAM_SIM_SCALE", "1.0"))
+
+# BCAM_SIM_BULK=1 gives the camera a GetImageInto bulk readout path
+BULK = os.environ.get("BCAM_SIM_BULK", "0") == "1"
+
+# number of cameras FindDeviceUsb lists, e.g. BCAM_SIM_CAMERAS=2 for a pair sharing one sky
+CAMERAS = int(os.environ.get("BCAM_SIM_CAMERAS", "1"))
+
+# apg.Status_* imaging states, as in libapogee
+Status_ConnectionError = -3
+Status_DataError = -2
+Status_PatternError = -1
+Status_Idle = 0
+Status_Exposing = 1
+Status_ImagingActive = 2
+Status_ImageReady = 3
+Status_Flushing = 4
+Status_WaitingOnTrigger = 5
+
+# Alta U16M readout: 1 MHz digitization, per-row shift time and fixed overhead (s)
+PIXEL_RATE = 1.0e6
+ROW_SHIFT = 2.0e-5
+READ_OVERHEAD = 0.05
+
+# latency of a single USB round trip to either device (s)
+USB_LATENCY = 0.0005
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds*SCALE)
+
+class FindDeviceUsb:
+    def Find(self):
+        return "".join(["<d>address=%d,interface=usb,deviceType=camera,id=0x49,firmwareRev=0x21,"
+                        "model=AltaU-16M,interfaceStatus=NA</d>" % i for i in range(CAMERAS)])
+
+class Alta:
+    """
+    the subset of apg.Alta that BCAM uses
+    """
+    COLS = 4096
+    ROWS = 4096
+    MAX_BIN = 16
+
+    # sky level and read noise (ADU), and the star's position (unbinned), peak and in-focus sigma
+    SKY = 1000.0
+    NOISE = 10.0
+    STAR = (2048.0, 2048.0)
+    STAR_PEAK = 20000.0
+    STAR_SIGMA = 1.5
+
+    def __init__(self, bulk=None):
+        if bulk is None:
+            bulk = BULK
+        self.startrow = 0
+        self.startcol = 0
+        self.numrows = Alta.ROWS
+        self.numcols = Alta.COLS
+        self.binrow = 1
+        self.bincol = 1
+        self.status = Status_Idle
+        self.started = None
+        self.exp = 0.0
+        self.shutter = False
+        self.readout = 0.0
+        self.cooler = False
+        self.setpoint = -20.0
+        self.backoff = 2.0
+        self.fanmode = 1
+        self.tccd = 10.0
+        self.tupdated = time.time()
+        self.noise = {}
+        if bulk:
+            self.GetImageInto = self.getImageInto
+
+    # connection
+    def OpenConnection(self, interface, address, firmwareRev, id):
+        sleep(USB_LATENCY)
+
+    def CloseConnection(self):
+        pass
+
+    def Init(self):
+        sleep(0.5)
+
+    def GetModel(self):
+        return "AltaU-16M"
+
+    def GetSensor(self):
+        return "KAF16803"
+
+    # geometry
+    def GetPixelHeight(self):
+        return 9.0
+
+    def GetPixelWidth(self):
+        return 9.0
+
+    def GetMaxImgCols(self):
+        sleep(USB_LATENCY)
+        return Alta.COLS
+
+    def GetMaxImgRows(self):
+        sleep(USB_LATENCY)
+        return Alta.ROWS
+
+    def GetMaxBinCols(self):
+        sleep(USB_LATENCY)
+        return Alta.MAX_BIN
+
+    def GetMaxBinRows(self):
+        sleep(USB_LATENCY)
+        return Alta.MAX_BIN
+
+    def SetRoiStartRow(self, v):
+        sleep(USB_LATENCY)
+        self.startrow = v
+
+    def SetRoiStartCol(self, v):
+        sleep(USB_LATENCY)
+        self.startcol = v
+
+    def SetRoiNumRows(self, v):
+        sleep(USB_LATENCY)
+        self.numrows = v
+
+    def SetRoiNumCols(self, v):
+        sleep(USB_LATENCY)
+        self.numcols = v
+
+    def SetRoiBinRow(self, v):
+        sleep(USB_LATENCY)
+        self.binrow = v
+
+    def SetRoiBinCol(self, v):
+        sleep(USB_LATENCY)
+        self.bincol = v
+
+    def GetRoiStartRow(self):
+        return self.startrow
+
+    def GetRoiStartCol(self):
+        return self.startcol
+
+    def GetRoiNumRows(self):
+        return self.numrows
+
+    def GetRoiNumCols(self):
+        return self.numcols
+
+    def GetRoiBinRow(self):
+        return self.binrow
+
+    def GetRoiBinCol(self):
+        return self.bincol
+
+    # exposure
+    def StartExposure(self, exp, shutter):
+        sleep(USB_LATENCY)
+        self.exp = exp
+        self.shutter = shutter
+        self.readout = READ_OVERHEAD + self.numrows*self.numcols/PIXEL_RATE + \
+            self.numrows*self.binrow*ROW_SHIFT
+        self.started = time.time()
+        self.status = Status_Exposing
+
+    def StopExposure(self, digitize):
+        self.status = Status_Idle
+        self.started = None
+
+    def GetImagingStatus(self):
+        sleep(USB_LATENCY)
+        if self.started is not None:
+            elapsed = (time.time() - self.started)/SCALE
+            if elapsed < self.exp:
+                self.status = Status_Exposing
+            elif elapsed < self.exp + self.readout:
+                self.status = Status_ImagingActive
+            else:
+                self.status = Status_ImageReady
+        return self.status
+
+    def GetShutterState(self):
+        return 1
+
+    # a flat sky with read noise, plus the star if the shutter was open.  the noise is made once
+    # per geometry so that producing a frame costs about what a copy does.
+    def makeFrame(self):
+        key = (self.numrows, self.numcols)
+        if key not in self.noise:
+            noise = np.random.normal(Alta.SKY, Alta.NOISE, key)
+            self.noise[key] = np.clip(noise, 0, 65535).astype(np.uint16)
+        frame = self.noise[key].copy()
+        if self.shutter:
+            self.addStar(frame)
+        return frame
+
+    def addStar(self, frame):
+        sigma = Alta.STAR_SIGMA*FLI.defocus()
+        x0 = (Alta.STAR[0] - self.startcol)/self.bincol
+        y0 = (Alta.STAR[1] - self.startrow)/self.binrow
+        r = int(6*sigma/min(self.bincol, self.binrow)) + 2
+        rows, cols = frame.shape
+        ylo, yhi = max(int(y0) - r, 0), min(int(y0) + r, rows)
+        xlo, xhi = max(int(x0) - r, 0), min(int(x0) + r, cols)
+        if ylo >= yhi or xlo >= xhi:
+            return
+        y, x = np.mgrid[ylo:yhi, xlo:xhi]
+        dx = (x - x0)*self.bincol
+        dy = (y - y0)*self.binrow
+        peak = Alta.STAR_PEAK*self.exp*(Alta.STAR_SIGMA/sigma)**2*self.bincol*self.binrow
+        star = peak*np.exp(-(dx*dx + dy*dy)/(2*sigma*sigma))
+        stamp = frame[ylo:yhi, xlo:xhi] + star
+        frame[ylo:yhi, xlo:xhi] = np.clip(stamp, 0, 65535)
+
+    # the SWIG binding hands back a tuple of python ints
+    def GetImage(self):
+        frame = self.makeFrame()
+        self.status = Status_Idle
+        self.started = None
+        return tuple(frame.ravel().tolist())
+
+    # bulk path into caller-owned memory, only present with bulk=True
+    def getImageInto(self, address, npix):
+        frame = self.makeFrame()
+        ctypes.memmove(address, frame.ctypes.data, 2*min(npix, frame.size))
+        self.status = Status_Idle
+        self.started = None
+
+    # cooling: the CCD relaxes toward the setpoint (or ambient with the cooler off)
+    def updateTemp(self):
+        now = time.time()
+        target = 10.0
+        if self.cooler:
+            target = self.setpoint
+        dt = (now - self.tupdated)/SCALE
+        self.tccd = target + (self.tccd - target)*np.exp(-dt/60.0)
+        self.tupdated = now
+
+    def GetTempCcd(self):
+        sleep(USB_LATENCY)
+        self.updateTemp()
+        return self.tccd
+
+    def GetTempHeatsink(self):
+        sleep(USB_LATENCY)
+        return 15.0
+
+    def GetCoolerDrive(self):
+        sleep(USB_LATENCY)
+        if self.cooler:
+            return min(100.0, max(0.0, 50.0 + 2.0*(self.tccd - self.setpoint)))
+        return 0.0
+
+    def GetCoolerStatus(self):
+        self.updateTemp()
+        if not self.cooler:
+            return 0
+        if abs(self.tccd - self.setpoint) < 0.5:
+            return 2
+        return 1
+
+    def GetCoolerSetPoint(self):
+        return self.setpoint
+
+    def GetCoolerBackoffPoint(self):
+        return self.backoff
+
+    def GetFanMode(self):
+        return self.fanmode
+
+    def SetCooler(self, on):
+        self.cooler = on
+
+    def SetCoolerSetPoint(self, t):
+        self.setpoint = t
+
+    def SetCoolerBackoffPoint(self, t):
+        self.backoff = t
+
+    def SetFanMode(self, mode):
+        self.fanmode = mode
+
+class Ascent(Alta):
+    pass
+
+class FakeLibfli:
+    """
+    the libfli calls Focuser makes, for one focuser.  output arguments are ctypes byref() objects
+    as they would be for the real library.
+    """
+    EXTENT = 7000
+    STEP_TIME = 0.001
+
+    # focus position where the simulated star is sharpest, and the defocus scale (steps)
+    BEST = 3500
+    DEPTH = 300.0
+
+    def __init__(self):
+        self.position = FakeLibfli.BEST - 500
+        self.target = self.position
+        self.moved = time.time()
+        self.lock = threading.Lock()
+
+    # position now, allowing for an asynchronous move in progress
+    def current(self):
+        self.lock.acquire()
+        try:
+            steps = (time.time() - self.moved)/(FakeLibfli.STEP_TIME*SCALE)
+            if self.target > self.position:
+                return min(self.position + int(steps), self.target)
+            return max(self.position - int(steps), self.target)
+        finally:
+            self.lock.release()
+
+    def defocus(self):
+        d = (self.current() - FakeLibfli.BEST)/FakeLibfli.DEPTH
+        return np.sqrt(1.0 + d*d)
+
+    def FLIOpen(self, handle, device, domain):
+        sleep(USB_LATENCY)
+        handle._obj.value = 1
+        return 0
+
+    def FLIClose(self, handle):
+        return 0
+
+    # a NULL-terminated array of "path;model" strings, as libfli hands back
+    def FLIList(self, domain, names):
+        self.names = (ctypes.c_char_p*2)("/dev/fliusb0;FLI Precision Digital Focuser", None)
+        ctypes.cast(ctypes.addressof(names._obj), ctypes.POINTER(ctypes.c_void_p))[0] = \
+            ctypes.addressof(self.names)
+        return 0
+
+    def FLIFreeList(self, names):
+        self.names = None
+        return 0
+
+    def FLIGetStepperPosition(self, handle, position):
+        sleep(USB_LATENCY)
+        position._obj.value = self.current()
+        return 0
+
+    def FLIGetFocuserExtent(self, handle, extent):
+        sleep(USB_LATENCY)
+        extent._obj.value = FakeLibfli.EXTENT
+        return 0
+
+    def FLIReadTemperature(self, handle, channel, t):
+        sleep(USB_LATENCY)
+        t._obj.value = 12.5
+        return 0
+
+    def FLIGetStepsRemaining(self, handle, steps):
+        sleep(USB_LATENCY)
+        steps._obj.value = abs(self.target - self.current())
+        return 0
+
+    # start moving by 'steps' and return how many steps the move will take
+    def move(self, steps):
+        now = self.current()
+        self.lock.acquire()
+        try:
+            self.position = now
+            self.target = min(max(now + steps, 0), FakeLibfli.EXTENT)
+            self.moved = time.time()
+            return abs(self.target - now)
+        finally:
+            self.lock.release()
+
+    def FLIStepMotorAsync(self, handle, steps):
+        sleep(USB_LATENCY)
+        self.move(steps.value)
+        return 0
+
+    def FLIStepMotor(self, handle, steps):
+        sleep(USB_LATENCY)
+        sleep(self.move(steps.value)*FakeLibfli.STEP_TIME)
+        return 0
+
+    def FLIHomeFocuser(self, handle):
+        sleep(USB_LATENCY)
+        sleep(self.move(-self.current())*FakeLibfli.STEP_TIME)
+        return 0
+
+# the one simulated focuser, shared with the camera so the star follows focus
+FLI = FakeLibfli()
@@ -1,29 +1,367 @@
 #!/usr/bin/env python
 
-import cStringIO
-from astropy.io import fits as pyfits
+import os
+import re
+import json
+import math
+import time
+import threading
+import itertools
+from collections import OrderedDict
 import bcam
+import bcam_metrics
+from bcam_metrics import timer
+import bcam_fits
+import bcam_jobs
+import bcam_calib
+import bcam_autofocus
+import bcam_preview
+import bcam_archive
+import bcam_stats
+import bcam_track
+import bcam_history
+import bcam_stack
+import bcam_live
+import numpy as np
 import web
 from web import form
 
-render = web.template.render('/home/tim/BCAM/templates/')
+render = web.template.render(os.path.join(bcam.BCAM_HOME, 'templates/'))
 
 urls = (
     '/', 'index',
     '/status', 'index',
+    '/status/stream', 'statusstream',
     '/expose', 'expose',
     '/cooling', 'cooling',
     '/focus', 'focus',
     '/getfocus', 'getfocus',
+    '/jobs', 'jobs',
+    '/jobs/(\d+)', 'job',
+    '/jobs/(\d+)/cancel', 'canceljob',
+    '/jobs/(\d+)/result', 'jobresult',
+    '/calib', 'calib',
+    '/autofocus', 'autofocus',
+    '/sequence', 'sequence',
+    '/preview', 'preview',
+    '/devices', 'devices',
+    '/metrics', 'metrics',
+    '/archive', 'archived',
+    '/archive/(\d+)', 'archivedframe',
+    '/archive/(\d+)/cutout', 'cutout',
+    '/stats', 'stats',
+    '/track', 'track',
+    '/track/stop', 'stoptrack',
+    '/track/stream', 'trackstream',
+    '/history', 'history',
+    '/stack', 'stack',
+    '/sync', 'sync',
+    '/profiles', 'profiles',
 )
 
-b = bcam.BCAM()
-ccd = b.camera
-foc = b.foc
+# seconds between telemetry polls of the camera and focuser, which is also the finest resolution
+# of the telemetry history and how often live status is pushed to the status page
+TELEMETRY_INTERVAL = 1.0
+
+# a live status request waits at most one telemetry interval for the next change, sends it and
+# closes; the browser reconnects STREAM_RETRY ms later for the changes after it.  only
+# STREAM_WAITERS requests wait at a time, the rest get what's new and close at once, so status
+# pages can never hold more than that many of the server's worker threads.
+STREAM_RETRY = 500
+STREAM_WAITERS = 4
+streamSlots = threading.BoundedSemaphore(STREAM_WAITERS)
+
+# write each frame's stage timing and statistics into its FITS header
+bcam.BCAM.timing_card = True
+bcam.BCAM.frame_stats = True
+
+# and the focus position once the focuser has stopped, not wherever it was during a move
+bcam.BCAM.settle_focus = True
+
+# limits on each camera's job queue and on the results it keeps for download
+JOB_QUEUE_DEPTH = 16
+JOB_MAX_AGE = 3600.0
+JOB_MAX_BYTES = 512*1024*1024
+
+# master bias and dark frames live here, those of cameras after the first under their ids
+CALIB_DIR = os.path.join(bcam.BCAM_HOME, "calib")
+
+calibration = bcam_calib.CalibStore(CALIB_DIR)
+bcam.BCAM.calib = calibration
+
+previews = bcam_preview.PreviewCache()
+
+# frame sequences are written here
+SEQUENCE_DIR = os.path.join(bcam.BCAM_HOME, "sequences")
+
+# every frame taken is kept here, indexed by its header
+ARCHIVE_DIR = os.path.join(bcam.BCAM_HOME, "archive")
+
+archive = bcam_archive.Archive(ARCHIVE_DIR)
+bcam.BCAM.archive = archive
+archive.start()
+
+# every camera's job queue numbers its jobs from here, so a job id is unique across cameras
+jobIds = itertools.count(1)
+
+class Unit:
+    """
+    one camera and everything the server runs for it.  it's connected in the background, so the
+    server is up at once and reports the camera as initializing or disconnected until it's ready.
+    every exposure on it, from the forms or the job API, goes through its own job worker, so
+    different cameras expose in parallel while each camera only ever does one thing at a time.
+    """
+    def __init__(self, camera, first=False):
+        self.id = camera.id
+        self.b = camera
+        self.foc = camera.foc
+        if not first:
+            camera.calib = bcam_calib.CalibStore(os.path.join(CALIB_DIR, camera.id))
+
+        self.connector = bcam.Connector(camera)
+        camera.connector = self.connector
+        self.connector.start()
+
+        self.history = bcam_history.History()
+        self.feed = bcam_live.StatusFeed()
+        self.telemetry = bcam.Telemetry(camera, interval=TELEMETRY_INTERVAL, history=self.history,
+                                        feed=self.feed)
+        camera.telemetry = self.telemetry
+        self.telemetry.start()
+
+        self.autofocuser = bcam_autofocus.AutoFocus(camera, camera.foc)
+        self.tracker = bcam_track.Tracker(camera)
+        self.stacker = bcam_stack.Stacker(camera)
+
+        self.jobqueue = bcam_jobs.JobQueue(maxqueue=JOB_QUEUE_DEPTH, max_age=JOB_MAX_AGE,
+                                           max_bytes=JOB_MAX_BYTES, abort=camera.abortExposure,
+                                           watch=camera.watchJob,
+                                           ids=jobIds, name="jobs-%s" % camera.id)
+        self.jobqueue.start()
+
+# every camera and focuser on the host.  requests go to the first camera unless their path starts
+# with another's id, e.g. /cam1/expose.  the host is enumerated in the background, at startup and
+# then every DISCOVER_INTERVAL s, and cameras plugged in later get units of their own as they
+# turn up.
+DISCOVER_INTERVAL = 30.0
+registry = bcam.Registry()
+
+# steps past the target a downward focus move goes before coming back up to it, so focus is always
+# approached from below; 0 turns backlash compensation off
+FOCUS_BACKLASH = 0
+
+# set up a unit for a camera.  the dict is replaced rather than changed, since the discovery
+# thread adds to it while requests read it.
+def addUnit(camera):
+    global units
+    camera.foc.backlash = FOCUS_BACKLASH
+    added = OrderedDict(units)
+    added[camera.id] = Unit(camera, first=not units)
+    units = added
+
+units = OrderedDict()
+for camera in registry.cameras.values():
+    addUnit(camera)
+DEFAULT_CAMERA = units.keys()[0]
+registry.start(DISCOVER_INTERVAL, added=addUnit)
+
+CAMERA_PATH = re.compile(r"^/(cam\d+)(/.*)?$")
+
+# pick the camera a request is for and strip its id from the path before routing.  the id is
+# added to homepath so that redirects and relative links stay with the camera.
+def cameraProcessor(handle):
+    m = CAMERA_PATH.match(web.ctx.path)
+    id = DEFAULT_CAMERA
+    if m:
+        id = m.group(1)
+        if id not in units:
+            jsonError("404 Not Found", "No camera %s." % id)
+        web.ctx.homepath += "/" + id
+        web.ctx.path = m.group(2) or "/"
+    web.ctx.unit = units[id]
+    return handle()
+
+# the Unit of the camera the current request is for
+def unit():
+    return web.ctx.unit
+
+# FITS CCDTYPE for an exposure
+def ccdtype(exptime, shutter):
+    if shutter:
+        return 'OBJECT'
+    elif exptime > 0.0:
+        return 'DARK'
+    else:
+        return 'BIAS'
+
+# take one exposure on camera b and return the image with its header.  runs on the camera's job
+# worker; the frame is archived in the background.  with a barrier, it starts together with the
+# other cameras' exposures sharing it.  a profile replaces the binning.
+def takeFrame(b, exptime, shutter, xbin, ybin, calibrate=False, barrier=None, profile=None):
+    try:
+        image = b.acquireImage(exptime, shutter, xbin=xbin, ybin=ybin, calibrate=calibrate,
+                               barrier=barrier, profile=profile)
+    except Exception:
+        # don't leave the other cameras waiting for this one
+        if barrier is not None:
+            barrier.abort()
+        raise
+    header = b.makeHeader(ccdtype(exptime, shutter), exptime)
+    archive.add(image, header, b.started)
+    return image, header
+
+# send an image back to the client as a FITS file.  uncompressed files are streamed straight from
+# the array; 'compress' picks one of bcam_fits.COMPRESSION's tile compression schemes instead.
+def fitsResponse(image, header, filename="bcam.fits", compress=None):
+    web.header("Content-Type", 'image/fits')
+    web.header("Content-Disposition", "attachment; filename=%s" % filename)
+    if compress:
+        with timer("fits_compress"):
+            data = bcam_fits.compressed(image, header, compress)
+        web.header("Content-Length", str(len(data)))
+        return data
+    web.header("Content-Length", str(bcam_fits.streamLength(image, header)))
+    return timedStream(bcam_fits.stream(image, header), "fits_stream")
+
+# chunks of a file on disk
+def fileStream(path, chunk=bcam_fits.CHUNK_BYTES):
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+# pass chunks through, recording how long it took to hand them all to the client
+def timedStream(chunks, stage):
+    with timer(stage):
+        for chunk in chunks:
+            yield chunk
+
+# compression scheme requested by the client, if any
+def compression(value):
+    if not value or value == "none":
+        return None
+    if value not in bcam_fits.COMPRESSION:
+        jsonError("400 Bad Request", "Unknown compression '%s'." % value)
+    return value
+
+def jsonResponse(data):
+    web.header("Content-Type", "application/json")
+    return json.dumps(data)
+
+def jsonError(status, msg):
+    raise web.HTTPError(status, {"Content-Type": "application/json"},
+                        json.dumps({"error": msg}))
+
+# the acquisition profile picked on a validated expose form, if any, checked against the
+# sensor of the request's camera, or u's
+def profileOf(f, u=None):
+    name = f.d.profile or None
+    if name is not None:
+        try:
+            (u or unit()).b.profile(name)
+        except ValueError as e:
+            jsonError("400 Bad Request", str(e))
+    return name
+
+# queue an exposure described by a validated expose form on the request's camera, or on u
+def submitExposure(f, u=None, barrier=None):
+    u = u or unit()
+    params = {
+        "exptime": float(f.d.exptime),
+        "xbin": int(f.d.xbin),
+        "ybin": int(f.d.ybin),
+        "shutter": bool(f.d.shutter),
+        "calibrate": bool(f.d.calibrate),
+        "profile": profileOf(f, u),
+    }
+    kwargs = dict(params)
+    if barrier is not None:
+        kwargs["barrier"] = barrier
+        params["synced"] = barrier.parties
+    try:
+        return u.jobqueue.submit("expose", takeFrame, args=(u.b,), kwargs=kwargs, params=params)
+    except bcam_jobs.QueueFull as e:
+        if barrier is not None:
+            barrier.abort()
+        jsonError("503 Service Unavailable", "%s: %s" % (u.id, e))
+
+# refuse camera requests with 503 until the request's camera, or u's, is connected
+def requireCamera(u=None):
+    b = (u or unit()).b
+    if b.state != bcam.READY:
+        msg = {"error": "Camera %s is %s." % (b.id, b.state), "camera": b.id, "state": b.state,
+               "reason": b.error}
+        raise web.HTTPError("503 Service Unavailable",
+                            {"Content-Type": "application/json", "Retry-After": "5"},
+                            json.dumps(msg))
+
+# job ids are unique across cameras, so a job is found whichever camera's path asks for it
+def getJob(id):
+    for u in units.values():
+        job = u.jobqueue.get(int(id))
+        if job is not None:
+            return job
+    jsonError("404 Not Found", "No job %s." % id)
+
+# wait for a job to finish and count its hardware calls toward the current request's
+def waitJob(job):
+    job.done.wait()
+    bcam_metrics.addCalls(job.calls)
+
+# optional number from a query string
+def number(value, kind=float):
+    if value is None or value == "":
+        return None
+    try:
+        return kind(value)
+    except ValueError:
+        jsonError("400 Bad Request", "Bad number '%s'." % value)
+
+def getFrame(id):
+    frame = archive.get(int(id))
+    if frame is None or not os.path.exists(frame["path"]):
+        jsonError("404 Not Found", "No archived frame %s." % id)
+    return frame
 
 class index:
     def GET(self):
-        return render.index(ccd, foc)
+        # a stale snapshot is shown as such rather than refreshed here, so page loads never
+        # reach the hardware once the poller is running
+        u = unit()
+        snap = u.telemetry.snapshot
+        state = u.b.state
+        if snap is None and state == bcam.READY:
+            snap = u.b.status()
+        return render.index(snap, u.foc.attached, state, u.id,
+                            web.ctx.homepath + "/status/stream", TELEMETRY_INTERVAL)
+
+class statusstream:
+    # live status as server-sent events: every field at first, then only the fields that change,
+    # as the telemetry poller publishes them.  each event is a JSON object whose id is the feed's
+    # sequence number, so a reconnecting browser's Last-Event-ID picks up where it left off.
+    # each request is a short long-poll, and EventSource reconnects by itself when it ends.
+    def GET(self):
+        last = number(web.ctx.env.get("HTTP_LAST_EVENT_ID"), int)
+        web.header("Content-Type", "text/event-stream")
+        web.header("Cache-Control", "no-cache")
+        return statusEvents(unit().feed, last)
+
+def statusEvents(feed, seq):
+    yield "retry: %d\n\n" % STREAM_RETRY
+    values, seq = feed.since(seq)
+    if not values and streamSlots.acquire(False):
+        try:
+            if feed.wait(seq, TELEMETRY_INTERVAL):
+                values, seq = feed.since(seq)
+        finally:
+            streamSlots.release()
+    if values:
+        yield "id: %d\ndata: %s\n\n" % (seq, json.dumps(values))
 
 class expose:
     form = web.form.Form(
@@ -55,52 +393,51 @@ class expose:
                           value='Open', 
                           checked=True, 
                           description="Open shutter:"),
+        web.form.Checkbox('calibrate',
+                          value='Yes',
+                          checked=False,
+                          description="Subtract master dark:"),
+        web.form.Dropdown('profile',
+                          args=[('', 'Custom')] + [(p, p) for p in bcam.PROFILES],
+                          value='',
+                          description="Profile (overrides binning):"),
+        web.form.Dropdown('compress',
+                          args=[('none', 'None'), ('rice', 'Rice'), ('gzip', 'Gzip'),
+                                ('hcompress', 'HCompress')],
+                          value='none',
+                          description="Compression:"),
     )
 
     def GET(self):
         return render.expform(expose.form)
 
     def POST(self):
+        requireCamera()
         f = expose.form() 
         if not f.validates(): 
             return render.expform(f)
         else:
-            exptime = float(f.d.exptime)
-            xbin = int(f.d.xbin)
-            ybin = int(f.d.ybin)
-            shutter = f.d.shutter
-            image = b.acquireImage(exptime, shutter, xbin=xbin, ybin=ybin)
-            if shutter:
-                header = b.makeHeader('OBJECT', exptime)
-            elif exptime > 0.0:
-                header = b.makeHeader('DARK', exptime)
-            else:
-                header = b.makeHeader('BIAS', exptime)
-
-            fitsData = cStringIO.StringIO()
-            pyfits.writeto(fitsData, image, header=header, clobber=True)
-            fitsData.seek(0)
-            web.header("Content-Type", 'image/fits')
-            web.header("Content-Disposition", "attachment; filename=bcam.fits")
-            return fitsData.read()
+            job = submitExposure(f)
+            waitJob(job)
+            if job.state != bcam_jobs.DONE:
+                jsonError("500 Internal Server Error", "Exposure %s: %s" % (job.state, job.error))
+            image, header = job.result
+            return fitsResponse(image, header, compress=compression(f.d.compress))
 
 class cooling:
     form = web.form.Form(
         web.form.Dropdown('fanmode',
                           args=[('0', 'Off'), ('1', 'Low'), ('2', 'Medium'), ('3', 'High')],
-                          value="%d" % ccd.GetFanMode(),
                           description="Fan Mode"),
         web.form.Textbox('backoff', 
                          web.form.notnull, 
                          web.form.Validator('Must be >= 1.0', lambda x:float(x)>=1.0),
-                         value="%.2f" % ccd.GetCoolerBackoffPoint(),
                          size=30,
                          description="Cooler Backoff Temp (C):",
                          ),
         web.form.Textbox('setpoint', 
                          web.form.notnull, 
                          web.form.Validator('Must be >= -40.0', lambda x:float(x)>=-40.0),
-                         value="%.2f" % ccd.GetCoolerSetPoint(),
                          size=30,
                          description="Cooler Set-Point (C):",
                          ),
@@ -109,10 +446,18 @@ class cooling:
                         ),
         )
 
+    # the form starts from the current settings
     def GET(self):
-        return render.cooling(cooling.form)
+        requireCamera()
+        snap = unit().b.status()
+        f = cooling.form()
+        f.fanmode.value = "%d" % snap["fan_mode"]
+        f.backoff.value = "%.2f" % snap["backoff"]
+        f.setpoint.value = "%.2f" % snap["setpoint"]
+        return render.cooling(f)
 
     def POST(self):
+        requireCamera()
         f = cooling.form()
         if not f.validates():
             return render.cooling(f)
@@ -120,6 +465,7 @@ class cooling:
             fanmode = int(f.d.fanmode)
             backoff = float(f.d.backoff)
             setpoint = float(f.d.setpoint)
+            ccd = unit().b.camera
             ccd.SetCooler(True)
             ccd.SetFanMode(fanmode)
             ccd.SetCoolerBackoffPoint(backoff)
@@ -141,22 +487,624 @@ class focus:
     )
 
     def GET(self):
-        return render.focus(foc, focus.form)
+        return render.focus(unit().foc, focus.form)
 
     def POST(self):
         f = focus.form()
         if not f.validates():
-            return render.focus(foc, f)
+            return render.focus(unit().foc, f)
         else:
             newfocus = int(f.d.focus)
-            foc.goto(newfocus, async=True)
+            unit().foc.goto(newfocus, async=True)
             raise web.seeother('/status')
 
 class getfocus:
+    # the focus position once the focuser has stopped, or wherever it is now with ?wait=0
     def GET(self):
+        foc = unit().foc
+        if web.input(wait="1").wait != "0":
+            foc.waitForMotion()
         return foc.position()
 
+class jobs:
+    def GET(self):
+        return jsonResponse([j.info() for j in unit().jobqueue.list()])
+
+    # submit an exposure with the same fields as the expose form and return its job at once
+    def POST(self):
+        requireCamera()
+        f = expose.form()
+        if not f.validates():
+            jsonError("400 Bad Request", dict([(i.name, i.note) for i in f.inputs if i.note]))
+        return jsonResponse(submitExposure(f).info())
+
+class job:
+    def GET(self, id):
+        return jsonResponse(getJob(id).info())
+
+class canceljob:
+    def POST(self, id):
+        job = getJob(id)
+        if not [u for u in units.values() if u.jobqueue.cancel(job.id)]:
+            jsonError("409 Conflict", "Job %s is already %s." % (id, job.state))
+        return jsonResponse(job.info())
+
+class jobresult:
+    def GET(self, id):
+        job = getJob(id)
+        if job.result is None:
+            jsonError("409 Conflict", "Job %s has no result (%s)." % (id, job.state))
+        if isinstance(job.result, dict):
+            return jsonResponse(job.result)
+        image, header = job.result
+        compress = compression(web.input(compress=None).compress)
+        return fitsResponse(image, header, filename="bcam-%d.fits" % job.id, compress=compress)
+
+class calib:
+    form = web.form.Form(
+        web.form.Textbox('exptime',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 0.0', lambda x:float(x)>=0.0),
+                         value="0.0"),
+        web.form.Textbox('nframes',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="10"),
+        web.form.Textbox('xbin',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="8"),
+        web.form.Textbox('ybin',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="8"),
+        web.form.Dropdown('method', args=bcam_calib.METHODS, value="median"),
+    )
+
+    # masters available on disk for the camera
+    def GET(self):
+        return jsonResponse(unit().b.calib.list())
+
+    # queue a master bias (exptime=0) or dark build; the master is the job's result
+    def POST(self):
+        requireCamera()
+        f = calib.form()
+        if not f.validates():
+            jsonError("400 Bad Request", dict([(i.name, i.note) for i in f.inputs if i.note]))
+        params = {
+            "exptime": float(f.d.exptime),
+            "n": int(f.d.nframes),
+            "xbin": int(f.d.xbin),
+            "ybin": int(f.d.ybin),
+            "method": f.d.method,
+        }
+        u = unit()
+        try:
+            job = u.jobqueue.submit("calib", u.b.calib.build, args=(u.b,), kwargs=params,
+                                    params=params)
+        except bcam_jobs.QueueFull as e:
+            jsonError("503 Service Unavailable", str(e))
+        return jsonResponse(job.info())
+
+class autofocus:
+    form = web.form.Form(
+        web.form.Textbox('start',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 0 and <= 7000',
+                                            lambda x:int(x)>=0 and int(x)<=7000)),
+        web.form.Textbox('stop',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 0 and <= 7000',
+                                            lambda x:int(x)>=0 and int(x)<=7000)),
+        web.form.Textbox('step',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="100"),
+        web.form.Textbox('exptime',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0.0', lambda x:float(x)>0.0),
+                         value="1.0"),
+        web.form.Textbox('box',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 16', lambda x:int(x)>=16),
+                         value="128"),
+        web.form.Textbox('x'),
+        web.form.Textbox('y'),
+    )
+
+    # progress of the current or last run
+    def GET(self):
+        return jsonResponse(unit().autofocuser.progress)
+
+    # queue an autofocus run on the job worker
+    def POST(self):
+        requireCamera()
+        f = autofocus.form()
+        if not f.validates():
+            jsonError("400 Bad Request", dict([(i.name, i.note) for i in f.inputs if i.note]))
+        params = {
+            "start": int(f.d.start),
+            "stop": int(f.d.stop),
+            "step": int(f.d.step),
+            "exptime": float(f.d.exptime),
+            "box": int(f.d.box),
+            "x": None,
+            "y": None,
+        }
+        if f.d.x and f.d.y:
+            params["x"] = number(f.d.x, int)
+            params["y"] = number(f.d.y, int)
+        try:
+            bcam_autofocus.sweepPositions(params["start"], params["stop"], params["step"])
+        except bcam_autofocus.AutoFocusError as e:
+            jsonError("400 Bad Request", str(e))
+        u = unit()
+        try:
+            job = u.jobqueue.submit("autofocus", u.autofocuser.run, kwargs=params, params=params)
+        except bcam_jobs.QueueFull as e:
+            jsonError("503 Service Unavailable", str(e))
+        return jsonResponse(job.info())
+
+class sequence:
+    form = web.form.Form(
+        web.form.Textbox('nframes',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="10"),
+    )
+
+    # queue a sequence of frames written to disk on the server.  takes the expose form's fields
+    # plus the number of frames; the job's result is the per-frame timing.
+    def POST(self):
+        requireCamera()
+        f = expose.form()
+        g = sequence.form()
+        if not f.validates() or not g.validates():
+            notes = [(i.name, i.note) for i in f.inputs + g.inputs if i.note]
+            jsonError("400 Bad Request", dict(notes))
+        u = unit()
+        exptime = float(f.d.exptime)
+        shutter = bool(f.d.shutter)
+        if not os.path.isdir(SEQUENCE_DIR):
+            os.makedirs(SEQUENCE_DIR)
+        params = {
+            "n": int(g.d.nframes),
+            "exp": exptime,
+            "shutter": shutter,
+            "prefix": os.path.join(SEQUENCE_DIR,
+                                   time.strftime("bcam-%s-%%Y%%m%%d-%%H%%M%%S" % u.id)),
+            "ccdtype": ccdtype(exptime, shutter),
+            "xbin": int(f.d.xbin),
+            "ybin": int(f.d.ybin),
+            "calibrate": bool(f.d.calibrate),
+            "profile": profileOf(f, u),
+        }
+        try:
+            job = u.jobqueue.submit("sequence", u.b.sequence, kwargs=params, params=params)
+        except bcam_jobs.QueueFull as e:
+            jsonError("503 Service Unavailable", str(e))
+        return jsonResponse(job.info())
+
+class stack:
+    form = web.form.Form(
+        web.form.Textbox('nframes',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="10"),
+        web.form.Dropdown('method', args=bcam_stack.METHODS, value="mean"),
+        web.form.Dropdown('register', args=bcam_stack.REGISTRATION, value="none"),
+        web.form.Textbox('nsigma',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0.0', lambda x:float(x)>0.0),
+                         value="3.0"),
+    )
+
+    # progress of the current or last stack, with its per-frame offset table
+    def GET(self):
+        return jsonResponse(unit().stacker.progress)
+
+    # queue a stack of frames combined on the server.  takes the expose form's fields plus the
+    # number of frames, combine method and registration; the job's result is the stack, which
+    # /jobs/<id>/result returns as a float32 FITS file.
+    def POST(self):
+        requireCamera()
+        f = expose.form()
+        g = stack.form()
+        if not f.validates() or not g.validates():
+            notes = [(i.name, i.note) for i in f.inputs + g.inputs if i.note]
+            jsonError("400 Bad Request", dict(notes))
+        u = unit()
+        params = {
+            "n": int(g.d.nframes),
+            "exptime": float(f.d.exptime),
+            "method": g.d.method,
+            "register": g.d.register,
+            "nsigma": float(g.d.nsigma),
+            "shutter": bool(f.d.shutter),
+            "xbin": int(f.d.xbin),
+            "ybin": int(f.d.ybin),
+            "calibrate": bool(f.d.calibrate),
+            "profile": profileOf(f, u),
+        }
+        try:
+            job = u.jobqueue.submit("stack", u.stacker.run, kwargs=params, params=params)
+        except bcam_jobs.QueueFull as e:
+            jsonError("503 Service Unavailable", str(e))
+        return jsonResponse(job.info())
+
+class sync:
+    form = web.form.Form(
+        web.form.Textbox('cameras'),
+        web.form.Textbox('timeout',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0.0', lambda x:float(x)>0.0),
+                         value="30.0"),
+    )
+
+    # expose on several cameras at once.  takes the expose form's fields plus the comma-separated
+    # camera ids (all of them by default) and how long to wait for the last of them to be free.
+    # each exposure is queued on its own camera's worker and they all start together once every
+    # camera is ready.  returns the jobs, whose results are the frames.
+    def POST(self):
+        f = expose.form()
+        g = sync.form()
+        if not f.validates() or not g.validates():
+            notes = [(i.name, i.note) for i in f.inputs + g.inputs if i.note]
+            jsonError("400 Bad Request", dict(notes))
+        ids = units.keys()
+        if g.d.cameras:
+            ids = g.d.cameras.split(",")
+            unknown = [id for id in ids if id not in units]
+            if unknown:
+                jsonError("404 Not Found", "No cameras %s." % ", ".join(unknown))
+        for id in ids:
+            requireCamera(units[id])
+        barrier = bcam.StartBarrier(len(ids), timeout=float(g.d.timeout))
+        jobs = [submitExposure(f, units[id], barrier) for id in ids]
+        return jsonResponse(dict([(id, job.info()) for id, job in zip(ids, jobs)]))
+
+class profiles:
+    # the acquisition profiles the expose form's 'profile' field takes, each with the binning and
+    # window it comes to on this camera's sensor, or why the sensor can't do it
+    def GET(self):
+        requireCamera()
+        b = unit().b
+        found = OrderedDict()
+        for name in bcam.PROFILES:
+            try:
+                found[name] = b.profile(name)
+            except ValueError as e:
+                found[name] = {"error": str(e)}
+        return jsonResponse(found)
+
+class preview:
+    # quick-look PNG/JPEG of a frame: the given job's (?job=<id>), a fresh exposure (?fresh=1 with
+    # the expose form's fields) or by default the last exposure taken.  size, stretch and format
+    # pick the rendering.
+    def GET(self):
+        i = web.input(job=None, fresh=None, size="512", stretch="zscale",
+                      format=bcam_preview.formats()[-1])
+        if i.stretch not in bcam_preview.STRETCHES:
+            jsonError("400 Bad Request", "Unknown stretch '%s'." % i.stretch)
+        if i.format not in bcam_preview.formats():
+            jsonError("400 Bad Request", "Unsupported format '%s'." % i.format)
+        size = number(i.size, int)
+        if size is None:
+            jsonError("400 Bad Request", "Bad size '%s'." % i.size)
+        size = min(max(size, 16), 2048)
+
+        if i.fresh:
+            requireCamera()
+            f = expose.form()
+            if not f.validates():
+                jsonError("400 Bad Request", dict([(n.name, n.note) for n in f.inputs if n.note]))
+            job = submitExposure(f)
+            waitJob(job)
+        elif i.job:
+            job = getJob(i.job)
+        else:
+            job = unit().jobqueue.latest("expose")
+            if job is None:
+                jsonError("404 Not Found", "No exposure to preview yet.")
+        if not isinstance(job.result, tuple):
+            jsonError("409 Conflict", "Job %d has no image (%s)." % (job.id, job.state))
+
+        image, header = job.result
+        data = previews.get(job.id, image, size, i.stretch, i.format)
+        web.header("Content-Type", "image/%s" % i.format)
+        web.header("Content-Length", str(len(data)))
+        return data
+
+class devices:
+    # connection state and contention counters for every camera and focuser
+    def GET(self):
+        found = []
+        for u in units.values():
+            camera = u.b.device.stats()
+            camera.update({"state": u.b.state, "error": u.b.error, "address": u.b.address,
+                           "connect_attempts": u.connector.attempts, "focuser": u.foc.id,
+                           "job_queue_depth": u.jobqueue.depth()})
+            found.append(camera)
+        for foc in registry.focusers.values():
+            focuser = foc.device.stats()
+            focuser.update({"attached": foc.attached, "path": foc.path,
+                            "moving": not foc.settled(), "target": foc.target(),
+                            "extent": foc.extent})
+            found.append(focuser)
+        return jsonResponse(found)
+
+class archived:
+    # archived frames matching the query, e.g. ?ccdtype=DARK&xbin=8&ybin=8&t_ccd=-20&t_tol=1
+    def GET(self):
+        i = web.input(ccdtype=None, exptime=None, xbin=None, ybin=None, t_ccd=None, t_tol="1.0",
+                      focus=None, since=None, until=None, limit="100")
+        frames = archive.query(ccdtype=i.ccdtype or None, exptime=number(i.exptime),
+                               xbin=number(i.xbin, int), ybin=number(i.ybin, int),
+                               t_ccd=number(i.t_ccd), t_tol=number(i.t_tol),
+                               focus=number(i.focus, int), since=number(i.since),
+                               until=number(i.until), limit=number(i.limit, int))
+        return jsonResponse(frames)
+
+class archivedframe:
+    # the archived FITS file, read from disk a chunk at a time
+    def GET(self, id):
+        frame = getFrame(id)
+        web.header("Content-Type", 'image/fits')
+        web.header("Content-Disposition", "attachment; filename=%s" %
+                   os.path.basename(frame["path"]))
+        web.header("Content-Length", str(os.path.getsize(frame["path"])))
+        return fileStream(frame["path"])
+
+class cutout:
+    # FITS of part of an archived frame: columns x0:x1 and rows y0:y1, each defaulting to the
+    # full extent, so ?y0=100&y1=200 gives a range of rows
+    def GET(self, id):
+        frame = getFrame(id)
+        i = web.input(x0="0", y0="0", x1=None, y1=None, compress=None)
+        x0, y0 = max(number(i.x0, int), 0), max(number(i.y0, int), 0)
+        x1, y1 = number(i.x1, int), number(i.y1, int)
+        image = archive.cutout(frame, x0, y0, x1, y1)
+        if image.size == 0:
+            jsonError("400 Bad Request", "Empty cutout.")
+        header = archive.header(frame, x0, y0)
+        return fitsResponse(image, header, filename="bcam-%d-cutout.fits" % frame["id"],
+                            compress=compression(i.compress))
+
+class stats:
+    # statistics of a frame, from its header cards: the given job's (?job=<id>), an archived
+    # frame's (?archive=<id>) or by default the last exposure's
+    def GET(self):
+        i = web.input(job=None, archive=None)
+        if i.archive:
+            frame = getFrame(i.archive)
+            result = {"archive": frame["id"], "stats": bcam_stats.fromHeader(archive.header(frame))}
+        else:
+            if i.job:
+                job = getJob(i.job)
+            else:
+                job = unit().jobqueue.latest("expose")
+                if job is None:
+                    jsonError("404 Not Found", "No exposure yet.")
+            if not isinstance(job.result, tuple):
+                jsonError("409 Conflict", "Job %d has no image (%s)." % (job.id, job.state))
+            image, header = job.result
+            result = {"job": job.id, "stats": bcam_stats.fromHeader(header)}
+        if result["stats"] is None:
+            jsonError("409 Conflict", "No statistics were recorded for that frame.")
+        return jsonResponse(result)
+
+# the camera's track job that is queued or still running, if any
+def trackJob(u):
+    for job in u.jobqueue.list():
+        if job.kind == "track" and job.state in (bcam_jobs.QUEUED, bcam_jobs.RUNNING,
+                                                 bcam_jobs.CANCELLING):
+            return job
+    return None
+
+# held while a track job is checked for and submitted, so two can't get in together
+trackLock = threading.Lock()
+
+class track:
+    form = web.form.Form(
+        web.form.Textbox('exptime',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 0.0', lambda x:float(x)>=0.0),
+                         value="0.1"),
+        web.form.Textbox('box',
+                         web.form.notnull,
+                         web.form.Validator('Must be >= 16 and <= 512',
+                                            lambda x:int(x)>=16 and int(x)<=512),
+                         value="64"),
+        web.form.Textbox('xbin',
+                         web.form.notnull,
+                         web.form.Validator('Must be > 0', lambda x:int(x)>0),
+                         value="1"),
+        web.form.Textbox('x'),
+        web.form.Textbox('y'),
+        web.form.Textbox('frames'),
+        web.form.Textbox('duration'),
+    )
+
+    # tracking progress and the records after ?since=<n>, as JSON or, with ?format=binary, as
+    # packed little-endian (t, x, y, flux, fwhm) float64/float32 records.  X-Track-Next is the
+    # number to ask for next time.
+    def GET(self):
+        i = web.input(since="0", format="json")
+        tracker = unit().tracker
+        records, seq = tracker.records.since(number(i.since, int) or 0)
+        web.header("X-Track-Next", str(seq))
+        if i.format == "binary":
+            web.header("Content-Type", "application/octet-stream")
+            return records.tostring()
+        rows = [dict(zip(bcam_track.RECORD.names, r.item())) for r in records]
+        return jsonResponse({"progress": tracker.progress, "next": seq, "records": rows})
+
+    # start tracking on the job worker
+    def POST(self):
+        requireCamera()
+        f = track.form()
+        if not f.validates():
+            jsonError("400 Bad Request", dict([(i.name, i.note) for i in f.inputs if i.note]))
+        u = unit()
+        params = {
+            "exptime": float(f.d.exptime),
+            "box": int(f.d.box),
+            "xbin": int(f.d.xbin),
+            "x": number(f.d.x, int),
+            "y": number(f.d.y, int),
+            "frames": number(f.d.frames, int),
+            "duration": number(f.d.duration),
+        }
+        trackLock.acquire()
+        try:
+            job = trackJob(u)
+            if job is not None:
+                jsonError("409 Conflict", "Already tracking (job %d is %s)." % (job.id, job.state))
+            # the run's own stop Event, which /track/stop sets
+            kwargs = dict(params, stop=threading.Event())
+            job = u.jobqueue.submit("track", u.tracker.run, kwargs=kwargs, params=params)
+        except bcam_jobs.QueueFull as e:
+            jsonError("503 Service Unavailable", str(e))
+        finally:
+            trackLock.release()
+        return jsonResponse(job.info())
+
+class stoptrack:
+    # finish the current frame and stop, or stop as soon as a queued track job starts; the job's
+    # result is the run's summary
+    def POST(self):
+        u = unit()
+        job = trackJob(u)
+        if job is None or (job.state != bcam_jobs.QUEUED and not u.tracker.running()):
+            jsonError("409 Conflict", "Not tracking.")
+        job.kwargs["stop"].set()
+        return jsonResponse(u.tracker.progress)
+
+class trackstream:
+    # records as text lines "t x y flux fwhm", sent as they arrive from ?since=<n> on, until
+    # tracking stops
+    def GET(self):
+        i = web.input(since="0")
+        web.header("Content-Type", "text/plain")
+        return trackLines(unit().tracker, number(i.since, int) or 0)
+
+def trackLines(tracker, seq):
+    while True:
+        records, seq = tracker.records.since(seq)
+        for r in records:
+            yield "%.4f %.3f %.3f %.1f %.3f\n" % r.item()
+        if not tracker.running():
+            break
+        tracker.records.wait(seq, 1.0)
+
+class history:
+    # min/mean/max telemetry from ?start= to ?end= (unix s; negative means seconds before now,
+    # default the last hour) in steps of ?step= s, for the comma-separated ?fields= (default all).
+    # JSON by default; ?format=binary gives float64 times followed by a float32 (min, mean, max)
+    # triple per field per step, with the layout in the X-History-* headers.
+    def GET(self):
+        i = web.input(start=None, end=None, step=None, fields=None, format="json")
+        now = time.time()
+        start = number(i.start)
+        end = number(i.end)
+        step = number(i.step)
+        for name, value in (("start", start), ("end", end), ("step", step)):
+            if value is not None and (math.isnan(value) or math.isinf(value)):
+                jsonError("400 Bad Request", "Bad %s '%s'." % (name, i[name]))
+        if start is None:
+            start = -3600.0
+        if end is None:
+            end = now
+        elif end < 0:
+            end += now
+        if start < 0:
+            start += now
+        end = min(end, now)
+        if start > end:
+            jsonError("400 Bad Request", "Start must be before end.")
+        if step is not None and step <= 0:
+            jsonError("400 Bad Request", "Step must be > 0.")
+        telemetryHistory = unit().history
+        fields = None
+        if i.fields:
+            fields = i.fields.split(",")
+            unknown = [f for f in fields if f not in telemetryHistory.fields]
+            if unknown:
+                jsonError("400 Bad Request", "Unknown fields %s." % ", ".join(unknown))
+        step, times, series = telemetryHistory.query(start, end, step=step, fields=fields)
+        names = fields or telemetryHistory.fields
+        if i.format == "binary":
+            web.header("Content-Type", "application/octet-stream")
+            web.header("X-History-Step", str(step))
+            web.header("X-History-Points", str(len(times)))
+            web.header("X-History-Fields", ",".join(names))
+            data = np.empty((len(times), len(names), 3), dtype="<f4")
+            for j, name in enumerate(names):
+                for k in range(3):
+                    data[:, j, k] = series[name][k]
+            return times.astype("<f8").tostring() + data.tostring()
+        return jsonResponse({
+            "step": step,
+            "t": times.tolist(),
+            "fields": dict([(name, {"min": jsonSeries(series[name][0]),
+                                    "mean": jsonSeries(series[name][1]),
+                                    "max": jsonSeries(series[name][2])}) for name in names]),
+        })
+
+# values with NaN as null, since JSON has no NaN
+def jsonSeries(values):
+    return [None if v != v else round(v, 3) for v in values.tolist()]
+
+# time each request and count the hardware calls made on its thread and by the jobs it waited
+# for.  ids in the path are folded together and paths that match no route are counted as "other",
+# to keep the number of label values bounded.
+def metricsProcessor(handle):
+    path = metricsPath(web.ctx.path)
+    bcam_metrics.resetCalls()
+    t0 = time.time()
+    try:
+        return handle()
+    finally:
+        bcam_metrics.REQUEST_SECONDS.observe(time.time() - t0, path=path)
+        bcam_metrics.REQUEST_HW_CALLS.observe(bcam_metrics.threadCalls(), path=path)
+
+ROUTES = [re.compile("^" + pattern + "$") for pattern in urls[::2]]
+
+def metricsPath(path):
+    m = CAMERA_PATH.match(path)
+    route = path
+    if m:
+        if m.group(1) not in units:
+            return "other"
+        route = m.group(2) or "/"
+    if not [r for r in ROUTES if r.match(route)]:
+        return "other"
+    return re.sub(r"/\d+", "/<id>", path)
+
+DEVICE_QUEUE = bcam_metrics.Gauge("bcam_device_queue_depth", "Calls waiting for each device.")
+DEVICE_WAIT = bcam_metrics.Gauge("bcam_device_wait_seconds",
+                                 "Total time calls have waited for each device.")
+JOB_QUEUE = bcam_metrics.Gauge("bcam_job_queue_depth", "Jobs waiting for each camera's worker.")
+CAMERA_READY = bcam_metrics.Gauge("bcam_camera_ready", "1 if the camera is connected, else 0.")
+
+class metrics:
+    # Prometheus text exposition
+    def GET(self):
+        devices = [u.b.device for u in units.values()] + \
+            [foc.device for foc in registry.focusers.values()]
+        for device in devices:
+            stats = device.stats()
+            DEVICE_QUEUE.set(stats["queue_depth"], device=device.name)
+            DEVICE_WAIT.set(stats["wait_total"], device=device.name)
+        for u in units.values():
+            JOB_QUEUE.set(u.jobqueue.depth(), camera=u.id)
+            CAMERA_READY.set(int(u.b.state == bcam.READY), camera=u.id)
+        web.header("Content-Type", "text/plain; version=0.0.4")
+        return bcam_metrics.render()
+
 if __name__ == "__main__":
 
     app = web.application(urls, globals())
+    app.add_processor(metricsProcessor)
+    app.add_processor(cameraProcessor)
     app.run()
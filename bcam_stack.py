@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+stacking for BCAM.  a series of frames is acquired into one reused buffer and folded into running
+accumulators as it arrives, so memory stays the same however many frames go in.  frames can be
+registered on the star's centroid, by whole pixels or with bilinear sub-pixel shifts, and combined
+as a sum, a mean or a sigma-clipped mean.  the star is found once on the first frame and after that
+only measured in a small box around where it was last seen, so other sources and the background of
+the rest of the frame don't pull the centroid.  the clipping is done on the fly against each pixel's
+running mean and variance (Welford's method) once a few frames are in.
+"""
+
+import time
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+import bcam_star
+from bcam import b_log, ExposureError, ImageBuffer, fitsDate
+
+METHODS = ("sum", "mean", "sigclip")
+REGISTRATION = ("none", "integer", "subpixel")
+
+# side of the box (binned pixels) the registration star is measured in
+REGISTER_BOX = 32
+
+# a box only counts as holding the star if its peak is this many robust sigmas above the background
+DETECTION = 5.0
+
+class StackError(Exception):
+    """
+    raised when a stack can't be built, e.g. no frame could be registered.
+    """
+    pass
+
+# destination and source slices along an axis of length n for a shift of d whole pixels
+def overlap(n, d):
+    if d >= 0:
+        return slice(d, n), slice(0, n - d)
+    return slice(0, n + d), slice(-d, n)
+
+# frame moved by (dx, dy) pixels: returns the destination region as a pair of slices and the
+# float32 values that land there, or None if nothing overlaps.  fractional shifts are bilinear,
+# which costs the region its first row and column.
+def shifted(frame, dx, dy):
+    rows, cols = frame.shape
+    ix, iy = int(np.floor(dx)), int(np.floor(dy))
+    fx, fy = dx - ix, dy - iy
+    ys_d, ys_s = overlap(rows, iy)
+    xs_d, xs_s = overlap(cols, ix)
+    if ys_d.stop - ys_d.start < 2 or xs_d.stop - xs_d.start < 2:
+        return None
+    base = frame[ys_s, xs_s].astype(np.float32)
+    if fx == 0.0 and fy == 0.0:
+        return (ys_d, xs_d), base
+    values = (1.0 - fx)*(1.0 - fy)*base[1:, 1:]
+    values += fx*(1.0 - fy)*base[1:, :-1]
+    values += (1.0 - fx)*fy*base[:-1, 1:]
+    values += fx*fy*base[:-1, :-1]
+    return (slice(ys_d.start + 1, ys_d.stop), slice(xs_d.start + 1, xs_d.stop)), values
+
+# the star near (x, y) in image, measured on a box x box cutout, with its centroid in frame
+# coordinates; None if the box holds no detection
+def locate(image, x, y, box=REGISTER_BOX):
+    rows, cols = image.shape
+    x0 = int(min(max(int(round(x)) - box//2, 0), max(cols - box, 0)))
+    y0 = int(min(max(int(round(y)) - box//2, 0), max(rows - box, 0)))
+    cut = image[y0:y0+box, x0:x0+box]
+    bg, sigma = bcam_star.background(cut.astype(np.float32))
+    if cut.max() - bg < DETECTION*max(sigma, 1.0):
+        return None
+    m = bcam_star.measure(cut, windowed=True)
+    if m is None:
+        return None
+    m["x"] += x0
+    m["y"] += y0
+    return m
+
+class Accumulator:
+    """
+    running combination of frames of one shape.  'sum' and 'mean' keep a float64 sum; 'sigclip'
+    keeps a float32 running mean and sum of squared deviations, and from the 'warmup'th frame on
+    leaves out pixels more than nsigma sigma from their running mean.  every method keeps a count
+    per pixel, so shifted frames that only partly cover the stack are averaged correctly.
+    """
+    def __init__(self, shape, method="mean", nsigma=3.0, warmup=3):
+        if method not in METHODS:
+            raise StackError("Unknown combine method '%s'." % method)
+        self.method = method
+        self.nsigma = nsigma
+        self.warmup = warmup
+        self.frames = 0
+        self.rejected = 0
+        self.count = np.zeros(shape, dtype=np.uint16)
+        if method == "sigclip":
+            self.mean = np.zeros(shape, dtype=np.float32)
+            self.m2 = np.zeros(shape, dtype=np.float32)
+        else:
+            self.sum = np.zeros(shape, dtype=np.float64)
+
+    # fold in values covering region (a pair of slices)
+    def add(self, region, values):
+        n = self.count[region]
+        if self.method == "sigclip":
+            mean = self.mean[region]
+            m2 = self.m2[region]
+            if self.frames >= self.warmup:
+                sigma = np.sqrt(m2/(np.maximum(n, 2) - 1))
+                keep = (n < 2) | (np.abs(values - mean) <= self.nsigma*np.maximum(sigma, 1.0))
+                self.rejected += int(keep.size - keep.sum())
+            else:
+                keep = np.ones(values.shape, dtype=bool)
+            n += keep
+            delta = np.where(keep, values - mean, 0.0)
+            mean += delta/np.maximum(n, 1)
+            m2 += delta*(values - mean)
+        else:
+            self.sum[region] += values
+            n += 1
+        self.frames += 1
+
+    # the combined image as float32
+    def result(self):
+        if self.method == "sigclip":
+            return np.where(self.count > 0, self.mean, 0.0).astype(np.float32)
+        if self.method == "sum":
+            return self.sum.astype(np.float32)
+        return (self.sum/np.maximum(self.count, 1)).astype(np.float32)
+
+class Stacker:
+    """
+    builds stacks on the job worker.  'progress' holds the state of the current or last run,
+    including its per-frame offset table, and is safe to read from other threads.
+    """
+    def __init__(self, bcam):
+        self.bcam = bcam
+        self.buf = ImageBuffer(0)
+        self.progress = {"state": "idle", "offsets": []}
+
+    def update(self, **kw):
+        p = dict(self.progress)
+        p.update(kw)
+        self.progress = p
+
+    # acquire n frames of 'exptime' s and combine them with 'method', registering each on the
+    # first frame's star as 'register' says.  other keywords go to acquireImage.  returns the
+    # stack and its header.
+    def run(self, n, exptime, method="mean", register="none", nsigma=3.0, shutter=True, **kw):
+        try:
+            return self.stack(n, exptime, method, register, nsigma, shutter, kw)
+        except Exception as e:
+            self.update(state="failed", error=str(e))
+            raise
+
+    def stack(self, n, exptime, method, register, nsigma, shutter, kw):
+        if register not in REGISTRATION:
+            raise StackError("Unknown registration '%s'." % register)
+        t0 = time.time()
+        self.update(state="stacking", error=None, total=n, done=0, offsets=[])
+        acc = None
+        ref = None
+        last = None
+        first = end = None
+        offsets = []
+        for i in range(n):
+            if self.bcam.aborting.isSet():
+                raise ExposureError("Stack aborted.", "aborted")
+            image = self.bcam.acquireImage(exptime, shutter, buf=self.buf, stats=False, **kw)
+            if first is None:
+                first = self.bcam.started
+            end = self.bcam.started + exptime
+            if acc is None:
+                acc = Accumulator(image.shape, method, nsigma)
+
+            dx = dy = 0.0
+            used = True
+            if register != "none":
+                if last is None:
+                    last = bcam_star.findStar(image)
+                m = locate(image, last[0], last[1])
+                if m is None:
+                    used = False
+                else:
+                    last = (m["x"], m["y"])
+                    if ref is None:
+                        ref = last
+                    dx, dy = ref[0] - m["x"], ref[1] - m["y"]
+                    if register == "integer":
+                        dx, dy = float(round(dx)), float(round(dy))
+            if used:
+                moved = shifted(image, dx, dy)
+                if moved is None:
+                    used = False
+                else:
+                    acc.add(*moved)
+            offsets.append({"frame": i, "dx": dx, "dy": dy, "used": used})
+            self.update(done=i + 1, offsets=list(offsets))
+
+        if acc is None or acc.frames == 0:
+            raise StackError("No frames could be registered.")
+        result = acc.result()
+        # the header is the last frame's, so its dates are put back to the stack's span and its
+        # per-frame stage times left out
+        header = self.bcam.makeHeader("STACK", exptime)
+        header["DATE-OBS"] = fitsDate(first)
+        header.insert("DATE-OBS", pyfits.createCard("DATE-END", fitsDate(end),
+                                                    "Last exposure end (UTC)"), after=True)
+        if "TIMING" in header:
+            del header["TIMING"]
+        header.append(pyfits.createCard("NCOMBINE", acc.frames, "Frames combined"))
+        header.append(pyfits.createCard("TOTEXP", exptime*acc.frames, "Total exposure (s)"))
+        header.append(pyfits.createCard("NSKIPPED", n - acc.frames, "Frames left out"))
+        header.append(pyfits.createCard("COMBINE", method, "Combine method"))
+        header.append(pyfits.createCard("REGISTER", register, "Frame registration"))
+        if method == "sigclip":
+            header.append(pyfits.createCard("NSIGMA", nsigma, "Clipping threshold (sigma)"))
+            header.append(pyfits.createCard("NREJECT", acc.rejected, "Pixel values clipped"))
+        elapsed = time.time() - t0
+        self.update(state="done", frames=acc.frames, rejected=acc.rejected, elapsed=elapsed)
+        b_log.info("Stacked %d of %d frames (%s, %s registration) in %.1f s." %
+                   (acc.frames, n, method, register, elapsed))
+        return result, header
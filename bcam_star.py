@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+star measurements on small BCAM frames: background, centroid, flux, half-flux diameter and FWHM.
+everything is done with whole-array numpy operations so it stays cheap on the windows used for
+focusing and tracking.
+"""
+
+import numpy as np
+
+# pixels more than this many robust sigmas above the background count as star
+THRESHOLD = 3.0
+
+# background level and robust sigma (from the MAD) of an image
+def background(data):
+    bg = np.median(data)
+    sigma = 1.4826*np.median(np.abs(data - bg))
+    return bg, sigma
+
+# position (x, y) of the brightest pixel after a 3x3 box smooth, which keeps hot pixels and cosmic
+# rays from winning
+def findStar(image):
+    data = image.astype(np.float32)
+    smooth = data[:-2, :-2] + data[:-2, 1:-1] + data[:-2, 2:] + \
+             data[1:-1, :-2] + data[1:-1, 1:-1] + data[1:-1, 2:] + \
+             data[2:, :-2] + data[2:, 1:-1] + data[2:, 2:]
+    y, x = np.unravel_index(np.argmax(smooth), smooth.shape)
+    return x + 1, y + 1
+
+# windowed centroid: iterate a Gaussian-weighted first moment about the current position, as
+# SExtractor's XWIN/YWIN do.  data is background subtracted and sigma is the window's width.
+def windowedCentroid(data, x, y, sigma, iters=5, tol=0.01):
+    yy, xx = np.indices(data.shape)
+    for i in range(iters):
+        dx = xx - x
+        dy = yy - y
+        w = data*np.exp(-(dx*dx + dy*dy)/(2.0*sigma*sigma))
+        total = w.sum()
+        if total <= 0.0:
+            break
+        step_x = 2.0*(w*dx).sum()/total
+        step_y = 2.0*(w*dy).sum()/total
+        x += step_x
+        y += step_y
+        if abs(step_x) < tol and abs(step_y) < tol:
+            break
+    return x, y
+
+# measure the star in image.  returns a dict with the background-subtracted centroid (x, y),
+# flux, half-flux diameter and FWHM in binned pixels, or None if nothing rises above the noise.
+# with windowed set, the centroid is refined with windowedCentroid().
+def measure(image, threshold=THRESHOLD, windowed=False):
+    data = image.astype(np.float32)
+    bg, sigma = background(data)
+    data -= bg
+    f = np.where(data > threshold*max(sigma, 1.0), data, 0.0)
+    flux = f.sum()
+    if flux <= 0.0:
+        return None
+
+    y, x = np.indices(data.shape)
+    cx = (f*x).sum()/flux
+    cy = (f*y).sum()/flux
+    r2 = (x - cx)**2 + (y - cy)**2
+    hfd = 2.0*(f*np.sqrt(r2)).sum()/flux
+    fwhm = 2.3548*np.sqrt((f*r2).sum()/flux/2.0)
+    if windowed and fwhm > 0.0:
+        cx, cy = windowedCentroid(data, cx, cy, fwhm/2.3548)
+    return {"x": float(cx), "y": float(cy), "flux": float(flux), "hfd": float(hfd),
+            "fwhm": float(fwhm), "background": float(bg)}
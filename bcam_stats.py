@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+per-frame quality statistics for BCAM.  a frame is reduced to a 65536-bin histogram of its uint16
+values in one pass, a block of pixels at a time, and every statistic comes from the histogram:
+exact mean, median and percentiles, robust sigma from the median absolute deviation, the number of
+saturated pixels and a sigma-clipped background estimate.
+"""
+
+import numpy as np
+
+# pixels histogrammed at a time, which bounds the temporaries np.bincount makes
+CHUNK_PIXELS = 1024*1024
+
+# ADU at or above which a pixel counts as saturated
+SATURATION = 65535
+
+LEVELS = np.arange(65536, dtype=np.float64)
+
+# header cards for each statistic
+CARDS = (
+    ("mean", "S_MEAN", "Mean (ADU)"),
+    ("median", "S_MEDIAN", "Median (ADU)"),
+    ("sigma", "S_RSIGMA", "Robust sigma, 1.4826 x MAD (ADU)"),
+    ("background", "S_BKG", "Clipped background estimate (ADU)"),
+    ("p01", "S_P01", "1st percentile (ADU)"),
+    ("p99", "S_P99", "99th percentile (ADU)"),
+    ("min", "S_MIN", "Minimum (ADU)"),
+    ("max", "S_MAX", "Maximum (ADU)"),
+    ("saturated", "S_NSAT", "Pixels at or above saturation"),
+)
+
+def histogram(image, chunk=CHUNK_PIXELS):
+    flat = image.reshape(-1)
+    hist = np.zeros(65536, dtype=np.int64)
+    for i in xrange(0, flat.size, chunk):
+        hist += np.bincount(flat[i:i+chunk], minlength=65536)
+    return hist
+
+# value below which fraction q of the pixels in hist fall
+def quantile(hist, q, cumulative=None):
+    if cumulative is None:
+        cumulative = np.cumsum(hist)
+    return int(np.searchsorted(cumulative, q*cumulative[-1], side="left"))
+
+def weightedMean(hist, lo, hi):
+    counts = hist[lo:hi+1]
+    n = counts.sum()
+    if n == 0:
+        return 0.0
+    return float(np.dot(counts, LEVELS[lo:hi+1])/n)
+
+# median absolute deviation about 'centre'
+def mad(hist, centre):
+    dev = np.abs(np.arange(65536) - int(round(centre)))
+    return quantile(np.bincount(dev, weights=hist, minlength=65536), 0.5)
+
+# iteratively clip to median +/- nsigma sigma and estimate the background from what's left: the
+# mode as 2.5 median - 1.5 mean, unless the clipped distribution is too skewed for that to hold,
+# in which case the median
+def background(hist, nsigma=3.0, iters=3):
+    lo, hi = 0, 65535
+    for i in range(iters):
+        part = np.zeros_like(hist)
+        part[lo:hi+1] = hist[lo:hi+1]
+        median = quantile(part, 0.5)
+        mean = weightedMean(part, lo, hi)
+        sigma = max(1.4826*mad(part, median), 1.0)
+        lo = max(int(median - nsigma*sigma), 0)
+        hi = min(int(median + nsigma*sigma), 65535)
+    if abs(mean - median)/sigma < 0.3:
+        return 2.5*median - 1.5*mean
+    return float(median)
+
+# statistics of a uint16 frame as a dict keyed like CARDS
+def frameStats(image, saturation=SATURATION, chunk=CHUNK_PIXELS):
+    hist = histogram(image, chunk)
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1])
+    if n == 0:
+        return None
+    nonzero = np.flatnonzero(hist)
+    median = quantile(hist, 0.5, cumulative)
+    return {
+        "n": n,
+        "mean": float(np.dot(hist, LEVELS)/n),
+        "median": median,
+        "sigma": 1.4826*mad(hist, median),
+        "background": background(hist),
+        "p01": quantile(hist, 0.01, cumulative),
+        "p99": quantile(hist, 0.99, cumulative),
+        "min": int(nonzero[0]),
+        "max": int(nonzero[-1]),
+        "saturated": int(hist[saturation:].sum()),
+    }
+
+# statistics back out of a header's cards, for frames kept only as image and header
+def fromHeader(header):
+    stats = {}
+    for name, keyword, comment in CARDS:
+        if keyword in header:
+            stats[name] = header[keyword]
+    return stats or None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+high-cadence star tracking for BCAM.  a small window is kept programmed on the camera and exposed
+over and over; each frame is read into a reused buffer and reduced to a windowed centroid, flux and
+FWHM, which go into a fixed-size ring of records.  the window is only moved when the star drifts
+away from its centre, so most frames need no ROI register writes at all.  no FITS is ever built.
+"""
+
+import time
+import threading
+
+import numpy as np
+
+import bcam_star
+from bcam import b_log, ExposureError, ImageBuffer
+
+# pixels in the reused frame buffer; tracking windows are far smaller than a full frame
+BUFFER_PIXELS = 512*512
+
+# one tracking measurement: time (unix s), centroid in unbinned CCD pixels, flux (ADU) and FWHM
+# (unbinned pixels)
+RECORD = np.dtype([("t", "<f8"), ("x", "<f4"), ("y", "<f4"), ("flux", "<f4"), ("fwhm", "<f4")])
+
+class TrackBuffer:
+    """
+    the last 'capacity' tracking records in a preallocated numpy ring.  records are numbered from 0
+    as they arrive so readers can ask for everything after the last one they saw.
+    """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=RECORD)
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def append(self, t, x, y, flux, fwhm):
+        self.cond.acquire()
+        try:
+            self.data[self.count % self.capacity] = (t, x, y, flux, fwhm)
+            self.count += 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    # records numbered 'seq' onwards still in the ring, oldest first, and the number of the next
+    # record to come
+    def since(self, seq=0):
+        self.cond.acquire()
+        try:
+            seq = max(seq, self.count - self.capacity, 0)
+            idx = np.arange(seq, self.count) % self.capacity
+            return self.data[idx], self.count
+        finally:
+            self.cond.release()
+
+    # wait up to timeout s for a record numbered 'seq' or later
+    def wait(self, seq, timeout):
+        self.cond.acquire()
+        try:
+            if self.count <= seq:
+                self.cond.wait(timeout)
+            return self.count > seq
+        finally:
+            self.cond.release()
+
+class Tracker:
+    """
+    tracks one star with repeated exposures on a box x box window.  run() is meant for the job
+    worker and goes until its 'stop' Event is set, the frame or time limit, or an abort.  the Event
+    belongs to that run, so it can be set while the run is still queued without touching any other.
+    stop() ends the current run.  'progress' is safe to read from other threads.
+    """
+    def __init__(self, bcam, capacity=65536):
+        self.bcam = bcam
+        self.records = TrackBuffer(capacity)
+        self.buf = ImageBuffer(BUFFER_PIXELS)
+        self.stopping = threading.Event()
+        self.progress = {"state": "idle"}
+
+    def update(self, **kw):
+        p = dict(self.progress)
+        p.update(kw)
+        self.progress = p
+
+    def stop(self):
+        self.stopping.set()
+
+    def running(self):
+        return self.progress["state"] in ("locating", "tracking")
+
+    # window of box x box unbinned pixels centred as nearly as the chip allows on (x, y)
+    def window(self, x, y, box):
+        sensor = self.bcam.sensorInfo()
+        startx = int(min(max(x - box//2, 0), sensor["max_img_cols"] - box))
+        starty = int(min(max(y - box//2, 0), sensor["max_img_rows"] - box))
+        return startx, starty
+
+    # brightest star on an 8x8 binned full frame, as an unbinned position
+    def locate(self, exptime):
+        image = self.bcam.acquireImage(exptime, True, xbin=8, ybin=8, stats=False)
+        x, y = bcam_star.findStar(image)
+        return 8*x + 4, 8*y + 4
+
+    # track the star at (x, y), or the brightest one if no position is given, with 'exptime' s
+    # exposures on a 'box' pixel window binned by 'xbin'.  the window is re-centred once the star
+    # is more than 'recentre' of the box from its centre.  stops after 'frames' frames or
+    # 'duration' s if given, or once 'stop' is set.  returns a summary of the run.
+    def run(self, exptime, box=64, x=None, y=None, xbin=1, recentre=0.25, frames=None,
+            duration=None, stop=None):
+        self.stopping = stop or threading.Event()
+        try:
+            return self.track(exptime, box, x, y, xbin, recentre, frames, duration)
+        except Exception as e:
+            self.update(state="failed", error=str(e))
+            raise
+
+    def track(self, exptime, box, x, y, xbin, recentre, frames, duration):
+        t0 = time.time()
+        self.update(state="locating", error=None, frames=0, lost=0, moves=0, rate=None,
+                    first=self.records.count)
+        if x is None or y is None:
+            x, y = self.locate(exptime)
+        startx, starty = self.window(x, y, box)
+        self.update(state="tracking", x=x, y=y, box=box, xbin=xbin)
+        b_log.info("Tracking star at (%d, %d) on a %d pixel window." % (x, y, box))
+
+        n = lost = moves = 0
+        tstart = time.time()
+        while not self.stopping.isSet():
+            if self.bcam.aborting.isSet():
+                raise ExposureError("Tracking aborted.", "aborted")
+            if frames is not None and n >= frames:
+                break
+            if duration is not None and time.time() - tstart >= duration:
+                break
+            image = self.bcam.acquireImage(exptime, True, xbin=xbin, ybin=xbin, startx=startx,
+                                           starty=starty, endx=startx+box, endy=starty+box,
+                                           buf=self.buf, stats=False)
+            t = self.bcam.started + 0.5*exptime
+            n += 1
+            m = bcam_star.measure(image, windowed=True)
+            if m is None:
+                lost += 1
+            else:
+                x = startx + xbin*(m["x"] + 0.5)
+                y = starty + xbin*(m["y"] + 0.5)
+                self.records.append(t, x, y, m["flux"], xbin*m["fwhm"])
+
+                # re-centre only when the star has wandered, so the ROI stays programmed
+                cx = startx + box/2.0
+                cy = starty + box/2.0
+                if max(abs(x - cx), abs(y - cy)) > recentre*box:
+                    startx, starty = self.window(x, y, box)
+                    moves += 1
+            rate = n/max(time.time() - tstart, 1e-6)
+            self.update(frames=n, lost=lost, moves=moves, rate=rate, x=x, y=y)
+
+        elapsed = time.time() - t0
+        result = {"frames": n, "lost": lost, "moves": moves, "elapsed": elapsed,
+                  "rate": n/max(time.time() - tstart, 1e-6), "first": self.progress["first"],
+                  "next": self.records.count}
+        self.update(state="done", elapsed=elapsed)
+        b_log.info("Tracked %d frames at %.1f Hz (%d lost, %d window moves)." %
+                   (n, result["rate"], lost, moves))
+        return result